@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import unittest
 import math
 import numpy as np
@@ -100,12 +102,29 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
     #self.parametersFormLayout.addWidget("Patient:", self.patientComboBox)
     parametersFormLayout.addRow("Select Patient",self.patientComboBox)
 
+    #
+    # Patients still waiting for classification
+    #
+    self.pendingLabel = qt.QLabel("0")
+    self.stopDiscoveryButton = qt.QPushButton("Stop")
+    self.stopDiscoveryButton.toolTip = "Stops looking for patients in DICOM database."
+    self.stopDiscoveryButton.enabled = False
+    pendingLayout = qt.QHBoxLayout()
+    pendingLayout.addWidget(self.pendingLabel)
+    pendingLayout.addWidget(self.stopDiscoveryButton)
+    parametersFormLayout.addRow("Patients pending: ", pendingLayout)
+
     self.patientList = []
+    self.patientKeys = [] # patientKey of every entry of patientList, for patients discovery left pending
+    self.catalog = None
+    #CTs are shared between patients' loadDicom calls, budget is set in volumeCacheSpinBox
+    self.volumeCache = FindMarginsLib.VolumeCache(4 * 1024**3)
+    self.discovery = None
+    self.discoveryTimer = qt.QTimer()
+    self.discoveryTimer.setInterval(100)
+    self.discoveryTimer.connect('timeout()', self.onDiscoveryTimer)
     self.getPatientList()
 
-    for patient in self.patientList:
-      self.patientComboBox.addItem(patient.ID)
-
     #
     # input volume selector
     #
@@ -217,6 +236,77 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
     self.RsigmaSpinBox.setRange(0, 10)
     parametersFormLayout.addRow("Random Error [mm]:", self.RsigmaSpinBox)
     
+    #
+    # Number of concurrent registrations:
+    #
+
+    self.workersSpinBox = qt.QSpinBox()
+    self.workersSpinBox.setToolTip("Number of 4D phase registrations that run at the same time.")
+    self.workersSpinBox.setRange(1, 64)
+    self.workersSpinBox.setValue(1)
+    parametersFormLayout.addRow("Registration workers:", self.workersSpinBox)
+
+    #
+    # Memory budget for concurrent registrations:
+    #
+
+    self.memoryBudgetSpinBox = qt.QSpinBox()
+    self.memoryBudgetSpinBox.setToolTip("RAM that concurrent registrations may use, 0 uses 75% of installed memory.")
+    self.memoryBudgetSpinBox.setRange(0, 1024)
+    self.memoryBudgetSpinBox.setValue(0)
+    parametersFormLayout.addRow("Registration RAM budget [GB]:", self.memoryBudgetSpinBox)
+
+    #
+    # Memory for CTs kept loaded for reuse
+    #
+
+    self.volumeCacheSpinBox = qt.QSpinBox()
+    self.volumeCacheSpinBox.setToolTip("RAM for CTs kept in scene after use, so they don't have to be loaded from DICOM again. 0 turns it off.")
+    self.volumeCacheSpinBox.setRange(0, 1024)
+    self.volumeCacheSpinBox.setValue(4)
+    parametersFormLayout.addRow("Volume cache [GB]:", self.volumeCacheSpinBox)
+
+    #
+    # Keep vector fields on disk
+    #
+
+    self.fieldStoreComboBox = qt.QComboBox()
+    self.fieldStoreComboBox.setToolTip("Keeps vector fields in the patient's vector directory, int16 takes half the space of a NRRD field.")
+    for encoding in ["Off", "int16", "float16", "float32"]:
+      self.fieldStoreComboBox.addItem(encoding)
+    parametersFormLayout.addRow("Vector field store: ", self.fieldStoreComboBox)
+
+    #
+    # Warm start of 4D registration
+    #
+
+    self.warmStartCheckBox = qt.QCheckBox()
+    self.warmStartCheckBox.toolTip = "Start registration of each phase from the result of neighbouring phase (needs plastimatch executable)."
+    self.warmStartCheckBox.setCheckState(0)
+    parametersFormLayout.addRow("Warm start 4D registration: ", self.warmStartCheckBox)
+
+    #
+    # Registration stages
+    #
+
+    self.stageScheduleComboBox = qt.QComboBox()
+    self.stageScheduleComboBox.setToolTip("Fixed uses the same stages for all CTs, planned stages follow voxel size and extent of the CT.")
+    for schedule in ["Fixed", "Planned (fast)", "Planned (normal)", "Planned (accurate)"]:
+      self.stageScheduleComboBox.addItem(schedule)
+    parametersFormLayout.addRow("Registration stages: ", self.stageScheduleComboBox)
+
+    self.stageSiteComboBox = qt.QComboBox()
+    self.stageSiteComboBox.setToolTip("Anatomical site for planned registration stages.")
+    for site in ["default", "lung", "liver"]:
+      self.stageSiteComboBox.addItem(site)
+    parametersFormLayout.addRow("Registration site: ", self.stageSiteComboBox)
+
+    self.stageTimeBudgetSpinBox = qt.QSpinBox()
+    self.stageTimeBudgetSpinBox.setToolTip("Planned stages get fewer iterations, if one registration is estimated to take longer. 0 is no limit.")
+    self.stageTimeBudgetSpinBox.setRange(0, 600)
+    self.stageTimeBudgetSpinBox.setValue(0)
+    parametersFormLayout.addRow("Registration time budget [min]:", self.stageTimeBudgetSpinBox)
+
     #
     # Do registration
     #
@@ -224,6 +314,57 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
     self.registerButton.toolTip = "Does the registration on planning CT and 4DCT."
     parametersFormLayout.addRow(self.registerButton)
 
+    #
+    # Registration progress, registrations run in background
+    #
+    self.registrationPool = None
+    self.registrationPatient = None
+    self.registrationProgressBar = qt.QProgressBar()
+    self.registrationProgressBar.setRange(0, 100)
+    self.registrationProgressBar.setValue(0)
+    self.cancelRegistrationButton = qt.QPushButton("Cancel")
+    self.cancelRegistrationButton.toolTip = "Cancels running and queued registrations."
+    self.cancelRegistrationButton.enabled = False
+    registrationProgressLayout = qt.QHBoxLayout()
+    registrationProgressLayout.addWidget(self.registrationProgressBar)
+    registrationProgressLayout.addWidget(self.cancelRegistrationButton)
+    parametersFormLayout.addRow("Registration progress:", registrationProgressLayout)
+    self.registrationStatusLabel = qt.QLabel("")
+    parametersFormLayout.addRow(self.registrationStatusLabel)
+
+    #
+    # MidV in slabs for large 4DCTs
+    #
+
+    self.midVSlabSpinBox = qt.QSpinBox()
+    self.midVSlabSpinBox.setToolTip("Creates midV in slabs of this many slices, so memory doesn't grow with size of 4DCT. 0 processes whole volume at once.")
+    self.midVSlabSpinBox.setRange(0, 512)
+    self.midVSlabSpinBox.setValue(0)
+    parametersFormLayout.addRow("MidV slab [slices]:", self.midVSlabSpinBox)
+
+    self.midVLevelComboBox = qt.QComboBox()
+    self.midVLevelComboBox.setToolTip("Preview creates a quick midV on 2x or 4x coarser grid from the vector field pyramid, it isn't saved.")
+    for level in ["Full", "Preview (2x coarser)", "Preview (4x coarser)"]:
+      self.midVLevelComboBox.addItem(level)
+    parametersFormLayout.addRow("MidV resolution:", self.midVLevelComboBox)
+
+    #
+    # MidV only around target
+    #
+
+    self.cropToTargetCheckBox = qt.QCheckBox()
+    self.cropToTargetCheckBox.toolTip = "Computes vector fields and midV only in a box around the target contour, rest of midV is the reference phase."
+    self.cropToTargetCheckBox.setCheckState(0)
+    self.targetPaddingSpinBox = qt.QDoubleSpinBox()
+    self.targetPaddingSpinBox.setToolTip("Padding of the box around target, it has to cover target motion.")
+    self.targetPaddingSpinBox.setRange(0, 200)
+    self.targetPaddingSpinBox.setValue(30)
+    self.targetPaddingSpinBox.setSuffix(" mm")
+    cropLayout = qt.QHBoxLayout()
+    cropLayout.addWidget(self.cropToTargetCheckBox)
+    cropLayout.addWidget(self.targetPaddingSpinBox)
+    parametersFormLayout.addRow("MidV around target only:", cropLayout)
+
     #
     # MidV Button
     #
@@ -244,10 +385,19 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
     # Average 4DCT Button
     #
     self.averageButton = qt.QPushButton("3a: Create Average of 4D CT")
-    self.averageButton.toolTip = "Creates time average CT from 4DCTs."
+    self.averageButton.toolTip = "Creates time average CT and the other selected projections from 4DCTs, each phase is loaded once."
     self.averageButton.enabled = True
     parametersFormLayout.addRow(self.averageButton)
 
+    self.projectionCheckBoxes = {}
+    projectionLayout = qt.QHBoxLayout()
+    for projection, label in [('mean', 'Mean'), ('mip', 'MIP'), ('minip', 'MinIP'), ('median', 'Median'), ('std', 'Std')]:
+      checkBox = qt.QCheckBox(label)
+      checkBox.setCheckState(2 if projection == 'mean' else 0)
+      projectionLayout.addWidget(checkBox)
+      self.projectionCheckBoxes[projection] = checkBox
+    parametersFormLayout.addRow("4DCT projections:", projectionLayout)
+
     #
     # Register planning CT to midV Button
     #
@@ -270,6 +420,37 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
     self.findAmplitudesButton.toolTip = "Run the algorithm."
     self.findAmplitudesButton.enabled = False
     parametersFormLayout.addRow(self.findAmplitudesButton)
+
+    #
+    # Amplitudes of all structures
+    #
+    self.structureMotionButton = qt.QPushButton("Find breathing amplitudes of all structures")
+    self.structureMotionButton.toolTip = "Propagates all loaded contours together, every registration is loaded once. Table is saved to patient directory."
+    self.structureMotionButton.enabled = False
+    parametersFormLayout.addRow(self.structureMotionButton)
+
+    self.structureList = qt.QListWidget()
+    self.structureList.toolTip = "Structures of the structure set, whose motion is found. Propagated contours, ITV and PTV aren't listed."
+    parametersFormLayout.addRow("Structures: ", self.structureList)
+
+    self.structureTable = qt.QTableWidget()
+    self.structureTable.setColumnCount(3)
+    self.structureTable.setHorizontalHeaderLabels(FindMarginsLib.AXES)
+    self.structureTable.setRowCount(0)
+    parametersFormLayout.addRow(self.structureTable)
+
+    #
+    # Amplitude maps
+    #
+    self.amplitudeMapsButton = qt.QPushButton("Create motion amplitude maps")
+    self.amplitudeMapsButton.toolTip = "Peak-to-peak displacement per voxel of reference phase from all registrations, saved to patient directory."
+    self.amplitudeMapsButton.enabled = True
+    parametersFormLayout.addRow(self.amplitudeMapsButton)
+
+    self.mapAmplitudesButton = qt.QPushButton("Breathing amplitudes of selected volume from maps")
+    self.mapAmplitudesButton.toolTip = "Mean amplitudes of the voxels of selected contour, read from amplitude maps without registrations."
+    self.mapAmplitudesButton.enabled = False
+    parametersFormLayout.addRow(self.mapAmplitudesButton)
     
     #
     # Calculate margins
@@ -324,8 +505,45 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
             self.table.setItem(i, j, self.item[n])
             n += 1
 
+    #
+    # Batch processing Area
+    #
+    batchCollapsibleButton = ctk.ctkCollapsibleButton()
+    batchCollapsibleButton.text = "Batch processing"
+    batchCollapsibleButton.collapsed = True
+    self.layout.addWidget(batchCollapsibleButton)
+    batchFormLayout = qt.QFormLayout(batchCollapsibleButton)
+
+    self.batchPatientsLineEdit = qt.QLineEdit()
+    self.batchPatientsLineEdit.setToolTip("Comma separated patient IDs, leave empty for all patients.")
+    batchFormLayout.addRow("Patient IDs: ", self.batchPatientsLineEdit)
+
+    self.batchContourLineEdit = qt.QLineEdit()
+    self.batchContourLineEdit.setToolTip("Name of target contour in structure sets, motion and PTV are skipped without it.")
+    batchFormLayout.addRow("Target contour: ", self.batchContourLineEdit)
+
+    self.batchTimeoutSpinBox = qt.QSpinBox()
+    self.batchTimeoutSpinBox.setToolTip("Time limit per patient, checked before each stage; running registrations are cancelled when it passes. 0 is no limit.")
+    self.batchTimeoutSpinBox.setRange(0, 48)
+    self.batchTimeoutSpinBox.setValue(0)
+    batchFormLayout.addRow("Timeout per patient [h]:", self.batchTimeoutSpinBox)
+
+    self.batchRetriesSpinBox = qt.QSpinBox()
+    self.batchRetriesSpinBox.setToolTip("How many times a failed stage is repeated.")
+    self.batchRetriesSpinBox.setRange(0, 5)
+    self.batchRetriesSpinBox.setValue(1)
+    batchFormLayout.addRow("Retries:", self.batchRetriesSpinBox)
+
+    self.runBatchButton = qt.QPushButton("Run batch")
+    self.runBatchButton.toolTip = "Registers, creates midV, finds motion and PTV for all listed patients. Continues where the last batch stopped."
+    batchFormLayout.addRow(self.runBatchButton)
+
     # connections
+    self.runBatchButton.connect('clicked(bool)', self.onRunBatchButton)
     self.findAmplitudesButton.connect('clicked(bool)', self.onFindAmplitudes)
+    self.structureMotionButton.connect('clicked(bool)', self.onStructureMotionButton)
+    self.amplitudeMapsButton.connect('clicked(bool)', self.onAmplitudeMapsButton)
+    self.mapAmplitudesButton.connect('clicked(bool)', self.onMapAmplitudesButton)
     self.loadContoursButton.connect('clicked(bool)', self.onLoadContoursButton)
     self.registerButton.connect('clicked(bool)', self.onRegisterButton)
     self.midVButton.connect('clicked(bool)', self.onMidVButton)
@@ -339,6 +557,11 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
     self.inputPlanCTSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onPlanCTChange)
     self.inputContourSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onContourChange)
     self.refPhaseSpinBox.connect("valueChanged(int)", self.onRefPhaseChange)
+    self.patientComboBox.connect('currentIndexChanged(int)', self.onPatientChange)
+    self.stopDiscoveryButton.connect('clicked(bool)', self.onStopDiscoveryButton)
+    self.volumeCacheSpinBox.connect('valueChanged(int)', self.onVolumeCacheChange)
+    self.fieldStoreComboBox.connect('currentIndexChanged(int)', self.onFieldStoreChange)
+    self.cancelRegistrationButton.connect('clicked(bool)', self.onCancelRegistrationButton)
     # self.patientComboBox.connect('currentIndexChanged(QString)', self.setSeriesComboBox)
 
     # Add vertical spacer
@@ -348,7 +571,8 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.onStopDiscoveryButton()
+    self.onCancelRegistrationButton()
 
   def onSelect(self):
     self.findAmplitudesButton.enabled = self.inputContourSelector.currentNode()
@@ -362,15 +586,13 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
       self.createPTVButton.enabled = False
       return
     self.createPTVButton.enabled = self.inputContourSelector.currentNode()
-    patientNumber = self.patientComboBox.currentIndex
-    patient = self.patientList[patientNumber]
+    patient = self.currentPatient()
     if patient is not None:
       patient.fourDCT[10].node = planningCT
 
   def onContourChange(self, targetContour):
       if targetContour is not None:
-          patientNumber = self.patientComboBox.currentIndex
-          patient = self.patientList[patientNumber]
+          patient = self.currentPatient()
           if patient is not None:
             patient.fourDCT[10].contour = targetContour
             # print patient.ID + "has now" + patient.fourDCT[10].node.GetName()
@@ -379,15 +601,13 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
       self.colorButton.enabled = True
 
   def onRefPhaseChange(self, refPhase):
-      patientNumber = self.patientComboBox.currentIndex
-      patient = self.patientList[patientNumber]
+      patient = self.currentPatient()
       if patient is not None:
           patient.refPhase = refPhase
   
   def onFindAmplitudes(self):
     logic = FindMarginsLogic()
-    patientNumber = self.patientComboBox.currentIndex
-    patient = self.patientList[patientNumber]
+    patient = self.currentPatient()
 
     if patient is None:
       self.qtMessage("Can't find patient.")
@@ -420,10 +640,61 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
       self.item[n+3].setText("")
       n += 1
 
+  def updateStructureList(self):
+    #Structure set contours in scene, all checked
+    self.structureList.clear()
+    nodes = slicer.util.getNodes('vtkMRMLContourNode*')
+    for node in sorted(nodes.values(), key = lambda node: node.GetName()):
+      if not FindMarginsLib.isStructureContour(node.GetName()):
+        continue
+      item = qt.QListWidgetItem(node.GetName())
+      item.setData(qt.Qt.UserRole, node.GetID())
+      item.setFlags(item.flags() | qt.Qt.ItemIsUserCheckable)
+      item.setCheckState(qt.Qt.Checked)
+      self.structureList.addItem(item)
+
+  def onStructureMotionButton(self):
+    logic = FindMarginsLogic()
+    patient = self.currentPatient()
+
+    if patient is None:
+      self.qtMessage("Can't find patient.")
+      return
+
+    skipPlanRegistration = False
+    if self.contourIn4D.checkState() == 2:
+      skipPlanRegistration = True
+
+    if self.structureList.count == 0:
+      self.updateStructureList()
+    contours = []
+    for row in range(self.structureList.count):
+      item = self.structureList.item(row)
+      if item.checkState() == 2:
+        contours.append(slicer.mrmlScene.GetNodeByID(item.data(qt.Qt.UserRole)))
+    contours = [contour for contour in contours if contour is not None]
+    if not contours:
+      self.qtMessage("No structure selected.")
+      return
+
+    exitString = logic.calculateStructureMotion(patient, contours, skipPlanRegistration)
+    if exitString:
+      self.qtMessage(exitString)
+      return
+    motion = patient.structureMotion
+    self.structureTable.setRowCount(len(motion.names))
+    self.structureTable.setVerticalHeaderLabels(motion.names)
+    for i in range(len(motion.names)):
+      for j in range(3):
+        self.structureTable.setItem(i, j, qt.QTableWidgetItem(str(round(motion.amplitudes[i, j], 2))))
+
 
   def onLoadContoursButton(self):
-    patientNumber = self.patientComboBox.currentIndex
-    patient = self.patientList[patientNumber]
+    patient = self.currentPatient()
+
+    if patient is None:
+      self.qtMessage("Can't find patient.")
+      return
 
     if  len(patient.structureSet.uid) == 0:
       self.qtMessage("Can't get Structure Set DICOM data for " + patient.ID)
@@ -434,30 +705,85 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
       return
 
     self.findAmplitudesButton.enabled = True
+    self.structureMotionButton.enabled = True
+    self.mapAmplitudesButton.enabled = True
+    self.updateStructureList()
     self.inputContourSelector.enabled = True
     self.itvButton.enabled = True
 
   def onRegisterButton(self):
     logic = FindMarginsLogic()
-    patientNumber = self.patientComboBox.currentIndex
-    patient = self.patientList[patientNumber]
+    patient = self.currentPatient()
 
     if patient is None:
       self.qtMessage("Can't find patient.")
       return
 
+    if self.registrationPool is not None:
+      self.qtMessage("Registration of " + self.registrationPatient.ID + " is running, wait for it or cancel it.")
+      return
+
     planToAll = False
     if self.planToAll.checkState() == 2:
       planToAll = True
-    exitString = logic.register(patient, planToAll)
-    if exitString:
+    memoryBudget = None
+    if self.memoryBudgetSpinBox.value > 0:
+      memoryBudget = self.memoryBudgetSpinBox.value * 1024**3
+    warmStart = False
+    if self.warmStartCheckBox.checkState() == 2:
+      warmStart = True
+    self.setStagePlanner(patient)
+    pool, exitString = logic.registerAsync(patient, planToAll, self.workersSpinBox.value, memoryBudget, warmStart,
+                                           self.onRegistrationProgress, self.onRegistrationFinished)
+    if pool is None:
       self.qtMessage(exitString)
       return
+    #Widget stays responsive, other patients can be prepared meanwhile
+    if pool.isRunning():
+      self.registrationPool = pool
+      self.registrationPatient = patient
+      self.cancelRegistrationButton.enabled = True
+      self.registrationStatusLabel.text = patient.ID + ": " + exitString
+
+  def onRegistrationProgress(self, pool):
+    self.registrationProgressBar.setValue(int(pool.totalProgress()))
+    self.registrationStatusLabel.text = pool.progressText()
+
+  def onRegistrationFinished(self, pool, message):
+    patient = self.registrationPatient
+    self.registrationPool = None
+    self.registrationPatient = None
+    self.cancelRegistrationButton.enabled = False
+    self.registrationProgressBar.setValue(int(pool.totalProgress()))
+    if patient is not None:
+      message = patient.ID + ": " + message
+    self.qtMessage(message)
+    if patient is not None and patient.registrationCache is not None:
+      message += "\n" + patient.registrationCache.summary()
+    self.registrationStatusLabel.text = message
+
+  def onCancelRegistrationButton(self):
+    if self.registrationPool is not None:
+      self.registrationPool.cancel()
+
+  def setStagePlanner(self, patient):
+    #Planner is kept while settings don't change, so it remembers converged iterations
+    schedule = self.stageScheduleComboBox.currentText
+    if schedule == "Fixed":
+      patient.stagePlanner = None
+      return
+    accuracy = schedule[schedule.find("(") + 1:schedule.find(")")]
+    site = self.stageSiteComboBox.currentText
+    timeBudget = None
+    if self.stageTimeBudgetSpinBox.value > 0:
+      timeBudget = self.stageTimeBudgetSpinBox.value * 60
+    planner = patient.stagePlanner
+    if planner is None or not planner.site == site or not planner.accuracy == accuracy or not planner.timeBudget == timeBudget:
+      patient.stagePlanner = FindMarginsLib.StagePlanner(site, accuracy, timeBudget)
 
   def onMidVButton(self):
     logic = FindMarginsLogic()
-    patientNumber = self.patientComboBox.currentIndex
-    patient = self.patientList[patientNumber]
+    patient = self.currentPatient()
 
     if patient is None:
       self.qtMessage("Can't find patient.")
@@ -466,14 +792,20 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
     if self.planToAll.checkState() == 2:
       exitString = logic.createMidVentilationFromPlanningCT(patient)
     else:
-      exitString = logic.createMidVentilation(patient)
+      roi = None
+      if self.cropToTargetCheckBox.checkState() == 2:
+        roi = logic.targetRegion(patient, self.targetPaddingSpinBox.value)
+        if roi is None:
+          self.qtMessage("Can't find target region. Select target contour and register planning CT first.")
+          return
+      level = [1, 2, 4][self.midVLevelComboBox.currentIndex]
+      exitString = logic.createMidVentilation(patient, slabSize = self.midVSlabSpinBox.value, roi = roi, level = level)
     if exitString:
       self.qtMessage(exitString)
       return
 
   def onExportMidVButton(self):
-    patientNumber = self.patientComboBox.currentIndex
-    patient = self.patientList[patientNumber]
+    patient = self.currentPatient()
     if patient is None:
       self.qtMessage("Can't find patient.")
       return
@@ -485,30 +817,74 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
         self.qtMessage("Can't load/make midVentilation CT.")
         return
 
-    #And export it
-    if patient.exportMidV():
-      self.qtMessage("Exported MidVentilation as DICOM to: " + patient.midVentilation.directory)
-    else:
+    #And export it, message is shown when CLI finishes
+    cliNode = patient.exportMidV(False)
+    if not cliNode:
       self.qtMessage("Can't export MidVentilation, check python console")
+      return
+    directory = patient.midVentilation.directory
+
+    def onStatusModified(caller, event):
+      if caller.GetStatus() == caller.Completed:
+        self.qtMessage("Exported MidVentilation as DICOM to: " + directory)
+      elif caller.GetStatus() in [caller.CompletedWithErrors, caller.Cancelled]:
+        self.qtMessage("Can't export MidVentilation: " + caller.GetStatusString())
+      else:
+        return
+      caller.RemoveObserver(self.exportObserver)
+    self.exportObserver = cliNode.AddObserver(slicer.vtkMRMLCommandLineModuleNode().StatusModifiedEvent, onStatusModified)
 
   def onAverageButton(self):
     logic = FindMarginsLogic()
-    patientNumber = self.patientComboBox.currentIndex
-    patient = self.patientList[patientNumber]
+    patient = self.currentPatient()
+
+    if patient is None:
+      self.qtMessage("Can't find patient.")
+      return
+
+    projections = [p for p in FindMarginsLib.PROJECTIONS if self.projectionCheckBoxes[p].checkState() == 2]
+    exitString = logic.createAverageFrom4DCT(patient, projections)
+    if exitString:
+      self.qtMessage(exitString)
+      return
+
+  def onAmplitudeMapsButton(self):
+    logic = FindMarginsLogic()
+    patient = self.currentPatient()
 
     if patient is None:
       self.qtMessage("Can't find patient.")
       return
 
-    exitString = logic.createAverageFrom4DCT(patient)
+    exitString = logic.createAmplitudeMaps(patient)
     if exitString:
       self.qtMessage(exitString)
+
+  def onMapAmplitudesButton(self):
+    logic = FindMarginsLogic()
+    patient = self.currentPatient()
+
+    if patient is None:
+      self.qtMessage("Can't find patient.")
+      return
+
+    if patient.fourDCT[10].contour is None:
+      self.qtMessage("No contour was set.")
       return
 
+    skipPlanRegistration = self.contourIn4D.checkState() == 2
+    amplitudes = logic.regionAmplitudes(patient, patient.fourDCT[10].contour, skipPlanRegistration)
+    if amplitudes is None:
+      self.qtMessage("Can't read amplitudes from maps - create them first, without 'Contour deliniated in 4D' planning CT has to be registered too.")
+      return
+    patient.amplitudes = list(amplitudes[0:3])
+    for i in range(3):
+      self.item[i].setText(str(round(patient.amplitudes[i], 2)))
+      self.item[i+3].setText("")
+
   def onRegisterMidButton(self):
     logic = FindMarginsLogic()
-    patientNumber = self.patientComboBox.currentIndex
-    patient = self.patientList[patientNumber]
+    patient = self.currentPatient()
 
     if patient is None:
       self.qtMessage("Can't find patient.")
@@ -522,8 +898,7 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
 
   def onItvButton(self):
     logic = FindMarginsLogic()
-    patientNumber = self.patientComboBox.currentIndex
-    patient = self.patientList[patientNumber]
+    patient = self.currentPatient()
 
     if patient is None:
       self.qtMessage("Can't find patient.")
@@ -543,8 +918,10 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
       return
 
   def onCalcMarginsButton(self):
-    patientNumber = self.patientComboBox.currentIndex
-    patient = self.patientList[patientNumber]
+    patient = self.currentPatient()
+    if patient is None:
+      self.qtMessage("Can't find patient.")
+      return
     #Copy values from table to patient (user can also change this values)
     for i in range(3):
       if not self.item[i].text():
@@ -565,8 +942,7 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
 
   def onCreatePTVButton(self):
     logic = FindMarginsLogic()
-    patientNumber = self.patientComboBox.currentIndex
-    patient = self.patientList[patientNumber]
+    patient = self.currentPatient()
     targetContour = self.inputContourSelector.currentNode()
 
     if patient is None:
@@ -606,76 +982,146 @@ class FindMarginsWidget(ScriptedLoadableModuleWidget):
       self.qtMessage(exitString)
       return
 
-  def getPatientList(self):
-
-    nPatient = 0
+  def onRunBatchButton(self):
+    #Batch gets only classified patients; after stopped discovery the rest is classified now
+    for index in range(len(self.patientList)):
+      self.resolvePatient(index)
+    patients = [patient for patient in self.patientList if patient is not None]
+    patientIDs = [patientID.strip() for patientID in self.batchPatientsLineEdit.text.split(',') if patientID.strip()]
+    if not patientIDs:
+      patientIDs = [patient.ID for patient in patients]
+    if not patientIDs:
+      self.qtMessage("No patients for batch.")
+      return
 
+    timeout = None
+    if self.batchTimeoutSpinBox.value > 0:
+      timeout = self.batchTimeoutSpinBox.value * 3600
+
+    journalFile = os.path.join(os.path.dirname(slicer.dicomDatabase.databaseFilename), "FindMarginsBatchJournal.json")
+    scheduler = FindMarginsLib.BatchScheduler(FindMarginsLogic(), patients, journalFile,
+                                              self.batchContourLineEdit.text.strip(), timeout, self.batchRetriesSpinBox.value)
+    scheduler.nWorkers = self.workersSpinBox.value
+    if self.memoryBudgetSpinBox.value > 0:
+      scheduler.memoryBudget = self.memoryBudgetSpinBox.value * 1024**3
+    for patient in patients:
+      self.setStagePlanner(patient)
+    scheduler.skipPlanRegistration = self.contourIn4D.checkState() == 2
+    scheduler.SSigma = self.SSigmaSpinBox.value
+    scheduler.Rsigma = self.RsigmaSpinBox.value
+    summary = scheduler.run(patientIDs)
+
+    self.qtMessage("Batch finished: " + str(len(summary['finished'])) + " patients processed, " + str(len(summary['failed'])) +
+                   " failed (" + str(round(summary['patientsPerHour'], 2)) + " patients per hour). Journal: " + journalFile)
+
+  def getPatientList(self, background = True):
+    """Fills patientComboBox from the DICOM database. In background, patients are classified
+    in a separate thread and added as they come (see onDiscoveryTimer).
+    """
+    self.onStopDiscoveryButton()
+    self.patientComboBox.clear()
     self.patientList = []
-    for patient in slicer.dicomDatabase.patients():
-      newPatient = FindMarginsLib.Patient()
-      for study in slicer.dicomDatabase.studiesForPatient(patient):
-        for series in slicer.dicomDatabase.seriesForStudy(study):
-          files = slicer.dicomDatabase.filesForSeries(series)
-          if len(files) > 0:
-            instance = slicer.dicomDatabase.instanceForFile(files[0])
-            try:
-              patientID = slicer.dicomDatabase.instanceValue(instance, self.tags['patientID'])
-            except RuntimeError:
-                # this indicates that the particular instance is no longer
-                # accessible to the dicom database, so we should ignore it here
-              continue
-            serialDescription = slicer.dicomDatabase.instanceValue(instance, self.tags['seriesDescription'])
-            studyDescription = slicer.dicomDatabase.instanceValue(instance, self.tags['studyDescription'])
-            modality = slicer.dicomDatabase.instanceValue(instance, self.tags['modality'])
-            if studyDescription.upper().find('PLAN') > -1 and studyDescription.upper().find('REPLAN') <= -1 and modality == "CT" and serialDescription.find('%') <= -1:
-              newPatient.fourDCT[10].uid = series
-              newPatient.fourDCT[10].file = files[0]
-              newPatient.fourDCT[10].name = serialDescription
-              print "CT plan for patient " + patientID + ": " + studyDescription + ", seriesID: ", series
-
-            # print "Series date: " + slicer.dicomDatabase.instanceValue(instance,self.tags['seriesDate'])
-            # if len(slicer.dicomDatabase.instanceValue(instance,self.tags['seriesDate'])) > 0:
-            #   print "Hello"
-            #   newPatient.planCT.uid = series
-            #   newPatient.planCT.file = files[0]
-
-            # print serialDescription
-            if serialDescription.find('Structure Sets') > -1:
-              newPatient.structureSet.uid = series
-
-            if serialDescription.find('%') > -1:        # phase of 4D scan
-              for i in range(0, 100, 10):
-                tmpName = str(i) + ".0%"
-                if serialDescription.find(tmpName) > -1:
-                  #Special case for 0.0%
-                  if i == 0:
-                    position = serialDescription.find(tmpName)
-                    try:
-                      int(serialDescription[position-1])
-                      continue
-                    except ValueError:
-                      if serialDescription.find(" " + tmpName) < 0 and not serialDescription == tmpName:
-                        continue
-                  # print patientID + " found " + serialDescription + " so " + files[0]
-                  newPatient.fourDCT[i/10].uid = series
-                  # print "4D phase found: ", i/10
-                  newPatient.fourDCT[i/10].file = files[0]
-                  if len(newPatient.patientDir) == 0:
-                    newPatient.patientDir = os.path.dirname(files[0])
-
-                if len(newPatient.vectorDir) == 0 and os.path.exists(files[0]):
-                    dicomDir = os.path.dirname(files[0])
-                    newPatient.vectorDir = dicomDir + "/VectorFields/"
-                    if not os.path.exists(newPatient.vectorDir):
-                        os.makedirs(newPatient.vectorDir)
-                        print "Created " + newPatient.vectorDir
-
-      newPatient.databaseNumber = nPatient
-      newPatient.ID = patientID
-      newPatient.name = slicer.dicomDatabase.instanceValue(instance, self.tags['patientName'])
-      self.patientList.append(newPatient)
-
-      nPatient += 1
+    self.patientKeys = []
+    catalog = FindMarginsLib.PatientCatalog(slicer.dicomDatabase, self.tags)
+    self.catalog = catalog
+    cacheDirectory = os.path.join(os.path.dirname(slicer.dicomDatabase.databaseFilename), "FindMarginsRegistrationCache")
+    self.registrationCache = FindMarginsLib.RegistrationCache(cacheDirectory)
+
+    if not background:
+      self.patientList = catalog.getPatients()
+      for patient in self.patientList:
+        self.setPatientCaches(patient)
+        self.patientComboBox.addItem(patient.ID)
+      self.updatePendingLabel()
+      return
+
+    self.discovery = FindMarginsLib.PatientDiscovery(catalog)
+    self.discovery.start()
+    self.stopDiscoveryButton.enabled = True
+    self.discoveryTimer.start()
+
+  def onDiscoveryTimer(self):
+    if self.discovery is None:
+      self.discoveryTimer.stop()
+      return
+
+    while not self.discovery.results.empty():
+      result = self.discovery.results.get()
+      if result[0] == 'patients':
+        self.patientList = [None] * len(result[1])
+        self.patientKeys = [patientKey for patientKey, patientID in result[1]]
+        for patientKey, patientID in result[1]:
+          self.patientComboBox.addItem(patientID + " (pending)")
+      elif result[0] == 'patient':
+        self.setPatient(result[1], result[2])
+      elif result[0] == 'fallback':
+        print "Can't classify patients in background (" + result[1] + ")"
+        self.discovery = None
+        self.discoveryTimer.stop()
+        self.getPatientList(False)
+        return
+      elif result[0] == 'done':
+        self.discovery = None
+        self.discoveryTimer.stop()
+        self.stopDiscoveryButton.enabled = False
+        break
+    self.updatePendingLabel()
+
+  def onPatientChange(self, index):
+    if index < 0 or index >= len(self.patientList):
+      return
+    if self.patientList[index] is None:
+      if self.discovery is not None:
+        self.discovery.prioritize(index)
+      else:
+        self.resolvePatient(index)
+
+  def setPatientCaches(self, patient):
+    patient.registrationCache = self.registrationCache
+    patient.volumeCache = self.volumeCache
+    patient.fieldEncoding = self.fieldEncoding()
+
+  def setPatient(self, index, patient):
+    self.setPatientCaches(patient)
+    self.patientList[index] = patient
+    self.patientComboBox.setItemText(index, patient.ID)
+
+  def resolvePatient(self, index):
+    #Patients left pending by stopped discovery are classified, when they are needed
+    if self.patientList[index] is not None or self.discovery is not None or index >= len(self.patientKeys):
+      return self.patientList[index]
+    self.setPatient(index, self.catalog.createPatient(self.patientKeys[index], index))
+    self.updatePendingLabel()
+    return self.patientList[index]
+
+  def onVolumeCacheChange(self, value):
+    #With 0 every released CT is removed right away, as without cache
+    self.volumeCache.maxBytes = value * 1024**3
+    self.volumeCache.evict()
+
+  def fieldEncoding(self):
+    if not hasattr(self, 'fieldStoreComboBox') or self.fieldStoreComboBox.currentText == "Off":
+      return None
+    return self.fieldStoreComboBox.currentText
+
+  def onFieldStoreChange(self, index):
+    for patient in self.patientList:
+      if patient is not None:
+        patient.fieldEncoding = self.fieldEncoding()
+
+  def onStopDiscoveryButton(self):
+    if self.discovery is not None:
+      self.discovery.cancel()
+
+  def updatePendingLabel(self):
+    self.pendingLabel.text = str(self.patientList.count(None))
+
+  def currentPatient(self):
+    """Returns selected patient or None, if it isn't classified yet."""
+    patientNumber = self.patientComboBox.currentIndex
+    if patientNumber < 0 or patientNumber >= len(self.patientList):
+      return None
+    return self.resolvePatient(patientNumber)
 
   def qtMessage(self, message):
     print(message)
@@ -695,7 +1141,7 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
-  def register(self, patient, planToAll = False):
+  def register(self, patient, planToAll = False, nWorkers = 1, memoryBudget = None, warmStart = False):
     refPhase = patient.refPhase
 
     self.delayDisplay("Starting registration")
@@ -708,10 +1154,8 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
 
       patient.refPhase = i
       patient.createPlanParameters()
-      if patient.getTransform(10):
+      if patient.regParameters.checkBspline():
         print "Planning transform already exist."
-        slicer.mrmlScene.RemoveNode(patient.fourDCT[10].transform)
-        patient.fourDCT[10].transform = None
       else:
         print "Registering planning CT"
         if not patient.loadDicom(10):
@@ -726,10 +1170,10 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
         patient.regParameters.movingNode = patient.fourDCT[10].node.GetID()
         patient.regParameters.referenceNode = patient.fourDCT[patient.refPhase].node.GetID()
         patient.regParameters.register()
+        patient.transformCache.invalidate(patient.regParameters.bspline_F_name)
 
         if planToAll:
-          slicer.mrmlScene.RemoveNode(patient.fourDCT[i].node)
-          patient.fourDCT[i].node = None
+          patient.releaseDicom(i)
 
     #We don't need 4D registration, when plan to all
     if planToAll:
@@ -738,17 +1182,20 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
 
     # Prepare everything for 4D registration
     patient.refPhase = refPhase
+    if nWorkers > 1 or warmStart:
+      return self.register4DParallel(patient, nWorkers, memoryBudget, warmStart)
+
     patient.create4DParameters()
 
+    #Reference phase is moving image of every registration, it stays cached
+    patient.pinDicom(refPhase)
     for i in range(0,10):
       if i == refPhase:
         continue
 
       patient.regParameters.referenceNumber = str(i) + "0"
-      if patient.getTransform(i):
+      if patient.regParameters.checkBspline():
         self.delayDisplay("Transform for phase " + str(i) + "0% already exist.")
-        slicer.mrmlScene.RemoveNode(patient.fourDCT[i].transform)
-        patient.fourDCT[i].transform = None
         continue
       else:
         self.setDisplay( "Registering phase " + str(i) + "0%.")
@@ -763,15 +1210,182 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
         patient.regParameters.movingNode = patient.fourDCT[refPhase].node.GetID()
         patient.regParameters.referenceNode = patient.fourDCT[i].node.GetID()
         patient.regParameters.register()
+        patient.transformCache.invalidate(patient.regParameters.bspline_F_name)
 
-        slicer.mrmlScene.RemoveNode(patient.fourDCT[i].node)
-        patient.fourDCT[i].node = None
+        patient.releaseDicom(i)
+        patient.releaseDicom(refPhase)
+    patient.unpinDicom(refPhase)
+    self.setDisplay()
+    return "Finished with registration."
+
+  def register4DParallel(self, patient, nWorkers, memoryBudget = None, warmStart = False):
+    """Registers reference phase to all other phases with up to nWorkers concurrent registrations.
+    With warmStart, phases are registered outward from reference phase and each one starts
+    from the B-spline of its neighbour closer to the reference phase.
+    """
+    pool, message = self.createRegistrationPool(patient, [], True, nWorkers, memoryBudget, warmStart)
+    if pool is None:
+      self.setDisplay()
+      return message
+
+    runningPhases = []
+    def progress(pool):
+      phases = [job.name for job in pool.running]
+      if phases != runningPhases:
+        runningPhases[:] = phases
+        self.setDisplay()
+        self.setDisplay("Registering phases " + ", ".join(phases) + ". " + pool.summary())
 
-        slicer.mrmlScene.RemoveNode(patient.fourDCT[refPhase].node)
-        patient.fourDCT[refPhase].node = None
+    self.setDisplay("Registering " + str(len(pool.jobs)) + " phases with " + str(pool.maxWorkers) + " workers.")
+    pool.run(progress)
     self.setDisplay()
+    return self.registrationResult(pool)
+
+  def registerAsync(self, patient, planToAll = False, nWorkers = 1, memoryBudget = None, warmStart = False, progress = None, finished = None):
+    """Same registrations as register(), but returns right after they are queued.
+    Returns (pool, message); pool is None when there's nothing to run. progress(pool) is called
+    whenever a registration changes, finished(pool, message) when all are done or cancelled.
+    """
+    if planToAll:
+      pool, message = self.createRegistrationPool(patient, range(0, 10), False, nWorkers, memoryBudget, warmStart)
+    else:
+      pool, message = self.createRegistrationPool(patient, [patient.refPhase], True, nWorkers, memoryBudget, warmStart)
+    if pool is None:
+      return None, message
+
+    def onFinished(pool):
+      message = self.registrationResult(pool)
+      if finished:
+        finished(pool, message)
+
+    pool.start(progress, onFinished)
+    return pool, "Registering " + str(len(pool.jobs)) + " CTs."
+
+  def registrationResult(self, pool):
+    print pool.summary()
+    if pool.cancelled:
+      return "Registration cancelled. " + pool.summary()
+    if len(pool.completed()) < len(pool.jobs):
+      return "Registration failed for some phases, check python console."
     return "Finished with registration."
 
+  def createRegistrationPool(self, patient, planPhases, fourD, nWorkers = 1, memoryBudget = None, warmStart = False):
+    """Queues registrations of planning CT to planPhases and, with fourD, of reference phase to all
+    other phases. Returns (pool, message), pool is None if all transforms already exist.
+    CTs are loaded when a job is launched and removed after the last job that needs them,
+    unless they were loaded before.
+    """
+    refPhase = patient.refPhase
+    pool = FindMarginsLib.RegistrationPool(nWorkers, memoryBudget)
+
+    for i in planPhases:
+      patient.refPhase = i
+      patient.createPlanParameters()
+      if patient.regParameters.checkBspline():
+        print "Planning transform to phase " + str(i) + "0% already exist."
+        continue
+      job = FindMarginsLib.RegistrationJob(i, patient.regParameters)
+      job.moving = 10
+      job.name = "planning CT to " + str(i) + "0%"
+      pool.addJob(job)
+    patient.refPhase = refPhase
+
+    order = []
+    if fourD:
+      order = [(i, None) for i in range(0, 10) if not i == refPhase]
+      if warmStart:
+        if FindMarginsLib.findPlastimatch():
+          order = FindMarginsLib.phaseOrder(refPhase)
+        else:
+          print "Can't find plastimatch executable for warm start, all phases start from identity."
+
+    jobs = {}
+    bsplineFiles = {}
+    seeds = {}
+    for i, seed in order:
+      patient.create4DParameters()
+      patient.regParameters.referenceNumber = str(i) + "0"
+      exists = patient.regParameters.checkBspline()
+      bsplineFiles[i] = patient.regParameters.bspline_F_name
+      if exists:
+        print "Transform for phase " + str(i) + "0% already exist."
+        continue
+      job = FindMarginsLib.RegistrationJob(i, patient.regParameters)
+      job.moving = refPhase
+      if seed is not None:
+        seeds[i] = seed
+        job.dependsOn = jobs.get(seed)
+      jobs[i] = job
+      pool.addJob(job)
+
+    if not pool.jobs:
+      return None, "Finished with registration."
+
+    #Number of unfinished jobs, that need CT at position
+    uses = {}
+    for job in pool.jobs:
+      for position in [job.position, job.moving]:
+        uses[position] = uses.get(position, 0) + 1
+    preloaded = [position for position in uses if patient.fourDCT[position].node is not None]
+
+    if not patient.loadDicom(refPhase):
+      return None, "Can't load reference phase"
+
+    #Reference phase stays in memory for all registrations, phases are loaded when admitted
+    numberOfVoxels = patient.fourDCT[refPhase].node.GetImageData().GetNumberOfPoints()
+    pool.reservedMemory = 2 * numberOfVoxels
+    for job in pool.jobs:
+      job.memory = pool.estimateMemory(numberOfVoxels)
+
+    thumbnails = {}
+    def startJob(job):
+      for position in [job.moving, job.position]:
+        if not patient.loadDicom(position):
+          print "Can't load position " + str(position) + "."
+          return False
+      job.regParameters.movingNode = patient.fourDCT[job.moving].node.GetID()
+      job.regParameters.referenceNode = patient.fourDCT[job.position].node.GetID()
+      if warmStart and job.moving == refPhase:
+        thumbnails[job.position] = FindMarginsLib.thumbnail(patient.fourDCT[job.position].node)
+      seed = seeds.get(job.position)
+      if seed is not None and job.moving == refPhase and os.path.exists(bsplineFiles[seed]):
+        distance = FindMarginsLib.imageDistance(thumbnails[job.position], thumbnails.get(seed))
+        FindMarginsLib.setWarmStart(job.regParameters, bsplineFiles[seed], distance)
+        print "Phase " + str(job.position) + "0% starts from phase " + str(seed) + "0%, relative difference: " + str(distance)
+      return True
+
+    def finishJob(job):
+      patient.transformCache.invalidate(job.regParameters.bspline_F_name)
+      for position in [job.position, job.moving]:
+        uses[position] -= 1
+        if uses[position] > 0 or position in preloaded:
+          continue
+        patient.releaseDicom(position)
+
+    pool.startJob = startJob
+    pool.finishJob = finishJob
+    return pool, ""
+
+  def benchmarkWarmStart(self, patient, phases = None):
+    """Compares cold and warm started registration of 4D phases, returns report.
+    Can be run from python console, e.g. for the selected patient:
+    FindMargins.FindMarginsLogic().benchmarkWarmStart(slicer.modules.FindMarginsWidget.currentPatient())
+    """
+    benchmark = FindMarginsLib.WarmStartBenchmark(patient, phases)
+    return benchmark.run()
+
+  def compareBsplineEvaluator(self, patient, position):
+    """Checks numpy B-spline evaluation against Slicer's displacement field for 4D phase position.
+    FindMargins.FindMarginsLogic().compareBsplineEvaluator(slicer.modules.FindMarginsWidget.currentPatient(), 0)
+    """
+    patient.create4DParameters()
+    patient.regParameters.referenceNumber = str(position) + "0"
+    if not patient.regParameters.checkBspline():
+      return "Can't find registration of phase " + str(position) + "0%."
+    if not patient.loadDicom(position):
+      return "Can't load phase " + str(position) + "0%."
+    return FindMarginsLib.compareWithSlicer(patient.regParameters.bspline_F_name, patient.fourDCT[position].node)
+
   def calculateMotion(self, patient, skipPlanRegistration, showContours, axisOfMotion = False, showPlot = True):
     # logging.info('Processing started')
 
@@ -790,6 +1404,8 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
       return "Can't find contour"
 
     planOrigins = self.getCenterOfMass(patient.fourDCT[10].contour)
+    if planOrigins is None:
+      return "Can't get points of contour."
     print "planorigins: ", planOrigins
     contourName = patient.fourDCT[10].contour.GetName().replace("_Contour", "")
     self.setDisplay("Calculating motion of " + contourName)
@@ -801,45 +1417,57 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
         parentNodeID = subjectHierarchyNode.GetParentNodeID()
 
     #If there's a labelmap, then contours are not propagated right.
-    #This is a workaround
-    contourLabelmap = patient.fourDCT[10].contour.GetLabelmapImageData()
+    #This is a workaround; propagated points don't need it, they may come from the labelmap
+    contourLabelmap = patient.fourDCT[10].contour.GetLabelmapImageData() if showContours else None
     if contourLabelmap:
       patient.fourDCT[10].contour.SetAndObserveLabelmapImageData(None)
     
-    if skipPlanRegistration:
-        contour = patient.fourDCT[10].contour
+    if not showContours:
+      #Contours aren't shown, so only their points are propagated and no nodes are created
+      exitString = self.propagateMotionPoints(patient, skipPlanRegistration, origins)
+      if exitString:
+        self.setDisplay()
+        return exitString
+      #Plan origin from the same points as phase origins
+      planOrigins = patient.fourDCT[10].origin
+      relOrigins[:, refPhase] += origins[:, refPhase] - planOrigins
     else:
-        #Propagate contour
-        contour = self.propagateContour(patient, 10, showContours, None, parentNodeID)
-        if contour is None:
-          self.setDisplay()
-          return "Can't propagate contour to reference phase."
+      if skipPlanRegistration:
+          contour = patient.fourDCT[10].contour
+      else:
+          #Propagate contour
+          contour = self.propagateContour(patient, 10, showContours, None, parentNodeID)
+          if contour is None:
+            self.setDisplay()
+            return "Can't propagate contour to reference phase."
 
-    patient.fourDCT[refPhase].contour = contour
-    origins[:, refPhase] = self.getCenterOfMass(contour)
-    print "reference origins: ", origins[:, refPhase]
-    relOrigins[:, refPhase] = [0, 0, 0]
-    relOrigins[:, refPhase] += origins[:, refPhase] - planOrigins
+      patient.fourDCT[refPhase].contour = contour
+      origin = self.getCenterOfMass(contour)
+      if origin is None:
+        self.setDisplay()
+        return "Contour in reference phase has no points."
+      origins[:, refPhase] = origin
+      print "reference origins: ", origins[:, refPhase]
+      relOrigins[:, refPhase] = [0, 0, 0]
+      relOrigins[:, refPhase] += origins[:, refPhase] - planOrigins
 
-    # Propagation in 4D
-    patient.create4DParameters()
-    for i in range(0, 10):
-      if i == refPhase:
-        continue
+      # Propagation in 4D
+      patient.create4DParameters()
+      for i in range(0, 10):
+        if i == refPhase:
+          continue
 
-      #Create & propagate contour
-      contour = self.propagateContour(patient, i, showContours, None, parentNodeID)
-      if contour is None:
-        print "Can't propagate contour for phase " + str(i) + "0 %"
-        continue
-      patient.fourDCT[i].contour = contour
-      origins[:, i] = self.getCenterOfMass(contour)
-      if not showContours:
-          slicer.mrmlScene.RemoveNode(contour)
-          patient.fourDCT[i].contour = None
-    if not showContours and not skipPlanRegistration:
-        slicer.mrmlScene.RemoveNode(patient.fourDCT[refPhase].contour)
-        patient.fourDCT[refPhase].contour = None
+        #Create & propagate contour
+        contour = self.propagateContour(patient, i, showContours, None, parentNodeID)
+        if contour is None:
+          print "Can't propagate contour for phase " + str(i) + "0 %"
+          continue
+        patient.fourDCT[i].contour = contour
+        origin = self.getCenterOfMass(contour)
+        if origin is None:
+          print "Propagated contour for phase " + str(i) + "0 % has no points"
+          continue
+        origins[:, i] = origin
 
     # Find axis of motion
     if axisOfMotion:
@@ -891,28 +1519,31 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
     self.delayDisplay("Finished with calculating motion.")
     return 
 
-  def createMidVentilation(self, patient):
+  def createMidVentilation(self, patient, cubic = False, slabSize = 0, roi = None, level = 1):
+    #With roi (RegionOfInterest, see targetRegion) only the box around the target is
+    #computed and pasted into the reference phase, the rest of midV is reference phase.
+    #level 2 or 4 creates a quick preview on coarser grid from field pyramid, it isn't saved.
 
-    transformLogic = slicer.modules.transforms.logic()
-    mathMultiply = vtk.vtkImageMathematics()
-    mathAddVector = vtk.vtkImageMathematics()
-    mathAddCT = vtk.vtkImageMathematics()
+    if slabSize > 0:
+      if roi is not None or level > 1:
+        print "Region of interest and preview levels aren't used for midV in slabs."
+      return self.createMidVentilationSlabs(patient, slabSize, cubic)
 
-    vectorImageData = vtk.vtkImageData()
+    accumulator = FindMarginsLib.FieldAccumulator(0.1)
     ctImageData = vtk.vtkImageData()
 
-    gridAverageTransform = slicer.vtkOrientedGridTransform()
-
     refPhase = patient.refPhase
 
     #Check if midVentilation is already on disk
-    if patient.loadMidV(refPhase):
+    if level == 1 and patient.loadMidV(refPhase):
       return "Loaded mid Ventilation."
 
     patient.create4DParameters()
     self.delayDisplay("Starting calculation of mid Ventilation")
 
     firstRun = True
+    #midV transform depends on registrations of all phases
+    transformFiles = []
     # vector = slicer.vtkMRMLVectorVolumeNode()
     # slicer.mrmlScene.AddNode(vector)
     for i in range(0, 10):
@@ -921,68 +1552,91 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
             continue
 
         patient.regParameters.referenceNumber = str(i) + "0"
+        patient.regParameters.checkBspline()
+        transformFiles.append(patient.regParameters.bspline_F_name)
         self.setDisplay("Getting vector field for phase" + str(i) + "0 %")
-        if not patient.getVectorField(i):
+        if not patient.getVectorField(i, roi = roi, level = level):
           self.setDisplay()
           return "Can't get vector field for phase " + str(i) + "0 %"
 
-        mathMultiply.RemoveAllInputs()
-        mathAddVector.RemoveAllInputs()
-
-        mathMultiply.SetOperationToMultiplyByK()
-        mathMultiply.SetConstantK(0.1)
-
         vectorField = patient.fourDCT[i].vectorField
-        mathMultiply.SetInput1Data(vectorField.GetImageData())
-        mathMultiply.Modified()
-        mathMultiply.Update()
+        #Phases are summed in place, 0.1 is applied once at the end
+        if not accumulator.add(vectorField.GetImageData()):
+          self.setDisplay()
+          return "Vector field for phase " + str(i) + "0 % doesn't match other phases."
 
         if firstRun:
-            vectorImageData.DeepCopy(mathMultiply.GetOutput())
-
-            matrix = vtk.vtkMatrix4x4()
-            vectorField.GetIJKToRASDirectionMatrix(matrix)
-            gridAverageTransform.SetGridDirectionMatrix(matrix)
-
-            # vector.SetOrigin(vectorField.GetOrigin())
-            # vector.SetSpacing(vectorField.GetSpacing())
-            # vector.SetIJKToRASDirectionMatrix(matrix)
-
+            vectorIJKToRAS = FindMarginsLib.volumeGeometry(vectorField)[1]
             firstRun = False
-        else:
-            mathAddVector.SetOperationToAdd()
-            mathAddVector.SetInput1Data( mathMultiply.GetOutput())
-            mathAddVector.SetInput2Data( vectorImageData)
-            mathAddVector.Modified()
-            mathAddVector.Update()
-            vectorImageData.DeepCopy(mathAddVector.GetOutput())
-
-        vectorImageData.SetSpacing(vectorField.GetSpacing())
-        vectorImageData.SetOrigin(vectorField.GetOrigin())
+
         slicer.mrmlScene.RemoveNode(vectorField)
         patient.fourDCT[i].vectorField = None
 
-    # print vector.GetID()
-    #
-    # vector.SetAndObserveImageData(vectorImageData)
-    gridAverageTransform.SetDisplacementGridData(vectorImageData)
-    gridAverageTransform.SetInterpolationModeToCubic()
-    gridAverageTransform.Inverse()
-    gridAverageTransform.Update()
-    transformNode = slicer.vtkMRMLGridTransformNode()
-    storageNode = slicer.vtkMRMLTransformStorageNode()
-    slicer.mrmlScene.AddNode(storageNode)
-    transformNode.SetAndObserveStorageNodeID(storageNode.GetID())
-    transformNode.SetName('MidV_ref' + str(refPhase))
-    slicer.mrmlScene.AddNode(transformNode)
-    transformNode.SetAndObserveTransformFromParent(gridAverageTransform)
-    # return
+    vectorImageData = accumulator.finish()
+    print accumulator.report()
 
     midVCT = slicer.vtkMRMLScalarVolumeNode()
     slicer.mrmlScene.AddNode(midVCT)
     midVCT.SetName(patient.ID + "_midV_ref"+str(refPhase))
 
-    firstRun = True
+    #All phases are warped onto grid of reference phase, which is also grid of midV
+    if not patient.loadDicom(refPhase):
+      self.setDisplay()
+      return "Can't get CT for phase " + str(refPhase) + "0 %"
+    refNode = patient.fourDCT[refPhase].node
+    dimensions, ijkToRAS = FindMarginsLib.volumeGeometry(refNode)
+    if level == 1:
+      ctImageData.DeepCopy(refNode.GetImageData())
+    else:
+      #Preview is on coarse grid, voxels outside of target region are taken from reference phase
+      dimensions, ijkToRAS = FindMarginsLib.levelGrid(dimensions, ijkToRAS, level)
+      ctImageData.SetDimensions(dimensions)
+      ctImageData.AllocateScalars(refNode.GetImageData().GetScalarType(), 1)
+      FindMarginsLib.imageDataArray(ctImageData)[:] = slicer.util.array(refNode.GetID())[::level, ::level, ::level]
+      midVCT.SetName(midVCT.GetName() + "_preview" + str(level) + "x")
+    midVCT.SetSpacing([spacing * level for spacing in refNode.GetSpacing()])
+    midVCT.SetOrigin(refNode.GetOrigin())
+    matrix = vtk.vtkMatrix4x4()
+    refNode.GetIJKToRASDirectionMatrix(matrix)
+    midVCT.SetIJKToRASDirectionMatrix(matrix)
+    cropStart = [0, 0, 0]
+    nameSuffix = ""
+    if roi is not None:
+      subGrid = roi.subGrid(dimensions, ijkToRAS)
+      if subGrid is None:
+        slicer.mrmlScene.RemoveNode(midVCT)
+        patient.releaseDicom(refPhase)
+        self.setDisplay()
+        return "Target region is outside of reference phase."
+      print "Target region: " + str(round(100 * roi.fraction(dimensions, ijkToRAS), 1)) + " % of voxels"
+      cropStart, dimensions, ijkToRAS = subGrid
+      #Fields of different regions are stored apart, crop start is in their names
+      nameSuffix = "_roi_" + "_".join([str(int(index)) for index in cropStart])
+      midVCT.SetName(midVCT.GetName() + "_roi")
+
+    #Reference to midV position is the inverse of mean field, it is inverted once and stored
+    fieldStore = patient.getFieldStore() if level == 1 else None
+    midVName = patient.midVFieldName(refPhase) + nameSuffix
+    storedField = None
+    if fieldStore is not None:
+      storedField = fieldStore.open(midVName, transformFiles)
+    if storedField is not None and storedField.matches(dimensions, ijkToRAS):
+      midVDisplacement = storedField.array()
+      storedField.close()
+    else:
+      self.setDisplay("Inverting mean vector field.")
+      inverter = FindMarginsLib.FieldInverter()
+      midVDisplacement = inverter.invert(FindMarginsLib.imageDataArray(vectorImageData), vectorIJKToRAS, dimensions, ijkToRAS)
+      print inverter.report()
+      if fieldStore is not None:
+        fieldStore.save(midVName, midVDisplacement, ijkToRAS, transformFiles)
+
+    #Buffers are reused for all phases
+    composed = np.empty(midVDisplacement.shape, dtype=np.float32)
+    warpedMidV = np.empty(midVDisplacement.shape[0:3], dtype=np.float32)
+    midVSum = np.zeros(midVDisplacement.shape[0:3], dtype=np.float32)
+    order = 3 if cubic else 1
+
     for i in range(0, 10):
         self.setDisplay("Propagating phase " + str(i) + "0 % to midV position.")
         patient.regParameters.referenceNumber = str(i) + "0"
@@ -992,87 +1646,213 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
           return "Can't get CT for phase " + str(i) + "0 %"
 
         ctNode = patient.fourDCT[i].node
+        ctDimensions, ctIJKToRAS = FindMarginsLib.volumeGeometry(ctNode)
+        field = midVDisplacement
 
         if not i == refPhase:
-            if not patient.getTransform(i):
-              self.setDisplay()
-              return "Can't get transform for phase " + str(i) + "0 %"
-
-            patient.fourDCT[i].transform.Inverse()
-            ctNode.SetAndObserveTransformNodeID(patient.fourDCT[i].transform.GetID())
-            if not transformLogic.hardenTransform(ctNode):
-              self.setDisplay()
-              return "Can't harden transform for phase " + str(i) + "0 %"
-
-            slicer.mrmlScene.RemoveNode(patient.fourDCT[i].transform)
-            patient.fourDCT[i].transform = None
-
-        # ctNode.ApplyTransform(gridAverageTransform)
-        ctNode.SetAndObserveTransformNodeID(transformNode.GetID())
-        if not transformLogic.hardenTransform(ctNode):
-          self.setDisplay()
-          return "Can't harden transform for phase " + str(i) + "0 %"
-
-        mathMultiply.RemoveAllInputs()
-        mathAddCT.RemoveAllInputs()
-
-        mathMultiply.SetOperationToMultiplyByK()
-        mathMultiply.SetConstantK(0.1)
-
-        mathMultiply.SetInput1Data(ctNode.GetImageData())
-
-        mathMultiply.Modified()
-        mathMultiply.Update()
-
-        if firstRun:
-          ctImageData.DeepCopy(mathMultiply.GetOutput())
-          midVCT.SetSpacing(ctNode.GetSpacing())
-          midVCT.SetOrigin(ctNode.GetOrigin())
-
-          matrix = vtk.vtkMatrix4x4()
-          ctNode.GetIJKToRASDirectionMatrix(matrix)
-          midVCT.SetIJKToRASDirectionMatrix(matrix)
-          firstRun = False
-        else:
-          mathAddCT.SetOperationToAdd()
-          mathAddCT.SetInput1Data( mathMultiply.GetOutput())
-          mathAddCT.SetInput2Data( ctImageData)
-          mathAddCT.Modified()
-          mathAddCT.Update()
-          ctImageData.DeepCopy(mathAddCT.GetOutput())
-
-        slicer.mrmlScene.RemoveNode(ctNode)
-        patient.fourDCT[i].node = None
-
+            #Phase to reference and reference to midV are fused into one field, so CT is interpolated once
+            fieldName = patient.midVFieldName(i) + nameSuffix
+            storedField = None
+            if fieldStore is not None:
+              storedField = fieldStore.open(fieldName, transformFiles)
+            if storedField is not None and storedField.matches(dimensions, ijkToRAS):
+              storedField.array(composed)
+              storedField.close()
+            else:
+              bspline = patient.getBspline()
+              if bspline is None:
+                self.setDisplay()
+                return "Can't get transform for phase " + str(i) + "0 %"
+
+              #Same as hardening inverted registration: sample phase at ToParent of the transform
+              phaseField = bspline.gridDisplacement(dimensions, ijkToRAS, True)
+              self.setDisplay("Phase " + str(i) + "0 %: B-spline inverse, maximal residual " + str(round(bspline.maxResidual, 4)) + " mm")
+              FindMarginsLib.composeFields(midVDisplacement, ijkToRAS, phaseField, ijkToRAS, composed)
+              del phaseField
+              if fieldStore is not None:
+                fieldStore.save(fieldName, composed, ijkToRAS, transformFiles)
+            field = composed
+
+        FindMarginsLib.warpVolume(slicer.util.array(ctNode.GetID()), ctIJKToRAS, field, ijkToRAS, warpedMidV, order)
+        midVSum += warpedMidV
+
+        #CT itself wasn't changed, so it can stay in cache
+        patient.releaseDicom(i)
+
+    midVSum *= 0.1
+    midVArray = FindMarginsLib.imageDataArray(ctImageData)
+    midVArray[cropStart[2]:cropStart[2] + dimensions[2], cropStart[1]:cropStart[1] + dimensions[1], cropStart[0]:cropStart[0] + dimensions[0]] = np.round(midVSum)
+    del midVSum, composed, warpedMidV
+    ctImageData.Modified()
 
     midVCT.SetAndObserveImageData(ctImageData)
-    patient.midVentilation.node = midVCT
+    if level > 1:
+      self.setDisplay()
+      return "Created mid Ventilation preview " + midVCT.GetName() + "."
+    #midV of target region is saved apart and isn't taken as midV of patient
+    if roi is None:
+      patient.midVentilation.node = midVCT
 
     #Save midVCT
 
-    slicer.util.saveNode(midVCT, patient.patientDir + "/" + midVCT.GetName() + ".nrrd")
+    suffix = "_roi" if roi is not None else ""
+    slicer.util.saveNode(midVCT, patient.midVFileName(refPhase, suffix))
+    patient.saveMidVManifest(refPhase, ("cubic" if cubic else "linear") + (", target region" if roi is not None else ""),
+                             suffix, roi.record() if roi is not None else None)
 
-    #Save transformation as vector field (it crashes when saving as transform)
-    transformLogic = slicer.modules.transforms.logic()
-    if not patient.loadDicom(refPhase):
-      self.setDisplay()
-      return "Can't get CT for phase " + str(i) + "0 %"
-    vf = transformLogic.CreateDisplacementVolumeFromTransform(transformNode, patient.fourDCT[refPhase].node, False)
-    slicer.mrmlScene.RemoveNode(patient.fourDCT[refPhase].node)
-    patient.fourDCT[refPhase].node = None
+    #Save reference to midV displacement from FieldInverter as vector field, on the grid it was used on
+    vf = FindMarginsLib.vectorVolumeFromArray(midVDisplacement, ijkToRAS, patient.ID + "_MidV_ref" + str(refPhase) + "_vf" + nameSuffix)
+    del midVDisplacement
     slicer.util.saveNode(vf,patient.vectorDir + "/" + vf.GetName() + ".nrrd")
     slicer.mrmlScene.RemoveNode(vf)
     self.setDisplay()
     return "Created mid Ventilation."
 
-  def createMidVentilationFromPlanningCT(self, patient):
+  def createMidVentilationSlabs(self, patient, slabSize = 32, cubic = False):
+    #Same midV as createMidVentilation, but only slabs of slabSize slices are kept in memory.
+    #Fields are evaluated from B-splines per slab, sums are memory mapped files and
+    #midV is written slab by slab into the NRRD, so memory doesn't grow with number of slices.
+    #Phase CTs are written to raw NRRD files first, warping reads the slices each slab needs from them.
 
-    mathMultiply = vtk.vtkImageMathematics()
-    mathAddVector = vtk.vtkImageMathematics()
+    refPhase = patient.refPhase
 
-    vectorImageData = vtk.vtkImageData()
+    #Check if midVentilation is already on disk
+    if patient.loadMidV(refPhase):
+      return "Loaded mid Ventilation."
 
-    gridAverageTransform = slicer.vtkOrientedGridTransform()
+    patient.create4DParameters()
+    self.delayDisplay("Starting calculation of mid Ventilation in slabs of " + str(slabSize) + " slices")
+
+    #B-splines are small, all phases are kept
+    bsplines = {}
+    transformFiles = []
+    for i in range(0, 10):
+        if i == refPhase:
+            continue
+        patient.regParameters.referenceNumber = str(i) + "0"
+        bsplines[i] = patient.getBspline()
+        if bsplines[i] is None:
+          self.setDisplay()
+          return "Can't get transform for phase " + str(i) + "0 %"
+        transformFiles.append(patient.regParameters.bspline_F_name)
+
+    workDirectory = tempfile.mkdtemp(prefix="midV_", dir=patient.patientDir)
+    try:
+      #Only one CT is in the scene at a time, while it's written
+      ctFiles = {}
+      for i in range(0, 10):
+          self.setDisplay("Writing phase " + str(i) + "0 % to disk.")
+          ctFiles[i] = os.path.join(workDirectory, "phase" + str(i) + ".nrrd")
+          if not self.writePhaseNrrd(patient, i, ctFiles[i]):
+            self.setDisplay()
+            return "Can't get CT for phase " + str(i) + "0 %"
+      refArray, dimensions, ijkToRAS = FindMarginsLib.readNrrdArray(ctFiles[refPhase])
+      scalarType = refArray.dtype
+      del refArray
+
+      shape = (dimensions[2], dimensions[1], dimensions[0])
+      slabs = [(zStart, min(zStart + slabSize, shape[0])) for zStart in range(0, shape[0], slabSize)]
+      meanField = np.lib.format.open_memmap(os.path.join(workDirectory, "mean.npy"), mode='w+', dtype=np.float32, shape=shape + (3,))
+      midVField = np.lib.format.open_memmap(os.path.join(workDirectory, "midV.npy"), mode='w+', dtype=np.float32, shape=shape + (3,))
+      midVSum = np.lib.format.open_memmap(os.path.join(workDirectory, "sum.npy"), mode='w+', dtype=np.float32, shape=shape)
+
+      #Mean of phase to reference fields
+      maxDisplacement = 0.
+      maxResidual = 0.
+      for zStart, zEnd in slabs:
+          self.setDisplay("Averaging vector fields, slices " + str(zStart) + " to " + str(zEnd) + ".")
+          slabDimensions = [dimensions[0], dimensions[1], zEnd - zStart]
+          slabMatrix = FindMarginsLib.slabIJKToRAS(ijkToRAS, zStart)
+          mean = np.zeros((zEnd - zStart,) + shape[1:3] + (3,), dtype=np.float32)
+          for i in bsplines:
+              mean += bsplines[i].gridDisplacement(slabDimensions, slabMatrix, True)
+              maxResidual = max(maxResidual, bsplines[i].maxResidual)
+          mean *= 0.1
+          meanField[zStart:zEnd] = mean
+          maxDisplacement = max(maxDisplacement, float(np.abs(mean).max()))
+      self.setDisplay("B-spline inverses: maximal residual " + str(round(maxResidual, 4)) + " mm")
+
+      #Inverse of mean field; slab is inverted with halo of slices, the mean field can reach from there
+      sliceThickness = np.sqrt(np.sum(np.asarray(ijkToRAS)[0:3, 2]**2))
+      halo = int(np.ceil(np.sqrt(3) * maxDisplacement / sliceThickness)) + 2
+      inverter = FindMarginsLib.FieldInverter()
+      for zStart, zEnd in slabs:
+          self.setDisplay("Inverting mean vector field, slices " + str(zStart) + " to " + str(zEnd) + ".")
+          haloStart, haloEnd = max(0, zStart - halo), min(shape[0], zEnd + halo)
+          midVField[zStart:zEnd] = inverter.invert(np.array(meanField[haloStart:haloEnd]), FindMarginsLib.slabIJKToRAS(ijkToRAS, haloStart),
+                                                   [dimensions[0], dimensions[1], zEnd - zStart], FindMarginsLib.slabIJKToRAS(ijkToRAS, zStart))
+      print inverter.report()
+      fieldStore = patient.getFieldStore()
+      if fieldStore is not None:
+        fieldStore.save(patient.midVFieldName(refPhase), midVField, ijkToRAS, transformFiles)
+      del meanField
+
+      #Each phase CT is warped slab by slab through composed field, reading only the slices
+      #the slab reaches (with halo of interpolation kernel) from its memory mapped NRRD
+      order = 3 if cubic else 1
+      for i in range(0, 10):
+          self.setDisplay("Propagating phase " + str(i) + "0 % to midV position.")
+          ctArray, ctDimensions, ctIJKToRAS = FindMarginsLib.readNrrdArray(ctFiles[i])
+          for zStart, zEnd in slabs:
+              slabDimensions = [dimensions[0], dimensions[1], zEnd - zStart]
+              slabMatrix = FindMarginsLib.slabIJKToRAS(ijkToRAS, zStart)
+              field = np.array(midVField[zStart:zEnd])
+              if not i == refPhase:
+                  #Phase field is evaluated exactly at midV points, no resampling of fields
+                  points = FindMarginsLib.gridIndices(slabDimensions, 0, slabDimensions[2])
+                  points = np.dot(points, slabMatrix[0:3, 0:3].T) + slabMatrix[0:3, 3] + field.reshape(-1, 3)
+                  phaseField = bsplines[i].inverseDisplacement(points)[0]
+                  field += phaseField.reshape(field.shape).astype(np.float32)
+              midVSum[zStart:zEnd] += FindMarginsLib.warpSlab(ctArray, ctIJKToRAS, field, slabMatrix, None, order)
+          del ctArray
+      del midVField
+
+      #midV goes straight from the sum to NRRD file
+      self.setDisplay("Writing mid Ventilation.")
+      fileName = patient.patientDir + "/" + patient.ID + "_midV_ref" + str(refPhase) + ".nrrd"
+      writer = FindMarginsLib.NrrdWriter(fileName, dimensions, ijkToRAS, scalarType)
+      if not writer.open():
+        self.setDisplay()
+        return "Can't write " + fileName
+      for zStart, zEnd in slabs:
+          writer.writeSlab(midVSum[zStart:zEnd] * 0.1)
+      del midVSum
+      if not writer.close():
+        self.setDisplay()
+        return "Can't write " + fileName
+      patient.saveMidVManifest(refPhase, ("cubic" if cubic else "linear") + ", slabs of " + str(slabSize))
+    finally:
+      shutil.rmtree(workDirectory, True)
+
+    peak = FindMarginsLib.peakMemory()
+    if peak is not None:
+      print "Peak memory of Slicer " + str(round(peak / 1024.**2, 1)) + " MB"
+    self.setDisplay()
+    if not patient.loadMidV(refPhase):
+      return "Can't load mid Ventilation from " + fileName
+    return "Created mid Ventilation."
+
+  def writePhaseNrrd(self, patient, position, fileName):
+    #CT of position as raw NRRD, which can be memory mapped; CT is released afterwards unless it was loaded before
+    loaded = patient.fourDCT[position].node is not None
+    if not patient.loadDicom(position):
+      return False
+    node = patient.fourDCT[position].node
+    dimensions, ijkToRAS = FindMarginsLib.volumeGeometry(node)
+    array = slicer.util.array(node.GetID())
+    writer = FindMarginsLib.NrrdWriter(fileName, dimensions, ijkToRAS, array.dtype)
+    success = writer.open()
+    if success:
+      writer.writeSlab(array)
+      success = writer.close()
+    del array
+    if not loaded:
+      patient.releaseDicom(position)
+    return success and FindMarginsLib.readNrrdArray(fileName) is not None
+
+  def createMidVentilationFromPlanningCT(self, patient):
+
+    accumulator = FindMarginsLib.FieldAccumulator(0.1)
 
     #Check if midVentilation is already on disk
     if patient.loadMidV(10):
@@ -1091,64 +1871,48 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
           return "Can't get vector field for phase " + str(i) + "0 %"
           self.setDisplay()
 
-        mathMultiply.RemoveAllInputs()
-        mathAddVector.RemoveAllInputs()
-
-        mathMultiply.SetOperationToMultiplyByK()
-        mathMultiply.SetConstantK(0.1)
-
         vectorField = patient.fourDCT[i].vectorField
-        mathMultiply.SetInput1Data(vectorField.GetImageData())
-        mathMultiply.Modified()
-        mathMultiply.Update()
+        if not accumulator.add(vectorField.GetImageData()):
+          self.setDisplay()
+          return "Vector field for phase " + str(i) + "0 % doesn't match other phases."
 
         if firstRun:
-            vectorImageData.DeepCopy(mathMultiply.GetOutput())
-            matrix = vtk.vtkMatrix4x4()
-            vectorField.GetIJKToRASDirectionMatrix(matrix)
-            gridAverageTransform.SetGridDirectionMatrix(matrix)
+            vectorIJKToRAS = FindMarginsLib.volumeGeometry(vectorField)[1]
             firstRun = False
-        else:
-            mathAddVector.SetOperationToAdd()
-            mathAddVector.SetInput1Data(mathMultiply.GetOutput())
-            mathAddVector.SetInput2Data(vectorImageData)
-            mathAddVector.Modified()
-            mathAddVector.Update()
-            vectorImageData.DeepCopy(mathAddVector.GetOutput())
-
-        vectorImageData.SetSpacing(vectorField.GetSpacing())
-        vectorImageData.SetOrigin(vectorField.GetOrigin())
+
         slicer.mrmlScene.RemoveNode(vectorField)
         patient.fourDCT[i].vectorField = None
 
-    # print vector.GetID()
-    #
-    # vector.SetAndObserveImageData(vectorImageData)
-    gridAverageTransform.SetDisplacementGridData(vectorImageData)
-    gridAverageTransform.SetInterpolationModeToCubic()
-    gridAverageTransform.Inverse()
-    gridAverageTransform.Update()
-    transformNode = slicer.vtkMRMLGridTransformNode()
-    slicer.mrmlScene.AddNode(transformNode)
-    transformNode.SetAndObserveTransformFromParent(gridAverageTransform)
+    vectorImageData = accumulator.finish()
+    print accumulator.report()
 
     # Load planning CT
     self.setDisplay("Propagating planning CT to MidV phase.")
     if not patient.loadDicom(10):
       self.setDisplay()
       return "Can't find planning CT."
-    #Save transformation as vector field (it crashes when saving as transform)
-    transformLogic = slicer.modules.transforms.logic()
-    vf = transformLogic.CreateDisplacementVolumeFromTransform(transformNode, patient.fourDCT[10].node, False)
-    slicer.util.saveNode(vf, patient.vectorDir + "/" + vf.GetName() + ".nrrd")
-    slicer.mrmlScene.RemoveNode(vf)
 
     midVCT = slicer.vtkMRMLScalarVolumeNode()
     midVCT.Copy(patient.fourDCT[10].node)
     slicer.mrmlScene.AddNode(midVCT)
     midVCT.SetName(patient.ID + "_midV_ref10")
-    midVCT.SetAndObserveTransformNodeID(transformNode.GetID())
-    transformLogic.hardenTransform(midVCT)
+
+    #Planning CT is warped through inverse of mean field, inverted once on its grid
+    planNode = patient.fourDCT[10].node
+    dimensions, ijkToRAS = FindMarginsLib.volumeGeometry(planNode)
+    inverter = FindMarginsLib.FieldInverter()
+    midVDisplacement = inverter.invert(FindMarginsLib.imageDataArray(vectorImageData), vectorIJKToRAS, dimensions, ijkToRAS)
+    print inverter.report()
+    #Inverse is saved as vector field, the same one that warps the planning CT
+    vf = FindMarginsLib.vectorVolumeFromArray(midVDisplacement, ijkToRAS, patient.ID + "_MidV_ref10_vf")
+    slicer.util.saveNode(vf, patient.vectorDir + "/" + vf.GetName() + ".nrrd")
+    slicer.mrmlScene.RemoveNode(vf)
+    warped = FindMarginsLib.warpVolume(slicer.util.array(planNode.GetID()), ijkToRAS, midVDisplacement, ijkToRAS)
+    ctImageData = vtk.vtkImageData()
+    ctImageData.DeepCopy(planNode.GetImageData())
+    FindMarginsLib.imageDataArray(ctImageData)[:] = np.round(warped)
+    del warped, midVDisplacement
+    midVCT.SetAndObserveImageData(ctImageData)
     self.setDisplay()
     return "Created midVentilation from planning CT."
 
@@ -1159,7 +1923,7 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
     patient.createPlanParameters()
     patient.regParameters.referenceNumber = "MidV_ref" + str(patient.refPhase)
 
-    if patient.getTransform(11):
+    if patient.regParameters.checkBspline():
       return
 
     if not patient.loadDicom(10):
@@ -1171,16 +1935,14 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
     patient.regParameters.register()
     self.setDisplay()
 
-  def createAverageFrom4DCT(self,patient):
-    mathMultiply = vtk.vtkImageMathematics()
-    mathAddCT = vtk.vtkImageMathematics()
-    ctImageData = vtk.vtkImageData()
+  def createAverageFrom4DCT(self, patient, projections = None):
+    #All selected projections (mean, mip, minip, median, std) are computed while each phase is loaded once
+    reducer = FindMarginsLib.ProjectionReducer(projections)
+    if not reducer.projections:
+      return "No projection selected."
 
     self.delayDisplay("Starting process")
-    midVCT = slicer.vtkMRMLScalarVolumeNode()
-    slicer.mrmlScene.AddNode(midVCT)
-    midVCT.SetName(patient.ID + "average4DCT")
-    firstRun = True
+    imageData = None
     for i in range(0, 10):
         if not patient.loadDicom(i):
           self.setDisplay()
@@ -1188,36 +1950,144 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
 
         self.setDisplay("Getting data from phase " + str(i) + "0 %")
         ctNode = patient.fourDCT[i].node
-        mathMultiply.RemoveAllInputs()
-        mathAddCT.RemoveAllInputs()
-        mathMultiply.SetOperationToMultiplyByK()
-        mathMultiply.SetConstantK(0.1)
-        mathMultiply.SetInput1Data(ctNode.GetImageData())
-        mathMultiply.Modified()
-        mathMultiply.Update()
-
-        if firstRun:
-          ctImageData.DeepCopy(mathMultiply.GetOutput())
-          midVCT.SetSpacing(ctNode.GetSpacing())
-          midVCT.SetOrigin(ctNode.GetOrigin())
-
+        if not reducer.add(slicer.util.array(ctNode.GetID())):
+          self.setDisplay()
+          return "Phase " + str(i) + "0 % doesn't match other phases."
+
+        if imageData is None:
+          #Geometry and scalar type of projections are taken from the first phase
+          imageData = vtk.vtkImageData()
+          imageData.DeepCopy(ctNode.GetImageData())
+          spacing = ctNode.GetSpacing()
+          origin = ctNode.GetOrigin()
           matrix = vtk.vtkMatrix4x4()
           ctNode.GetIJKToRASDirectionMatrix(matrix)
-          midVCT.SetIJKToRASDirectionMatrix(matrix)
-          firstRun = False
+
+        patient.releaseDicom(i)
+
+    self.setDisplay("Creating projections.")
+    names = []
+    for projection, values in reducer.finish().items():
+        projectionImageData = vtk.vtkImageData()
+        if projection == 'std':
+          projectionImageData.SetDimensions(imageData.GetDimensions())
+          projectionImageData.AllocateScalars(vtk.VTK_FLOAT, 1)
         else:
-          mathAddCT.SetOperationToAdd()
-          mathAddCT.SetInput1Data(mathMultiply.GetOutput())
-          mathAddCT.SetInput2Data(ctImageData)
-          mathAddCT.Modified()
-          mathAddCT.Update()
-          ctImageData.DeepCopy(mathAddCT.GetOutput())
-
-        slicer.mrmlScene.RemoveNode(ctNode)
-        patient.fourDCT[i].node = None
-    midVCT.SetAndObserveImageData(ctImageData)
+          projectionImageData.DeepCopy(imageData)
+        projectionArray = FindMarginsLib.imageDataArray(projectionImageData)
+        if np.issubdtype(projectionArray.dtype, np.integer):
+          values = np.round(values)
+        projectionArray[:] = values
+        projectionImageData.Modified()
+
+        node = slicer.vtkMRMLScalarVolumeNode()
+        slicer.mrmlScene.AddNode(node)
+        node.SetName(patient.ID + FindMarginsLib.PROJECTION_NAMES[projection])
+        node.SetSpacing(spacing)
+        node.SetOrigin(origin)
+        node.SetIJKToRASDirectionMatrix(matrix)
+        node.SetAndObserveImageData(projectionImageData)
+        names.append(node.GetName())
     self.setDisplay()
-    return "Finished with registration"
+    return "Created " + ", ".join(names) + "."
+
+  def createAmplitudeMaps(self, patient, slabSize = 32):
+    #Peak-to-peak displacement per voxel of reference phase (L-R, A-P, I-S and largest displacement).
+    #Inverse field of every phase is computed once (or reused from field store) and streamed slab by slab,
+    #only the running minimum and maximum of the slab are kept; maps are written slab by slab into NRRDs.
+    refPhase = patient.refPhase
+    maps = patient.getAmplitudeMaps(refPhase)
+    if maps is not None:
+      return "Loaded amplitude maps."
+
+    patient.create4DParameters()
+    if not patient.loadDicom(refPhase):
+      self.setDisplay()
+      return "Can't get CT for phase " + str(refPhase) + "0 %"
+    dimensions, ijkToRAS = FindMarginsLib.volumeGeometry(patient.fourDCT[refPhase].node)
+    patient.releaseDicom(refPhase)
+
+    #Without field store of the patient, fields are kept in a temporary one until maps are written
+    fieldStore = patient.getFieldStore()
+    workDirectory = None
+    if fieldStore is None:
+      workDirectory = tempfile.mkdtemp(prefix="amplitudes_", dir=patient.patientDir)
+      fieldStore = FindMarginsLib.FieldStore(workDirectory, 'float32')
+    try:
+      fields = {}
+      for i in range(0, 10):
+        if i == refPhase:
+          continue
+        patient.regParameters.referenceNumber = str(i) + "0"
+        bspline = patient.getBspline()
+        if bspline is None:
+          self.setDisplay()
+          return "Can't get transform for phase " + str(i) + "0 %"
+        fieldName = patient.phaseFieldName(i)
+        fields[i] = fieldStore.open(fieldName, bspline.fileName)
+        if fields[i] is None or not fields[i].matches(dimensions, ijkToRAS):
+          #Same as propagating points: ToParent of the registration from reference phase
+          self.setDisplay("Inverting transform of phase " + str(i) + "0 %.")
+          field = bspline.gridDisplacement(dimensions, ijkToRAS, True)
+          self.setDisplay("Phase " + str(i) + "0 %: B-spline inverse, maximal residual " + str(round(bspline.maxResidual, 4)) + " mm")
+          fieldStore.save(fieldName, field, ijkToRAS, bspline.fileName)
+          del field
+          fields[i] = fieldStore.open(fieldName, bspline.fileName)
+
+      fileNames = FindMarginsLib.amplitudeMapFiles(patient.amplitudeMapPrefix(refPhase))
+      writers = [FindMarginsLib.NrrdWriter(fileName, dimensions, ijkToRAS, np.float32) for fileName in fileNames]
+      for writer in writers:
+        if not writer.open():
+          self.setDisplay()
+          return "Can't write " + writer.fileName
+      for zStart in range(0, dimensions[2], slabSize):
+        zEnd = min(zStart + slabSize, dimensions[2])
+        self.setDisplay("Amplitude maps, slices " + str(zStart) + " to " + str(zEnd) + ".")
+        accumulator = FindMarginsLib.AmplitudeAccumulator((zEnd - zStart, dimensions[1], dimensions[0]))
+        for i in fields:
+          accumulator.add(fields[i].slab(zStart, zEnd))
+        slab = accumulator.maps()
+        for n in range(len(writers)):
+          writers[n].writeSlab(slab[..., n])
+      for writer in writers:
+        if not writer.close():
+          self.setDisplay()
+          return "Can't write " + writer.fileName
+      for i in fields:
+        fields[i].close()
+    finally:
+      if workDirectory is not None:
+        shutil.rmtree(workDirectory, True)
+    patient.saveAmplitudeMapsManifest(refPhase)
+
+    self.setDisplay()
+    if patient.getAmplitudeMaps(refPhase) is None:
+      return "Can't read amplitude maps."
+    return "Created amplitude maps."
+
+  def regionAmplitudes(self, patient, contour, skipPlanRegistration = False, statistic = 'mean'):
+    #Amplitudes (L-R, A-P, I-S, largest displacement) of contour from amplitude maps, None without maps.
+    #Maps are on reference phase; contour of planning CT is moved there first, unless it was delineated in 4D
+    maps = patient.getAmplitudeMaps(patient.refPhase)
+    if maps is None:
+      return None
+    points = None
+    labelmap = contour.GetLabelmapImageData()
+    if labelmap is not None and hasattr(contour, 'GetRASToIJKMatrix'):
+      matrix = vtk.vtkMatrix4x4()
+      contour.GetRASToIJKMatrix(matrix)
+      matrix.Invert()
+      ijkToRAS = [[matrix.GetElement(i, j) for j in range(4)] for i in range(4)]
+      points = FindMarginsLib.maskPoints(FindMarginsLib.imageDataArray(labelmap), ijkToRAS)
+    if points is None or len(points) == 0:
+      points = FindMarginsLib.contourPoints(contour)
+    if points is None:
+      return None
+    if not skipPlanRegistration:
+      points = self.propagatePoints(patient, 10, points)
+      if points is None:
+        return None
+    return maps.regionAmplitudes(points, statistic)
 
   def createPTV(self, patient, SSigma, Rsigma, keepAmplitudes, axisOfMotion):
     import vtkSlicerContourMorphologyModuleLogic
@@ -1420,12 +2290,115 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
     contour.SetAndObserveTransformNodeID(bspline.GetID())
     if not transformLogic.hardenTransform(contour):
         self.delayDisplay("Can't harden transform.")
-        slicer.mrmlScene.RemoveNode(bspline)
         return None
 
-    slicer.mrmlScene.RemoveNode(bspline)
+    #Transform stays in patient.transformCache for the next stage
     return contour
 
+  def propagatePoints(self, patient, position, points):
+    #Moves points (N x 3, RAS) like propagateContour moves a contour, but without any MRML nodes
+    if position == 10 or position == 11:
+      patient.createPlanParameters()
+      if position == 11:
+        patient.regParameters.referenceNumber = "MidV_ref" + str(patient.refPhase)
+    else:
+      patient.create4DParameters()
+      patient.regParameters.referenceNumber = str(position) + "0"
+
+    bspline = patient.getBspline()
+    if bspline is None:
+      return None
+    #Hardening applies ToParent of the registration to the points
+    displacement, residual = bspline.inverseDisplacement(points)
+    return points + displacement
+
+  def propagateMotionPoints(self, patient, skipPlanRegistration, origins):
+    #Points of target in planning CT are propagated to reference phase and from there to all phases,
+    #centroids are written into origins (3 x 10) and points are kept in patient.fourDCT[i].points
+    refPhase = patient.refPhase
+    #Closed surface (or labelmap voxels) gives volumetric centroids, the same for plan and all phases
+    mesh = FindMarginsLib.centroidPoints(patient.fourDCT[10].contour)
+    if mesh is None:
+      return "Can't get points of contour."
+    planPoints, triangles = mesh
+    patient.fourDCT[10].points = planPoints
+    patient.fourDCT[10].origin = FindMarginsLib.pointsCentroids([planPoints], triangles)[0]
+
+    if skipPlanRegistration:
+      refPoints = planPoints
+    else:
+      refPoints = self.propagatePoints(patient, 10, planPoints)
+      if refPoints is None:
+        return "Can't propagate contour to reference phase."
+    patient.fourDCT[refPhase].points = refPoints
+    phases = [refPhase]
+
+    for i in range(0, 10):
+      if i == refPhase:
+        continue
+      self.setDisplay("Propagating points to phase " + str(i) + "0 %")
+      points = self.propagatePoints(patient, i, refPoints)
+      if points is None:
+        print "Can't propagate contour for phase " + str(i) + "0 %"
+        continue
+      patient.fourDCT[i].points = points
+      phases.append(i)
+
+    #Centroids of all phases in one batch
+    centroids = FindMarginsLib.pointsCentroids([patient.fourDCT[i].points for i in phases], triangles)
+    for n in range(len(phases)):
+      origins[:, phases[n]] = centroids[n]
+    print "reference origins: ", origins[:, refPhase]
+    return ""
+
+  def calculateStructureMotion(self, patient, contours = None, skipPlanRegistration = False):
+    #Motion of several structures (structure set contours in scene by default) from one pass over registrations:
+    #points of all structures are stacked, so every phase registration is loaded once.
+    #Result is kept in patient.structureMotion and written to patient directory
+    if contours is None:
+      nodes = slicer.util.getNodes('vtkMRMLContourNode*')
+      contours = [nodes[name] for name in sorted(nodes.keys()) if FindMarginsLib.isStructureContour(nodes[name].GetName())]
+
+    motion = FindMarginsLib.StructureMotion()
+    for contour in contours:
+      mesh = FindMarginsLib.centroidPoints(contour)
+      if mesh is None:
+        continue
+      motion.add(contour.GetName().replace("_Contour", ""), mesh[0], mesh[1])
+    if len(motion.names) == 0:
+      return "Can't get points of any contour."
+
+    refPhase = patient.refPhase
+    planPoints = motion.stackedPoints()
+    if skipPlanRegistration:
+      refPoints = planPoints
+    else:
+      self.setDisplay("Propagating " + str(len(motion.names)) + " structures to reference phase")
+      refPoints = self.propagatePoints(patient, 10, planPoints)
+      if refPoints is None:
+        self.setDisplay()
+        return "Can't propagate structures to reference phase."
+    motion.setPhase(refPhase, refPoints)
+
+    for i in range(0, 10):
+      if i == refPhase:
+        continue
+      self.setDisplay("Propagating " + str(len(motion.names)) + " structures to phase " + str(i) + "0 %")
+      points = self.propagatePoints(patient, i, refPoints)
+      if points is None:
+        print "Can't propagate structures to phase " + str(i) + "0 %"
+        continue
+      motion.setPhase(i, points)
+
+    motion.finish()
+    patient.structureMotion = motion
+    for name in motion.names:
+      print name, motion.amplitude(name)
+    if patient.patientDir:
+      motion.writeCsv(patient.patientDir + "/" + patient.ID + "_structureMotion.csv")
+    self.setDisplay()
+    return ""
+
   def setDisplayNode(self, contour, parentHierarchy = None):
       from vtkSlicerContoursModuleMRML import vtkMRMLContourModelDisplayNode
 
@@ -1438,12 +2411,27 @@ class FindMarginsLogic(ScriptedLoadableModuleLogic):
       contour.SetAndObserveDisplayNodeID(displayNode.GetID())
       contour.CreateRibbonModelDisplayNode()
 
+  def targetRegion(self, patient, padding = 30.):
+      #Box around target propagated from planning CT to reference phase (grid of midV), padding [mm] has to cover its motion
+      contour = patient.fourDCT[10].contour
+      if contour is None:
+          return None
+      mesh = FindMarginsLib.centroidPoints(contour)
+      if mesh is None:
+          return None
+      points = self.propagatePoints(patient, 10, mesh[0])
+      if points is None:
+          print "Can't propagate target to reference phase."
+          return None
+      return FindMarginsLib.regionFromPoints(points, padding)
+
   def getCenterOfMass(self,contour):
-      comFilter = vtk.vtkCenterOfMass()
-      comFilter.SetInputData(contour.GetRibbonModelPolyData())
-      comFilter.SetUseScalarsAsWeights(False)
-      comFilter.Update()
-      return comFilter.GetCenter()
+      #Centre of enclosed volume from closed surface, or of labelmap voxels if there's no closed surface.
+      #Same source as centroids of propagated points, so plan and phase origins can be compared
+      mesh = FindMarginsLib.centroidPoints(contour)
+      if mesh is None:
+        return None
+      return FindMarginsLib.pointsCentroids([mesh[0]], mesh[1])[0]
 
   def plotMotion(self, relOrigins, contourName):
     ln = slicer.util.getNode(pattern='vtkMRMLLayoutNode*')
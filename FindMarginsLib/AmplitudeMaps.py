@@ -0,0 +1,113 @@
+import os
+import numpy as np
+
+from NrrdFile import readNrrdArray
+
+# Peak-to-peak displacement along each axis and largest displacement from reference phase
+MAP_NAMES = ['LR', 'AP', 'IS', 'magnitude']
+
+
+def amplitudeMapFiles(prefix):
+  return [prefix + "_" + name + ".nrrd" for name in MAP_NAMES]
+
+
+def maskPoints(mask, ijkToRAS):
+  """RAS of non zero voxels of mask (k, j, i), e.g. labelmap of a contour."""
+  kji = np.argwhere(mask)
+  ijk = kji[:, ::-1].astype(np.float64)
+  matrix = np.asarray(ijkToRAS, dtype=np.float64)
+  return np.dot(ijk, matrix[0:3, 0:3].T) + matrix[0:3, 3]
+
+
+#
+# AmplitudeAccumulator
+#
+
+class AmplitudeAccumulator():
+  """Running minimum, maximum and largest length of displacement fields (k, j, i, 3) of one slab.
+
+  Starts from zero, which is the displacement of the reference phase, so
+  only the other phases have to be added.
+  """
+  def __init__(self, shape):
+    self.minimum = np.zeros(tuple(shape) + (3,), dtype=np.float32)
+    self.maximum = np.zeros(tuple(shape) + (3,), dtype=np.float32)
+    self.magnitude = np.zeros(tuple(shape), dtype=np.float32)
+
+  def add(self, field):
+    np.minimum(self.minimum, field, out=self.minimum)
+    np.maximum(self.maximum, field, out=self.maximum)
+    np.maximum(self.magnitude, np.sqrt(np.einsum('kjic,kjic->kji', field, field)), out=self.magnitude)
+
+  def maps(self):
+    """(k, j, i, 4) maps in order of MAP_NAMES."""
+    result = np.empty(self.magnitude.shape + (4,), dtype=np.float32)
+    np.subtract(self.maximum, self.minimum, out=result[..., 0:3])
+    result[..., 3] = self.magnitude
+    return result
+
+
+#
+# AmplitudeMaps
+#
+
+class AmplitudeMaps():
+  """Per voxel motion amplitudes written by FindMarginsLogic.createAmplitudeMaps.
+
+  Maps are memory mapped from their NRRD files, so amplitudes of any
+  structure are read by sampling the maps at its voxels (or points),
+  without registrations or vector fields.
+  """
+  def __init__(self, prefix):
+    self.prefix = prefix
+    self.fileNames = amplitudeMapFiles(prefix)
+    self.maps = None
+    self.dimensions = None
+    self.ijkToRAS = None
+
+  def exists(self):
+    return all([os.path.exists(fileName) for fileName in self.fileNames])
+
+  def read(self):
+    maps = []
+    for fileName in self.fileNames:
+      result = readNrrdArray(fileName) if os.path.exists(fileName) else None
+      if result is None:
+        print "Can't read amplitude map " + fileName
+        return False
+      array, dimensions, ijkToRAS = result
+      if self.dimensions is not None and not (dimensions == self.dimensions and np.allclose(ijkToRAS, self.ijkToRAS)):
+        print "Amplitude maps " + self.prefix + " don't share geometry."
+        return False
+      self.dimensions, self.ijkToRAS = dimensions, ijkToRAS
+      maps.append(array)
+    self.maps = maps
+    return True
+
+  def indices(self, points):
+    """Nearest voxel (k, j, i) of RAS points and mask of points inside the maps."""
+    rasToIJK = np.linalg.inv(self.ijkToRAS)
+    ijk = np.round(np.dot(points, rasToIJK[0:3, 0:3].T) + rasToIJK[0:3, 3]).astype(int)
+    inside = np.all((ijk >= 0) & (ijk < self.dimensions), axis=1)
+    ijk = ijk[inside]
+    return (ijk[:, 2], ijk[:, 1], ijk[:, 0]), inside
+
+  def sample(self, points):
+    """Values of all maps at RAS points inside the maps (M x 4)."""
+    kji, inside = self.indices(np.asarray(points, dtype=np.float64))
+    return np.column_stack([np.asarray(array[kji], dtype=np.float32) for array in self.maps])
+
+  def regionAmplitudes(self, points, statistic = 'max'):
+    """LR, AP, IS amplitude and magnitude of a structure given by its voxels (or points) in RAS.
+    statistic is 'max', 'mean' or a percentile (e.g. 95), None if no point lies in the maps.
+    """
+    if self.maps is None and not self.read():
+      return None
+    values = self.sample(points)
+    if values.shape[0] == 0:
+      return None
+    if statistic == 'max':
+      return values.max(axis=0)
+    if statistic == 'mean':
+      return values.mean(axis=0)
+    return np.percentile(values, statistic, axis=0)
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+from __main__ import vtk, qt, ctk, slicer
+
+
+#
+# BatchJournal
+#
+
+class BatchJournal():
+  """Persistent record of batch stages per patient.
+
+  Every state change is written to disk right away (through a temporary file
+  and rename), so after a crash the journal holds the last finished stage of
+  each patient. A stage left in "running" state was interrupted and runs again.
+  """
+  def __init__(self, fileName):
+    self.fileName = fileName
+    self.patients = {}
+    self.load()
+
+  def load(self):
+    if not os.path.exists(self.fileName):
+      return False
+    try:
+      with open(self.fileName, 'r') as f:
+        self.patients = json.load(f)
+    except (IOError, ValueError):
+      print "Can't read batch journal " + self.fileName
+      return False
+    return True
+
+  def save(self):
+    tmpFile = self.fileName + ".tmp"
+    with open(tmpFile, 'w') as f:
+      json.dump(self.patients, f, indent=1, sort_keys=True)
+      f.flush()
+      os.fsync(f.fileno())
+    if os.path.exists(self.fileName):
+      os.remove(self.fileName)
+    os.rename(tmpFile, self.fileName)
+
+  def patient(self, patientID, refPhase):
+    entry = self.patients.get(patientID)
+    #Results for other reference phase can't be reused
+    if entry is None or entry.get('refPhase') != refPhase:
+      entry = {'refPhase': refPhase, 'stages': {}}
+      self.patients[patientID] = entry
+    return entry
+
+  def stage(self, patientID, stage):
+    return self.patients[patientID]['stages'].get(stage, {})
+
+  def isDone(self, patientID, stage):
+    return self.stage(patientID, stage).get('state') in ["done", "skipped"]
+
+  def setState(self, patientID, stage, state, message = "", result = None):
+    entry = self.patients[patientID]['stages'].setdefault(stage, {'attempts': 0})
+    entry['state'] = state
+    entry['message'] = message
+    if state == "running":
+      entry['attempts'] += 1
+      entry['start'] = time.time()
+    else:
+      entry['end'] = time.time()
+    if result is not None:
+      entry['result'] = result
+    self.save()
+
+
+#
+# BatchScheduler
+#
+
+class BatchScheduler():
+  """Runs register -> mid ventilation -> motion -> PTV for a list of patients.
+
+  Progress is kept in a BatchJournal, so a restarted batch continues with the
+  first unfinished stage of every patient. Motion and PTV stages need the name
+  of the target contour from the structure set; without it they are skipped.
+  The per patient timeout is checked before every stage and every retry;
+  registrations also get it as deadline of their pool, which cancels
+  (kills) the running ones when it passes.
+  """
+  STAGES = ["register", "midV", "motion", "PTV"]
+
+  def __init__(self, logic, patientList, journalFile, contourName = "", timeout = None, retries = 1):
+    self.logic = logic
+    self.patientList = patientList
+    self.journal = BatchJournal(journalFile)
+    self.contourName = contourName
+    self.timeout = timeout
+    self.retries = retries
+    self.nWorkers = 1
+    self.memoryBudget = None
+    self.SSigma = 2
+    self.Rsigma = 0
+    self.skipPlanRegistration = False # True, if batch contour was delineated in reference phase, not planning CT
+    self.deadline = None # of current patient
+    self.summary = {}
+
+  def findPatient(self, patientID):
+    for patient in self.patientList:
+      if patient is not None and patient.ID == patientID:
+        return patient
+    return None
+
+  def run(self, patientIDs):
+    startTime = time.time()
+    finished = []
+    failed = []
+    for patientID in patientIDs:
+      patient = self.findPatient(patientID)
+      if patient is None:
+        print "Batch: can't find patient " + patientID
+        failed.append(patientID)
+        continue
+      if self.processPatient(patient):
+        finished.append(patientID)
+      else:
+        failed.append(patientID)
+      self.releasePatient(patient)
+
+    hours = (time.time() - startTime) / 3600.
+    self.summary = {}
+    self.summary['finished'] = finished
+    self.summary['failed'] = failed
+    self.summary['hours'] = hours
+    self.summary['patientsPerHour'] = len(finished) / hours if hours > 0 else 0
+    print "Batch finished: " + str(len(finished)) + " patients processed, " + str(len(failed)) + " failed in " + str(round(hours, 2)) + " h (" + str(round(self.summary['patientsPerHour'], 2)) + " patients per hour)."
+    return self.summary
+
+  def processPatient(self, patient):
+    patientID = patient.ID
+    self.journal.patient(patientID, patient.refPhase)
+    self.journal.save()
+    startTime = time.time()
+    self.deadline = startTime + self.timeout if self.timeout is not None else None
+    for stage in self.STAGES:
+      if self.journal.isDone(patientID, stage):
+        print "Batch: " + patientID + " " + stage + " already done."
+        continue
+
+      success = False
+      for attempt in range(0, self.retries + 1):
+        if self.timeout is not None and time.time() - startTime > self.timeout:
+          self.journal.setState(patientID, stage, "timeout", "Patient exceeded " + str(self.timeout) + " s.")
+          print "Batch: " + patientID + " timed out before " + stage
+          return False
+
+        self.journal.setState(patientID, stage, "running")
+        try:
+          state, message, result = self.runStage(stage, patient)
+        except Exception as e:
+          state, message, result = "failed", "Exception: " + str(e), None
+        self.journal.setState(patientID, stage, state, message, result)
+        print "Batch: " + patientID + " " + stage + " " + state + " " + message
+        if state == "timeout":
+          return False
+        if state in ["done", "skipped"]:
+          success = True
+          break
+
+      if not success:
+        return False
+    return True
+
+  def runStage(self, stage, patient):
+    """Returns (state, message, result) of one stage. State is done, skipped, failed or timeout."""
+    if stage == "register":
+      #Through the pool (also with one worker), so registrations are killed at the deadline
+      pool, message = self.logic.createRegistrationPool(patient, [patient.refPhase], True, self.nWorkers, self.memoryBudget)
+      if pool is not None:
+        pool.deadline = self.deadline
+        pool.run()
+        if pool.timedOut:
+          return "timeout", "Patient exceeded " + str(self.timeout) + " s during registration. " + pool.summary(), None
+        message = self.logic.registrationResult(pool)
+      missing = self.missingTransforms(patient)
+      if missing:
+        return "failed", str(message) + " Missing: " + ", ".join(missing), None
+      return "done", str(message), None
+
+    if stage == "midV":
+      message = self.logic.createMidVentilation(patient)
+      fileName = patient.midVFileName(patient.refPhase)
+      reason = patient.checkMidV(patient.refPhase)
+      #midV from before manifests is accepted, like in Patient.loadMidV
+      if reason and not reason == "no manifest":
+        return "failed", str(message) + " (" + reason + ")", None
+      return "done", str(message), fileName
+
+    if not self.contourName:
+      return "skipped", "No contour name for batch.", None
+
+    if not self.findContour(patient):
+      return "failed", "Can't find contour " + self.contourName, None
+
+    if stage == "motion":
+      message = self.logic.calculateMotion(patient, self.skipPlanRegistration, False, False, False)
+      if message:
+        return "failed", str(message), None
+      return "done", "", [float(a) for a in patient.amplitudes]
+
+    if stage == "PTV":
+      #Amplitudes from the motion stage, also when it was finished in an earlier run
+      patient.amplitudes = self.journal.stage(patient.ID, "motion").get('result', patient.amplitudes)
+      message = self.logic.createPTV(patient, self.SSigma, self.Rsigma, True, False)
+      if not message or message.find("Created ") < 0:
+        return "failed", str(message), None
+      return "done", str(message), [float(patient.ptvMargins[i]) for i in range(3)]
+
+    return "failed", "Unknown stage " + stage, None
+
+  def missingTransforms(self, patient):
+    missing = []
+    refPhase = patient.refPhase
+    patient.createPlanParameters()
+    if not patient.regParameters.checkBspline():
+      missing.append("planning CT")
+    patient.create4DParameters()
+    for i in range(0, 10):
+      if i == refPhase:
+        continue
+      patient.regParameters.referenceNumber = str(i) + "0"
+      if not patient.regParameters.checkBspline():
+        missing.append(str(i) + "0%")
+    return missing
+
+  def findContour(self, patient):
+    if patient.fourDCT[10].contour is not None:
+      return True
+    if not patient.loadStructureSet():
+      return False
+    nodes = slicer.util.getNodes('vtkMRMLContourNode*')
+    for name in nodes:
+      if name.find(self.contourName) > -1 and name.find('_Contour') > -1:
+        patient.fourDCT[10].contour = nodes[name]
+        return True
+    return False
+
+  def releasePatient(self, patient):
+    #Free memory before next patient, all results are on disk or in journal
+    if patient.volumeCache is not None:
+      patient.volumeCache.clear()
+    patient.transformCache.clear()
+    slicer.mrmlScene.Clear(0)
+    for i in range(0, 11):
+      patient.fourDCT[i].node = None
+      patient.fourDCT[i].transform = None
+      patient.fourDCT[i].contour = None
+      patient.fourDCT[i].vectorField = None
+    patient.midVentilation.node = None
+    patient.midVentilation.transform = None
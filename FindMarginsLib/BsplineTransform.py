@@ -0,0 +1,333 @@
+import os
+import math
+import time
+import threading
+import multiprocessing
+import numpy as np
+
+# Slicer works in RAS, ITK and plastimatch files are in LPS
+LPS_TO_RAS = np.array([-1., -1., 1.])
+
+
+def cubicWeights(u):
+  """Cubic B-spline basis for fractions u, returns array of shape u.shape + (4,)."""
+  u2 = u * u
+  u3 = u2 * u
+  weights = np.empty(u.shape + (4,), dtype=np.float64)
+  weights[..., 0] = (1 - u)**3 / 6.
+  weights[..., 1] = (3 * u3 - 6 * u2 + 4) / 6.
+  weights[..., 2] = (-3 * u3 + 3 * u2 + 3 * u + 1) / 6.
+  weights[..., 3] = u3 / 6.
+  return weights
+
+
+def volumeGeometry(node):
+  """Returns (dimensions (i, j, k), IJK to RAS matrix as 4x4 array) of a volume node."""
+  from __main__ import vtk
+  matrix = vtk.vtkMatrix4x4()
+  node.GetIJKToRASMatrix(matrix)
+  ijkToRAS = np.array([[matrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+  return node.GetImageData().GetDimensions(), ijkToRAS
+
+
+#
+# BsplineTransform
+#
+
+class BsplineTransform():
+  """Cubic B-spline deformation read from a plastimatch result (_bs.txt), evaluated with numpy.
+
+  Reads ITK transform files (BSplineDeformableTransform/BSplineTransform, as
+  written by the plastimatch CLI) and plastimatch native files (MGH_GPUIT_BSP).
+  The transform maps a point x to x + d(x), which is how Slicer loads the file
+  (as FromParent transform). Points and displacements are in RAS, conversion
+  from file's LPS is done here. Like ITK, displacement is zero outside the
+  region where all 4x4x4 supporting control points exist.
+
+  displacement() evaluates arbitrary points in batches, gridDisplacement()
+  evaluates whole volume on its voxel grid as separable tensor product split
+  over threads. With toParent the inverse is found by fixed-point iteration,
+  this is what CreateDisplacementVolumeFromTransform gives for the transform.
+
+  Forward displacement matches ITK up to float rounding (< 0.001 mm), the
+  inverse up to tolerance (default 0.01 mm), except next to the edge of the
+  valid region, where the displacement drops to zero and the iteration can't
+  converge. Use compareWithSlicer() to check both on a patient.
+  """
+  BATCH_SIZE = 200000
+
+  def __init__(self, fileName = None):
+    self.fileName = ""
+    self.coefficients = None  # (3, nz, ny, nx), LPS displacements of control points
+    self.size = np.zeros(3, dtype=int)  # control points along x, y, z
+    self.origin = np.zeros(3)
+    self.spacing = np.ones(3)
+    self.direction = np.eye(3)
+    self.nThreads = multiprocessing.cpu_count()
+    self.maxResidual = 0.  # of the last inverse field, reported by callers
+    if fileName:
+      self.read(fileName)
+
+  def read(self, fileName):
+    if not os.path.exists(fileName):
+      print "Can't find " + fileName
+      return False
+    with open(fileName, 'r') as f:
+      text = f.read()
+    if text.startswith("MGH_GPUIT_BSP"):
+      success = self.readNative(text)
+    else:
+      success = self.readITK(text)
+    if not success:
+      print "Can't read B-spline from " + fileName
+      return False
+    self.fileName = fileName
+    self.inverseDirection = np.linalg.inv(self.direction)
+    return True
+
+  def readITK(self, text):
+    transformType = None
+    parameters = None
+    fixedParameters = None
+    for line in text.splitlines():
+      if line.startswith("Transform:"):
+        if transformType is not None and transformType.find("BSpline") > -1:
+          break
+        transformType = line.split(":", 1)[1].strip()
+      elif line.startswith("Parameters:"):
+        parameters = line.split(":", 1)[1]
+      elif line.startswith("FixedParameters:"):
+        fixedParameters = line.split(":", 1)[1]
+    if transformType is None or transformType.find("BSpline") < 0 or parameters is None or fixedParameters is None:
+      print "No B-spline transform in file (" + str(transformType) + ")."
+      return False
+
+    fixed = np.array(fixedParameters.split(), dtype=np.float64)
+    self.size = fixed[0:3].astype(int)
+    self.origin = fixed[3:6]
+    self.spacing = fixed[6:9]
+    self.direction = fixed[9:18].reshape(3, 3)
+    values = np.array(parameters.split(), dtype=np.float64)
+    nPoints = np.prod(self.size)
+    if not values.size == 3 * nPoints:
+      print "Number of B-spline coefficients " + str(values.size) + " doesn't match grid " + str(list(self.size))
+      return False
+    # ITK stores all x, then all y, then all z coefficients, x index running fastest
+    self.coefficients = values.reshape(3, self.size[2], self.size[1], self.size[0])
+    return True
+
+  def readNative(self, text):
+    header = {}
+    values = []
+    for line in text.splitlines()[1:]:
+      if line.find("=") > -1:
+        name, value = line.split("=", 1)
+        header[name.strip()] = np.array(value.split(), dtype=np.float64)
+      elif line.strip():
+        values.append(float(line))
+    try:
+      imageOrigin = header["img_origin"]
+      imageSpacing = header["img_spacing"]
+      roiOffset = header["roi_offset"]
+      roiDim = header["roi_dim"]
+      voxelsPerRegion = header["vox_per_rgn"]
+    except KeyError as e:
+      print "Missing " + str(e) + " in plastimatch B-spline header."
+      return False
+    self.direction = header.get("direction_cosines", np.eye(3).flatten()).reshape(3, 3)
+    # Control point grid starts one knot spacing before the region of interest
+    self.spacing = imageSpacing * voxelsPerRegion
+    regions = np.floor((roiDim - 1) / voxelsPerRegion).astype(int) + 1
+    self.size = regions + 3
+    self.origin = imageOrigin + np.dot(self.direction, roiOffset * imageSpacing - self.spacing)
+    values = np.array(values, dtype=np.float64)
+    nPoints = np.prod(self.size)
+    if not values.size == 3 * nPoints:
+      print "Number of B-spline coefficients " + str(values.size) + " doesn't match grid " + str(list(self.size))
+      return False
+    # Native coefficients are interleaved (x, y, z per control point)
+    self.coefficients = values.reshape(self.size[2], self.size[1], self.size[0], 3).transpose(3, 0, 1, 2).copy()
+    return True
+
+  def continuousIndex(self, pointsLPS):
+    return np.dot(pointsLPS - self.origin, self.inverseDirection.T) / self.spacing
+
+  def displacement(self, points):
+    """FromParent displacement (RAS) at points (N x 3 array in RAS)."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    result = np.zeros(points.shape)
+    for start in range(0, points.shape[0], self.BATCH_SIZE):
+      end = min(start + self.BATCH_SIZE, points.shape[0])
+      result[start:end] = self.evaluateBatch(points[start:end])
+    return result
+
+  def evaluateBatch(self, points):
+    cidx = self.continuousIndex(points * LPS_TO_RAS)
+    first = np.floor(cidx).astype(int) - 1
+    # Points without complete support get zero displacement (ITK valid region)
+    valid = np.all((cidx >= 1) & (cidx < self.size - 2), axis=1)
+    first = first[valid]
+    weights = cubicWeights(cidx[valid] - np.floor(cidx[valid]))
+
+    displacement = np.zeros((first.shape[0], 3))
+    nx, ny = self.size[0], self.size[1]
+    flat = self.coefficients.reshape(3, -1)
+    for k in range(4):
+      for j in range(4):
+        weightKJ = weights[:, 2, k] * weights[:, 1, j]
+        offset = ((first[:, 2] + k) * ny + first[:, 1] + j) * nx + first[:, 0]
+        for i in range(4):
+          displacement += (weightKJ * weights[:, 0, i])[:, np.newaxis] * flat[:, offset + i].T
+
+    # Coefficients are physical (LPS) displacements, direction only maps points to the grid
+    result = np.zeros(points.shape)
+    result[valid] = displacement * LPS_TO_RAS
+    return result
+
+  def inverseDisplacement(self, points, tolerance = 0.01, maxIterations = 30):
+    """ToParent displacement (RAS) at points: y - x, where x + d(x) = y.
+    Returns (displacement, maximal residual in mm).
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    return self.invertFrom(points, -self.displacement(points), tolerance, maxIterations)
+
+  def axisWeights(self, start, step, n, axis):
+    """Dense weights (n x control points) of voxels along one axis, given its continuous index start + step * i."""
+    cidx = start + step * np.arange(n)
+    first = np.floor(cidx).astype(int) - 1
+    valid = (cidx >= 1) & (cidx < self.size[axis] - 2)
+    weights = cubicWeights(cidx - np.floor(cidx))
+    matrix = np.zeros((n, self.size[axis]))
+    rows = np.nonzero(valid)[0]
+    for m in range(4):
+      matrix[rows, first[valid] + m] = weights[valid, m]
+    return matrix
+
+  def gridDisplacement(self, dimensions, ijkToRAS, toParent = False, tolerance = 0.01):
+    """Displacement (RAS) on voxel grid as float32 array of shape (k, j, i, 3), like slicer.util.array of a vector volume.
+    Uses separable evaluation when grid axes are parallel to control point grid, otherwise point evaluation.
+    With toParent the maximal residual of the inversion is kept in maxResidual.
+    """
+    dimensions = [int(d) for d in dimensions]
+    ijkToLPS = np.asarray(ijkToRAS, dtype=np.float64)[0:3] * LPS_TO_RAS[:, np.newaxis]
+    # Continuous control point index = A * ijk + b
+    A = np.dot(self.inverseDirection, ijkToLPS[:, 0:3]) / self.spacing[:, np.newaxis]
+    b = np.dot(self.inverseDirection, ijkToLPS[:, 3] - self.origin) / self.spacing
+    if np.abs(A - np.diag(np.diag(A))).max() < 1e-6 * np.abs(A).max():
+      field = self.separableDisplacement(dimensions, np.diag(A), b)
+    else:
+      field = self.pointGridDisplacement(dimensions, ijkToRAS)
+
+    if toParent:
+      points = self.gridPoints(dimensions, ijkToRAS)
+      field = field.reshape(-1, 3)
+      # Fixed-point iteration x = y - d(x), started from y - d(y)
+      inverse = -field.astype(np.float64)
+      self.maxResidual = self.invertThreaded(points, inverse, tolerance)
+      field = inverse.astype(np.float32).reshape(dimensions[2], dimensions[1], dimensions[0], 3)
+    return field
+
+  def separableDisplacement(self, dimensions, scale, offset):
+    weights = [self.axisWeights(offset[axis], scale[axis], dimensions[axis], axis) for axis in range(3)]
+    # Contract x and y once (3, cz, ny, nx), z slabs are contracted in threads
+    partial = np.dot(self.coefficients, weights[0].T)
+    partial = np.einsum('yb,azbx->azyx', weights[1], partial)
+    lps = np.zeros((dimensions[2], dimensions[1], dimensions[0], 3), dtype=np.float32)
+
+    def slab(zStart, zEnd):
+      values = np.tensordot(weights[2][zStart:zEnd], partial, axes=([1], [1]))  # (z, 3, ny, nx)
+      lps[zStart:zEnd] = values.transpose(0, 2, 3, 1)
+
+    self.runSlabs(dimensions[2], slab)
+    lps *= LPS_TO_RAS.astype(np.float32)
+    return lps
+
+  def gridPoints(self, dimensions, ijkToRAS, zStart = 0, zEnd = None):
+    if zEnd is None:
+      zEnd = dimensions[2]
+    k, j, i = np.mgrid[zStart:zEnd, 0:dimensions[1], 0:dimensions[0]]
+    ijk = np.vstack([i.ravel(), j.ravel(), k.ravel()]).T.astype(np.float64)
+    ijkToRAS = np.asarray(ijkToRAS, dtype=np.float64)
+    return np.dot(ijk, ijkToRAS[0:3, 0:3].T) + ijkToRAS[0:3, 3]
+
+  def pointGridDisplacement(self, dimensions, ijkToRAS):
+    field = np.zeros((dimensions[2], dimensions[1], dimensions[0], 3), dtype=np.float32)
+
+    def slab(zStart, zEnd):
+      points = self.gridPoints(dimensions, ijkToRAS, zStart, zEnd)
+      field[zStart:zEnd] = self.displacement(points).reshape(zEnd - zStart, dimensions[1], dimensions[0], 3)
+
+    self.runSlabs(dimensions[2], slab)
+    return field
+
+  def invertThreaded(self, points, inverse, tolerance):
+    residuals = []
+    lock = threading.Lock()
+    step = int(math.ceil(points.shape[0] / float(self.nThreads)))
+
+    def part(start, end):
+      values, residual = self.invertFrom(points[start:end], inverse[start:end], tolerance)
+      inverse[start:end] = values
+      with lock:
+        residuals.append(residual)
+
+    self.runSlabs(points.shape[0], part, step)
+    return max(residuals) if residuals else 0.
+
+  def invertFrom(self, points, inverse, tolerance, maxIterations = 30):
+    inverse = inverse.copy()
+    residual = np.zeros(points.shape[0])
+    active = np.arange(points.shape[0])
+    for iteration in range(maxIterations):
+      error = self.displacement(points[active] + inverse[active]) + inverse[active]
+      residual[active] = np.sqrt(np.sum(error**2, axis=1))
+      inverse[active] -= error
+      active = active[residual[active] > tolerance]
+      if active.size == 0:
+        break
+    return inverse, float(residual.max()) if residual.size else 0.
+
+  def runSlabs(self, n, function, step = None):
+    """Calls function(start, end) on consecutive slabs of range(n) in nThreads threads."""
+    if step is None:
+      step = max(1, int(math.ceil(n / float(self.nThreads))))
+    threads = []
+    for start in range(0, n, step):
+      thread = threading.Thread(target=function, args=(start, min(start + step, n)))
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      thread.join()
+
+
+def compareWithSlicer(fileName, volumeNode, toParent = True):
+  """Evaluates fileName on grid of volumeNode with numpy and with Slicer.
+  Returns dictionary with maximal difference (mm) and both run times (s).
+  """
+  from __main__ import slicer
+  result = {}
+  startTime = time.time()
+  bspline = BsplineTransform(fileName)
+  dimensions, ijkToRAS = volumeGeometry(volumeNode)
+  field = bspline.gridDisplacement(dimensions, ijkToRAS, toParent)
+  result['numpyTime'] = time.time() - startTime
+
+  startTime = time.time()
+  success, transform = slicer.util.loadTransform(fileName, returnNode=True)
+  if not success:
+    print "Can't load " + fileName
+    return None
+  transformLogic = slicer.modules.transforms.logic()
+  if not toParent:
+    transform.Inverse()
+  vf = transformLogic.CreateDisplacementVolumeFromTransform(transform, volumeNode, False)
+  slicerField = slicer.util.array(vf.GetID()).copy()
+  result['slicerTime'] = time.time() - startTime
+  slicer.mrmlScene.RemoveNode(vf)
+  slicer.mrmlScene.RemoveNode(transform)
+
+  result['maxDifference'] = float(np.abs(field - slicerField).max())
+  result['speedup'] = result['slicerTime'] / max(result['numpyTime'], 1e-6)
+  print ("B-spline evaluation: max difference " + str(round(result['maxDifference'], 4)) + " mm, numpy " +
+         str(round(result['numpyTime'], 1)) + " s, Slicer " + str(round(result['slicerTime'], 1)) + " s.")
+  return result
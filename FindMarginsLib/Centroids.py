@@ -0,0 +1,121 @@
+import numpy as np
+
+from ContourPoints import polyDataPoints
+from AmplitudeMaps import maskPoints
+
+
+def polyDataTriangles(polyData):
+  """Triangles of vtkPolyData as M x 3 point indices, None if it has no polygons.
+  Polygons with more than three points are triangulated first.
+  """
+  if polyData is None or polyData.GetNumberOfPolys() == 0:
+    return None
+  from vtk.util import numpy_support
+  cells = numpy_support.vtk_to_numpy(polyData.GetPolys().GetData())
+  if not cells.size == 4 * polyData.GetNumberOfPolys() or not np.all(cells[0::4] == 3):
+    from __main__ import vtk
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(polyData)
+    triangleFilter.PassVertsOff()
+    triangleFilter.PassLinesOff()
+    triangleFilter.Update()
+    cells = numpy_support.vtk_to_numpy(triangleFilter.GetOutput().GetPolys().GetData())
+  return cells.reshape(-1, 4)[:, 1:].astype(np.int64)
+
+
+def contourMesh(contour):
+  """(points, triangles) of closed surface of contour node, None if it has none."""
+  getter = getattr(contour, 'GetClosedSurfacePolyData', None)
+  if getter is None:
+    return None
+  polyData = getter()
+  points = polyDataPoints(polyData)
+  triangles = polyDataTriangles(polyData)
+  if points is None or triangles is None:
+    return None
+  return points, triangles
+
+
+def convertToClosedSurface(contour):
+  """Creates closed surface of contour node from its other representations (SlicerRT contour conversion)."""
+  try:
+    from vtkSlicerContoursModuleLogic import vtkConvertContourRepresentations
+    from vtkSlicerContoursModuleMRML import vtkMRMLContourNode
+  except ImportError:
+    print "Can't convert contours without SlicerRT Contours module."
+    return False
+  converter = vtkConvertContourRepresentations()
+  converter.SetContourNode(contour)
+  return bool(converter.ConvertToRepresentation(vtkMRMLContourNode.ClosedSurfaceModel))
+
+
+def labelmapPoints(contour):
+  """RAS centres of voxels inside labelmap of contour node, None if it has no labelmap."""
+  getter = getattr(contour, 'GetLabelmapImageData', None)
+  labelmap = getter() if getter is not None else None
+  if labelmap is None or labelmap.GetNumberOfPoints() == 0 or not hasattr(contour, 'GetRASToIJKMatrix'):
+    return None
+  from __main__ import vtk
+  from WarpEngine import imageDataArray
+  matrix = vtk.vtkMatrix4x4()
+  contour.GetRASToIJKMatrix(matrix)
+  matrix.Invert()
+  points = maskPoints(imageDataArray(labelmap), [[matrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+  if len(points) == 0:
+    return None
+  return points
+
+
+def centroidPoints(contour):
+  """(points, triangles) all centroids of a contour are computed from, in planning CT and every phase
+  alike, so they are all volumetric: closed surface mesh (converted from other representations, if the
+  contour has none), or centres of labelmap voxels (triangles None) if it can't be converted. None without both.
+  """
+  if contour is None:
+    return None
+  mesh = contourMesh(contour)
+  if mesh is None and convertToClosedSurface(contour):
+    mesh = contourMesh(contour)
+  if mesh is not None:
+    return mesh
+  points = labelmapPoints(contour)
+  if points is not None:
+    return points, None
+  print "Contour " + contour.GetName() + " has neither closed surface nor labelmap, its centroid isn't known."
+  return None
+
+
+def meshCentroids(points, triangles):
+  """Volumetric centres of closed meshes sharing triangles (e.g. one contour propagated to all phases).
+
+  points is N x 3 or P x N x 3 (P meshes), returns 3 or P x 3 array. Each
+  triangle spans a tetrahedron with the origin; by the divergence theorem the
+  signed tetrahedron volumes add up to the enclosed volume and their
+  centroids, weighted by volume, to its centre of mass. Orientation of the
+  triangles doesn't matter, as long as it is consistent.
+  """
+  points = np.asarray(points, dtype=np.float64)
+  single = points.ndim == 2
+  if single:
+    points = points[np.newaxis]
+  # Shift to mesh centre first, so volumes don't lose precision far from the origin
+  shift = points.mean(axis=1)[:, np.newaxis, :]
+  local = points - shift
+  a = local[:, triangles[:, 0]]
+  b = local[:, triangles[:, 1]]
+  c = local[:, triangles[:, 2]]
+  volumes = np.einsum('pti,pti->pt', a, np.cross(b, c)) / 6.
+  volume = volumes.sum(axis=1)
+  centroids = np.einsum('pt,pti->pi', volumes, a + b + c) / 4.
+  centroids = centroids / volume[:, np.newaxis] + shift[:, 0]
+  if single:
+    return centroids[0]
+  return centroids
+
+
+def pointsCentroids(points, triangles = None):
+  """Centroids of propagated point arrays (list or P x N x 3): of the enclosed volume for vertices of a
+  mesh, mean of points for labelmap voxel centres (each voxel stands for the same volume of the plan)."""
+  if triangles is not None:
+    return meshCentroids(np.array(points), triangles)
+  return np.array([np.asarray(p).mean(axis=0) for p in points])
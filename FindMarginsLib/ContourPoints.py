@@ -0,0 +1,33 @@
+import numpy as np
+
+# Contour representations tried for points; ribbon last, as it is generated when it's asked for
+REPRESENTATIONS = ['closedSurface', 'roiPoints', 'ribbon']
+GETTERS = {'ribbon': 'GetRibbonModelPolyData', 'closedSurface': 'GetClosedSurfacePolyData', 'roiPoints': 'GetDicomRtRoiPoints'}
+
+
+def polyDataPoints(polyData):
+  """Points of vtkPolyData as N x 3 array (RAS), None if there are none."""
+  if polyData is None or polyData.GetNumberOfPoints() == 0:
+    return None
+  from vtk.util import numpy_support
+  return numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(np.float64)
+
+
+def contourPoints(contour, representations = REPRESENTATIONS):
+  """Vertices of first existing representation of contour node (ribbon, closed surface or RT structure points)."""
+  if contour is None:
+    return None
+  for representation in representations:
+    getter = getattr(contour, GETTERS[representation], None)
+    if getter is None:
+      continue
+    points = polyDataPoints(getter())
+    if points is not None:
+      return points
+  print "Contour " + contour.GetName() + " has no points."
+  return None
+
+
+def pointsCentroid(points):
+  """Mean of points, same as vtkCenterOfMass without weights."""
+  return points.mean(axis=0)
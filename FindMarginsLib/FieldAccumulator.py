@@ -0,0 +1,72 @@
+from __main__ import vtk, qt, ctk, slicer
+import numpy as np
+from vtk.util import numpy_support
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+
+def peakMemory():
+  """Peak resident memory of Slicer process in bytes (None where it can't be read)."""
+  if resource is None:
+    return None
+  # ru_maxrss is in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+#
+# FieldAccumulator
+#
+
+class FieldAccumulator():
+  """Sums vector fields into one preallocated float32 image.
+
+  Fields are added through numpy views of their VTK arrays, so adding a
+  phase allocates nothing; the scale (e.g. 0.1 for ten phases) is applied
+  once, in place, by finish(). The result is a vtkImageData with spacing and
+  origin of the first field, ready for vtkOrientedGridTransform.
+  """
+  def __init__(self, scale = 1.0):
+    self.scale = scale
+    self.imageData = None
+    self.buffer = None
+    self.count = 0
+    self.inputBytes = 0
+
+  def add(self, imageData):
+    view = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    if self.imageData is None:
+      self.imageData = vtk.vtkImageData()
+      self.imageData.SetDimensions(imageData.GetDimensions())
+      self.imageData.SetSpacing(imageData.GetSpacing())
+      self.imageData.SetOrigin(imageData.GetOrigin())
+      self.imageData.AllocateScalars(vtk.VTK_FLOAT, imageData.GetNumberOfScalarComponents())
+      self.buffer = numpy_support.vtk_to_numpy(self.imageData.GetPointData().GetScalars())
+      self.buffer[:] = 0
+    elif not view.shape == self.buffer.shape:
+      print "Vector field " + str(imageData.GetDimensions()) + " doesn't match " + str(self.imageData.GetDimensions())
+      return False
+    np.add(self.buffer, view, out=self.buffer, casting='unsafe')
+    self.count += 1
+    self.inputBytes = max(self.inputBytes, view.nbytes)
+    return True
+
+  def finish(self):
+    """Applies scale and returns accumulated vtkImageData."""
+    if self.imageData is None:
+      return None
+    if not self.scale == 1.0:
+      self.buffer *= self.scale
+    self.imageData.Modified()
+    return self.imageData
+
+  def report(self):
+    text = "Accumulated " + str(self.count) + " fields in "
+    if self.buffer is not None:
+      text += str(round(self.buffer.nbytes / 1024.**2, 1)) + " MB buffer (largest input " + str(round(self.inputBytes / 1024.**2, 1)) + " MB)"
+    peak = peakMemory()
+    if peak is not None:
+      text += ", peak memory of Slicer " + str(round(peak / 1024.**2, 1)) + " MB"
+    return text + "."
@@ -0,0 +1,81 @@
+import time
+import threading
+import numpy as np
+
+from WarpEngine import interpolate, gridIndices, runSlabs
+
+
+#
+# FieldInverter
+#
+
+class FieldInverter():
+  """Inverts dense displacement fields on a voxel grid.
+
+  For field u the inverse v satisfies v(y) = -u(y + v(y)). It is found by
+  fixed-point iteration over whole slabs at once (u interpolated trilinearly),
+  points leave the iteration as soon as their residual |v + u(y + v)| drops
+  below tolerance. Converges where the field doesn't fold (|grad u| < 1),
+  which holds for breathing motion. Statistics of the last inversion are
+  kept for report().
+  """
+  def __init__(self, tolerance = 0.01, maxIterations = 20, nThreads = None):
+    self.tolerance = tolerance
+    self.maxIterations = maxIterations
+    self.nThreads = nThreads
+    self.clearStatistics()
+
+  def clearStatistics(self):
+    self.statistics = {'points': 0, 'unconverged': 0, 'iterations': 0, 'maxResidual': 0., 'seconds': 0.}
+
+  def invert(self, field, fieldIJKToRAS, dimensions = None, ijkToRAS = None, out = None):
+    """Inverse of field (k, j, i, 3, RAS) as float32 (k, j, i, 3) array.
+    Output grid is dimensions/ijkToRAS (4x4), grid of field if not given.
+    """
+    if dimensions is None:
+      dimensions = [field.shape[2], field.shape[1], field.shape[0]]
+      ijkToRAS = fieldIJKToRAS
+    dimensions = [int(d) for d in dimensions]
+    if out is None:
+      out = np.empty((dimensions[2], dimensions[1], dimensions[0], 3), dtype=np.float32)
+    ijkToRAS = np.asarray(ijkToRAS, dtype=np.float64)
+    rasToFieldIJK = np.linalg.inv(np.asarray(fieldIJKToRAS, dtype=np.float64))
+    # Field is extended beyond its grid by edge values (as in vtkGridTransform), so edge voxels converge too
+    lastIndex = np.array([field.shape[2], field.shape[1], field.shape[0]], dtype=np.float64) - 1
+    self.clearStatistics()
+    lock = threading.Lock()
+    start = time.time()
+
+    def slab(zStart, zEnd):
+      points = np.dot(gridIndices(dimensions, zStart, zEnd), ijkToRAS[0:3, 0:3].T) + ijkToRAS[0:3, 3]
+      inverse = np.zeros(points.shape)
+      residual = np.zeros(points.shape[0])
+      active = np.arange(points.shape[0])
+      iteration = 0
+      while active.size > 0 and iteration < self.maxIterations:
+        iteration += 1
+        cidx = np.dot(points[active] + inverse[active], rasToFieldIJK[0:3, 0:3].T) + rasToFieldIJK[0:3, 3]
+        np.clip(cidx, 0, lastIndex, out=cidx)
+        error = interpolate(field, cidx, 1, 0.) + inverse[active]
+        residual[active] = np.sqrt(np.sum(error**2, axis=1))
+        inverse[active] -= error
+        active = active[residual[active] > self.tolerance]
+      out[zStart:zEnd] = inverse.reshape(zEnd - zStart, dimensions[1], dimensions[0], 3)
+      with lock:
+        self.statistics['points'] += points.shape[0]
+        self.statistics['unconverged'] += active.size
+        self.statistics['iterations'] = max(self.statistics['iterations'], iteration)
+        if residual.size:
+          self.statistics['maxResidual'] = max(self.statistics['maxResidual'], float(residual.max()))
+
+    runSlabs(dimensions[2], slab, self.nThreads)
+    self.statistics['seconds'] = time.time() - start
+    return out
+
+  def report(self):
+    s = self.statistics
+    text = ("Inverted field of " + str(s['points']) + " voxels in " + str(round(s['seconds'], 1)) + " s, " +
+            str(s['iterations']) + " iterations, maximal residual " + str(round(s['maxResidual'], 4)) + " mm")
+    if s['unconverged'] > 0:
+      text += ", " + str(s['unconverged']) + " voxels above tolerance " + str(self.tolerance) + " mm"
+    return text + "."
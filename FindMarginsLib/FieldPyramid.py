@@ -0,0 +1,61 @@
+import numpy as np
+
+# Downsampling factors of coarse levels kept with every stored field
+PYRAMID_LEVELS = [2, 4]
+
+
+def halveIndices(n):
+  """Centre, left and right neighbour (edge repeated) of every second voxel along an axis of n voxels."""
+  center = np.arange(0, n, 2)
+  return center, np.maximum(center - 1, 0), np.minimum(center + 1, n - 1)
+
+
+def halveAxis(array, axis):
+  """Binomial [1 2 1] / 4 smoothing and taking every second voxel along axis."""
+  center, left, right = halveIndices(array.shape[axis])
+  result = np.take(array, center, axis=axis) * np.float32(0.5)
+  result += np.take(array, left, axis=axis) * np.float32(0.25)
+  result += np.take(array, right, axis=axis) * np.float32(0.25)
+  return result
+
+
+def halveField(field, slabSize = 16):
+  """One pyramid step of displacement field (k, j, i, 3); slices are read in slabs, so field may be memory mapped."""
+  n = field.shape[0]
+  center, left, right = halveIndices(n)
+  result = np.empty((center.size,) + field.shape[1:], dtype=np.float32)
+  for start in range(0, center.size, slabSize):
+    end = min(start + slabSize, center.size)
+    first, last = left[start], right[end - 1] + 1
+    block = np.asarray(field[first:last], dtype=np.float32)
+    slab = block[center[start:end] - first] * np.float32(0.5)
+    slab += block[left[start:end] - first] * np.float32(0.25)
+    slab += block[right[start:end] - first] * np.float32(0.25)
+    result[start:end] = slab
+  # Displacements are in mm, so values stay as they are, only the grid gets coarser
+  return halveAxis(halveAxis(result, 1), 2)
+
+
+def levelGrid(dimensions, ijkToRAS, level):
+  """(dimensions, ijkToRAS) of pyramid level (1, 2, 4, ...) of a grid."""
+  dimensions = [int(d) for d in dimensions]
+  matrix = np.array(ijkToRAS, dtype=np.float64)
+  factor = 1
+  while factor < level:
+    dimensions = [(d + 1) // 2 for d in dimensions]
+    matrix[0:3, 0:3] *= 2
+    factor *= 2
+  return dimensions, matrix
+
+
+def downsampleField(field, ijkToRAS, level = 2):
+  """Displacement field (k, j, i, 3) at pyramid level, returns (field, ijkToRAS).
+  Every halving smooths with a binomial kernel first, so coarse levels don't alias.
+  """
+  matrix = np.array(ijkToRAS, dtype=np.float64)
+  factor = 1
+  while factor < level:
+    field = halveField(field)
+    matrix[0:3, 0:3] *= 2
+    factor *= 2
+  return field, matrix
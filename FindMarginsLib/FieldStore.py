@@ -0,0 +1,243 @@
+import os
+import json
+import numpy as np
+
+from FieldPyramid import PYRAMID_LEVELS, downsampleField
+
+# numpy type of stored components for each encoding; NRRD fields written by Slicer are float32
+ENCODINGS = {'float32': np.float32, 'float16': np.float16, 'int16': np.int16}
+
+
+def sourceStamp(fileName):
+  """Identifies the file a field was computed from (name, size and modification time).
+  For a list of files (e.g. field composed from several transforms) all of them are stamped.
+  """
+  if isinstance(fileName, (list, tuple)):
+    return [sourceStamp(name) for name in fileName]
+  if not fileName or not os.path.exists(fileName):
+    return None
+  return {'file': os.path.abspath(fileName), 'size': os.path.getsize(fileName), 'mtime': os.path.getmtime(fileName)}
+
+
+#
+# StoredField
+#
+
+class StoredField():
+  """Displacement field in a FieldStore, memory mapped and decoded on request."""
+  def __init__(self, fileName, header):
+    self.fileName = fileName
+    self.header = header
+    self.dimensions = header['dimensions']
+    self.ijkToRAS = np.array(header['ijkToRAS'])
+    self.scale = header.get('scale', 1.0)
+    self.shape = (self.dimensions[2], self.dimensions[1], self.dimensions[0], 3)
+    self.data = None
+
+  def open(self):
+    if self.data is None:
+      # Only the header is read here, pages are loaded when slabs are accessed
+      self.data = np.load(self.fileName, mmap_mode='r')
+    return self.data
+
+  def slab(self, zStart, zEnd):
+    """Displacements of slices zStart:zEnd as float32 array (z, j, i, 3)."""
+    values = np.asarray(self.open()[zStart:zEnd], dtype=np.float32)
+    if not self.scale == 1.0:
+      values *= self.scale
+    return values
+
+  def __getitem__(self, index):
+    """Decoded slices, so field can be read like an array of slabs (e.g. by downsampleField)."""
+    if not isinstance(index, slice) or index.step not in [None, 1]:
+      return self.array()[index]
+    zStart, zEnd, step = index.indices(self.shape[0])
+    return self.slab(zStart, zEnd)
+
+  def matches(self, dimensions, ijkToRAS):
+    """True if field lies on grid (dimensions, ijkToRAS)."""
+    return self.dimensions == [int(d) for d in dimensions] and np.allclose(self.ijkToRAS, ijkToRAS, atol=1e-3)
+
+  def array(self, out = None, slabSize = 16):
+    """Whole field as float32 (k, j, i, 3), decoded slab by slab into out if given."""
+    data = self.open()
+    if out is None:
+      out = np.empty(data.shape, dtype=np.float32)
+    for zStart in range(0, data.shape[0], slabSize):
+      zEnd = min(zStart + slabSize, data.shape[0])
+      out[zStart:zEnd] = self.slab(zStart, zEnd)
+    return out
+
+  def close(self):
+    self.data = None
+
+
+#
+# FieldStore
+#
+
+class FieldStore():
+  """Directory of displacement fields as .npy files with a JSON sidecar.
+
+  Fields are written slab by slab into a memory mapped .npy file, either as
+  float32, float16 or int16 quantized with a scale factor recorded in the
+  sidecar (maximal quantization error is stored too). int16 takes half the
+  space of a float32 NRRD field. The sidecar also records the transform file
+  the field was computed from, a field is only reused while that file is
+  unchanged. Coarser pyramid levels (2x, 4x, for quick looks) aren't saved
+  with the field; open() builds one from the stored field the first time it
+  is asked for and keeps it, so only levels that are used take disk space.
+  """
+  def __init__(self, directory, encoding = 'int16'):
+    if encoding not in ENCODINGS:
+      print "Unknown field encoding " + str(encoding) + ", using float32."
+      encoding = 'float32'
+    self.directory = directory
+    self.encoding = encoding
+
+  def levelName(self, name, level = 1):
+    if level == 1:
+      return name
+    return name + "_" + str(level) + "x"
+
+  def fileNames(self, name):
+    return os.path.join(self.directory, name + ".npy"), os.path.join(self.directory, name + ".json")
+
+  def readHeader(self, name):
+    dataFile, headerFile = self.fileNames(name)
+    if not os.path.exists(dataFile) or not os.path.exists(headerFile):
+      return None
+    try:
+      with open(headerFile, 'r') as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      print "Can't read " + headerFile
+      return None
+
+  def has(self, name, source = None):
+    header = self.readHeader(name)
+    if header is None:
+      return False
+    return source is None or header.get('source') == sourceStamp(source)
+
+  def open(self, name, source = None, level = 1):
+    """Returns StoredField or None, if there's no field (computed from unchanged source)."""
+    levelName = self.levelName(name, level)
+    if not self.has(levelName, source):
+      if level == 1 or not self.has(name, source):
+        return None
+      self.saveLevel(name, source, level)
+    return StoredField(self.fileNames(levelName)[0], self.readHeader(levelName))
+
+  def saveLevel(self, name, source, level):
+    """Builds pyramid level of stored field; the field is read slab by slab from its memory map."""
+    field = self.open(name, source)
+    levelField, matrix = downsampleField(field, field.ijkToRAS, level)
+    field.close()
+    return self.save(self.levelName(name, level), levelField, matrix, source)
+
+  def save(self, name, field, ijkToRAS, source = None, slabSize = 16, levels = []):
+    """Stores field (k, j, i, 3 array, e.g. slicer.util.array of a vector volume) and given pyramid levels."""
+    if not os.path.exists(self.directory):
+      os.makedirs(self.directory)
+    dataFile, headerFile = self.fileNames(name)
+    # Levels of an older field would be reused while its source didn't change
+    for level in PYRAMID_LEVELS:
+      if level not in levels:
+        for fileName in self.fileNames(self.levelName(name, level)):
+          if os.path.exists(fileName):
+            os.remove(fileName)
+    header = {}
+    header['dimensions'] = [int(field.shape[2]), int(field.shape[1]), int(field.shape[0])]
+    header['ijkToRAS'] = np.asarray(ijkToRAS, dtype=np.float64).tolist()
+    header['encoding'] = self.encoding
+    header['scale'] = 1.0
+    header['maxError'] = 0.0
+    if not self.encoding == 'float32':
+      maxValue = 0.
+      for zStart in range(0, field.shape[0], slabSize):
+        maxValue = max(maxValue, float(np.abs(field[zStart:zStart + slabSize]).max()))
+      if self.encoding == 'int16':
+        header['scale'] = maxValue / 32767. if maxValue > 0 else 1.0
+        # Rounding to integers plus float32 rounding when encoding and decoding
+        header['maxError'] = header['scale'] / 2. + maxValue * 2**-22
+      else:
+        # float16 has 11 significant bits
+        header['maxError'] = maxValue * 2**-11
+    header['source'] = sourceStamp(source)
+
+    # Header is written last, so an interrupted save leaves no usable field
+    if os.path.exists(headerFile):
+      os.remove(headerFile)
+    data = np.lib.format.open_memmap(dataFile, mode='w+', dtype=ENCODINGS[self.encoding], shape=field.shape)
+    for zStart in range(0, field.shape[0], slabSize):
+      values = field[zStart:zStart + slabSize]
+      if self.encoding == 'int16':
+        data[zStart:zStart + slabSize] = np.round(values / header['scale'])
+      else:
+        data[zStart:zStart + slabSize] = values
+    data.flush()
+    del data
+    with open(headerFile, 'w') as f:
+      json.dump(header, f, indent=1, sort_keys=True)
+
+    # Each level is made from the previous one, the full field is read only once
+    previous, matrix, previousLevel = field, ijkToRAS, 1
+    for level in sorted(levels):
+      previous, matrix = downsampleField(previous, matrix, level // previousLevel)
+      previousLevel = level
+      self.save(self.levelName(name, level), previous, matrix, source, slabSize, [])
+    return True
+
+  def remove(self, name):
+    for level in [1] + PYRAMID_LEVELS:
+      for fileName in self.fileNames(self.levelName(name, level)):
+        if os.path.exists(fileName):
+          os.remove(fileName)
+
+  def size(self):
+    total = 0
+    if not os.path.exists(self.directory):
+      return 0
+    for fileName in os.listdir(self.directory):
+      total += os.path.getsize(os.path.join(self.directory, fileName))
+    return total
+
+
+def createVectorVolume(field, name):
+  """Vector volume node from StoredField, decoded slab by slab into the node's image data."""
+  from __main__ import vtk
+  from vtk.util import numpy_support
+  dimensions = field.dimensions
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(dimensions)
+  imageData.AllocateScalars(vtk.VTK_FLOAT, 3)
+  array = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+  field.array(array.reshape(dimensions[2], dimensions[1], dimensions[0], 3))
+  field.close()
+  return vectorVolumeNode(imageData, field.ijkToRAS, name)
+
+
+def vectorVolumeFromArray(field, ijkToRAS, name):
+  """Vector volume node from displacement array (k, j, i, 3) on grid ijkToRAS."""
+  from __main__ import vtk
+  from vtk.util import numpy_support
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(field.shape[2], field.shape[1], field.shape[0])
+  imageData.AllocateScalars(vtk.VTK_FLOAT, 3)
+  numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())[:] = field.reshape(-1, 3)
+  return vectorVolumeNode(imageData, ijkToRAS, name)
+
+
+def vectorVolumeNode(imageData, ijkToRAS, name):
+  from __main__ import vtk, slicer
+  matrix = vtk.vtkMatrix4x4()
+  for i in range(4):
+    for j in range(4):
+      matrix.SetElement(i, j, ijkToRAS[i][j])
+  node = slicer.vtkMRMLVectorVolumeNode()
+  node.SetName(name)
+  node.SetIJKToRASMatrix(matrix)
+  node.SetAndObserveImageData(imageData)
+  slicer.mrmlScene.AddNode(node)
+  return node
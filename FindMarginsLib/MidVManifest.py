@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+
+from NrrdFile import NRRD_TYPES, readNrrdHeader, nrrdGeometry
+
+MANIFEST_VERSION = 1
+
+
+def manifestFileName(fileName):
+  return os.path.splitext(fileName)[0] + ".json"
+
+
+def fileHash(fileName):
+  sha = hashlib.sha1()
+  with open(fileName, 'rb') as f:
+    for block in iter(lambda: f.read(1024 * 1024), b''):
+      sha.update(block)
+  return sha.hexdigest()
+
+
+def transformRecord(fileName, previous = None):
+  """Size, modification time and hash of a transform file; hash of previous record is reused while size and time match."""
+  if not os.path.exists(fileName):
+    return None
+  record = {'file': os.path.basename(fileName), 'size': os.path.getsize(fileName), 'mtime': os.path.getmtime(fileName)}
+  if previous is not None and previous.get('size') == record['size'] and previous.get('mtime') == record['mtime']:
+    record['sha1'] = previous.get('sha1')
+  else:
+    record['sha1'] = fileHash(fileName)
+  return record
+
+
+#
+# MidVManifest
+#
+
+class MidVManifest():
+  """Sidecar JSON of a midV NRRD recording what it was made from.
+
+  Holds reference phase, series UIDs of the CTs, size, modification time and
+  SHA-1 of every registration file and the geometry of the NRRD. check()
+  compares that with the current inputs and the NRRD header only, transform
+  files are hashed again only when their size or time changed (e.g. restored
+  from registration cache), so an up to date midV is confirmed without
+  loading any voxels.
+  """
+  def __init__(self, fileName):
+    self.fileName = fileName
+    self.manifestFile = manifestFileName(fileName)
+
+  def read(self):
+    if not os.path.exists(self.manifestFile):
+      return None
+    try:
+      with open(self.manifestFile, 'r') as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      print "Can't read " + self.manifestFile
+      return None
+
+  def write(self, refPhase, seriesUIDs, transformFiles, method = "", region = None):
+    header = readNrrdHeader(self.fileName)
+    geometry = nrrdGeometry(header) if header is not None else None
+    if geometry is None:
+      print "Can't read geometry of " + self.fileName
+      return False
+    manifest = {}
+    manifest['version'] = MANIFEST_VERSION
+    manifest['refPhase'] = refPhase
+    manifest['method'] = method
+    manifest['region'] = region # RegionOfInterest.record() of midV made in target region only
+    manifest['created'] = time.strftime("%Y-%m-%d %H:%M:%S")
+    manifest['series'] = seriesUIDs
+    manifest['transforms'] = [transformRecord(fileName) for fileName in transformFiles]
+    manifest['dimensions'] = geometry[0]
+    manifest['ijkToRAS'] = geometry[1].tolist()
+    manifest['type'] = header.get('type', "")
+    with open(self.manifestFile, 'w') as f:
+      json.dump(manifest, f, indent=1, sort_keys=True)
+    return True
+
+  def check(self, refPhase, seriesUIDs, transformFiles, dimensions = None, ijkToRAS = None, region = None):
+    """Returns "" if midV is up to date, otherwise the reason it's stale.
+    Geometry is also compared with dimensions/ijkToRAS (e.g. of a loaded reference CT), when given.
+    region is the record of the target region a midV is requested for, None for full midV.
+    """
+    if not os.path.exists(self.fileName):
+      return "no file " + self.fileName
+    manifest = self.read()
+    if manifest is None:
+      return "no manifest"
+    if not manifest.get('version') == MANIFEST_VERSION:
+      return "manifest version " + str(manifest.get('version'))
+    if not manifest.get('refPhase') == refPhase:
+      return "made for reference phase " + str(manifest.get('refPhase'))
+    if not manifest.get('series') == seriesUIDs:
+      return "CT series changed"
+    if not manifest.get('region') == region:
+      return "made for target region only" if region is None else "made for other target region"
+
+    records = manifest.get('transforms', [])
+    if not len(records) == len(transformFiles):
+      return "number of registrations changed"
+    for record, fileName in zip(records, transformFiles):
+      if record is None or not record.get('file') == os.path.basename(fileName):
+        return "registration " + os.path.basename(fileName) + " wasn't used"
+      current = transformRecord(fileName, record)
+      if current is None:
+        return "registration " + os.path.basename(fileName) + " is missing"
+      if not current['sha1'] == record.get('sha1'):
+        return "registration " + os.path.basename(fileName) + " changed"
+
+    header = readNrrdHeader(self.fileName)
+    geometry = nrrdGeometry(header) if header is not None else None
+    if geometry is None:
+      return "unreadable header"
+    if not geometry[0] == manifest.get('dimensions') or not np.allclose(geometry[1], manifest.get('ijkToRAS'), atol=1e-3):
+      return "geometry of file differs from manifest"
+    if dimensions is not None and not list(geometry[0]) == [int(d) for d in dimensions]:
+      return "dimensions differ from reference CT"
+    if ijkToRAS is not None and not np.allclose(geometry[1], ijkToRAS, atol=1e-3):
+      return "position differs from reference CT"
+    scalarTypes = dict([(nrrdType, name) for name, nrrdType in NRRD_TYPES.items()])
+    if header.get('encoding') == "raw" and header.get('type') in scalarTypes:
+      size = header['data offset'] + int(np.prod(geometry[0])) * np.dtype(scalarTypes[header['type']]).itemsize
+      if os.path.getsize(self.fileName) < size:
+        return "file is truncated"
+    return ""
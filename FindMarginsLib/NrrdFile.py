@@ -0,0 +1,139 @@
+import sys
+import numpy as np
+
+from BsplineTransform import LPS_TO_RAS
+
+# NRRD type names of numpy scalar types
+NRRD_TYPES = {'int8': 'signed char', 'uint8': 'uchar', 'int16': 'short', 'uint16': 'ushort',
+              'int32': 'int', 'uint32': 'uint', 'float32': 'float', 'float64': 'double'}
+
+
+def formatVector(vector):
+  return "(" + ",".join([repr(float(value) + 0.) for value in vector]) + ")"
+
+
+#
+# NrrdWriter
+#
+
+class NrrdWriter():
+  """Writes a scalar volume into a raw NRRD file slab by slab.
+
+  The header (geometry from a 4x4 ijkToRAS) is written on open, slabs of
+  slices must then be written in order of increasing k. Only the slab being
+  written has to be in memory.
+  """
+  def __init__(self, fileName, dimensions, ijkToRAS, dtype = np.int16):
+    self.fileName = fileName
+    self.dimensions = [int(d) for d in dimensions]
+    self.ijkToRAS = np.asarray(ijkToRAS, dtype=np.float64)
+    self.dtype = np.dtype(dtype)
+    self.file = None
+    self.slices = 0
+
+  def open(self):
+    if self.dtype.name not in NRRD_TYPES:
+      print "Can't write " + self.dtype.name + " to NRRD."
+      return False
+    ijkToLPS = self.ijkToRAS[0:3] * LPS_TO_RAS[:, np.newaxis]
+    header = ["NRRD0004",
+              "type: " + NRRD_TYPES[self.dtype.name],
+              "dimension: 3",
+              "space: left-posterior-superior",
+              "sizes: " + " ".join([str(d) for d in self.dimensions]),
+              "space directions: " + " ".join([formatVector(ijkToLPS[:, axis]) for axis in range(3)]),
+              "kinds: domain domain domain",
+              "endian: " + ("little" if sys.byteorder == "little" else "big"),
+              "encoding: raw",
+              "space origin: " + formatVector(ijkToLPS[:, 3])]
+    self.file = open(self.fileName, 'wb')
+    self.file.write("\n".join(header) + "\n\n")
+    self.slices = 0
+    return True
+
+  def writeSlab(self, slab):
+    """Writes slices (z, j, i) following the ones written before, converted (and rounded) to volume type."""
+    if np.issubdtype(self.dtype, np.integer) and not np.issubdtype(slab.dtype, np.integer):
+      info = np.iinfo(self.dtype)
+      slab = np.clip(np.round(slab), info.min, info.max)
+    np.ascontiguousarray(slab, dtype=self.dtype).tofile(self.file)
+    self.slices += slab.shape[0]
+
+  def close(self):
+    if self.file is None:
+      return True
+    self.file.close()
+    self.file = None
+    if not self.slices == self.dimensions[2]:
+      print "Only " + str(self.slices) + " of " + str(self.dimensions[2]) + " slices written to " + self.fileName
+      return False
+    return True
+
+
+def readNrrdHeader(fileName, maxBytes = 64 * 1024):
+  """Fields of NRRD header (lower case keys) without reading voxel data, None if file isn't NRRD."""
+  header = {}
+  try:
+    with open(fileName, 'rb') as f:
+      if not f.readline().startswith("NRRD"):
+        print fileName + " isn't a NRRD file."
+        return None
+      while f.tell() < maxBytes:
+        line = f.readline()
+        if not line or not line.strip():
+          break
+        if line.startswith("#") or ":" not in line:
+          continue
+        # Key/value pairs (key:=value) are kept too
+        key, value = line.split(":", 1)
+        header[key.strip().lower()] = value.lstrip("=").strip()
+      header['data offset'] = f.tell()
+  except IOError:
+    print "Can't read " + fileName
+    return None
+  return header
+
+
+def parseVector(text):
+  return [float(value) for value in text.strip().strip("()").split(",")]
+
+
+def nrrdGeometry(header):
+  """(dimensions, 4x4 ijkToRAS) of scalar volume header, None if it isn't a 3D volume with space directions."""
+  try:
+    dimensions = [int(value) for value in header['sizes'].split()]
+    directions = [text for text in header['space directions'].split() if not text == "none"]
+    origin = parseVector(header.get('space origin', "(0,0,0)"))
+  except (KeyError, ValueError):
+    return None
+  if not len(dimensions) == 3 or not len(directions) == 3:
+    return None
+  ijkToRAS = np.eye(4)
+  for axis in range(3):
+    ijkToRAS[0:3, axis] = parseVector(directions[axis])
+  ijkToRAS[0:3, 3] = origin
+  if header.get('space', "left-posterior-superior") in ["left-posterior-superior", "LPS"]:
+    ijkToRAS[0:3] *= LPS_TO_RAS[:, np.newaxis]
+  return dimensions, ijkToRAS
+
+
+def readNrrdArray(fileName):
+  """(array (k, j, i), dimensions, ijkToRAS) of raw scalar NRRD, memory mapped read only; None if it can't be mapped."""
+  header = readNrrdHeader(fileName)
+  geometry = nrrdGeometry(header) if header is not None else None
+  if geometry is None:
+    return None
+  scalarTypes = dict([(nrrdType, name) for name, nrrdType in NRRD_TYPES.items()])
+  if not header.get('encoding') == "raw" or header.get('type') not in scalarTypes or 'data file' in header:
+    print "Only raw NRRD with data in the same file can be mapped: " + fileName
+    return None
+  dtype = np.dtype(scalarTypes[header['type']])
+  if dtype.itemsize > 1:
+    dtype = dtype.newbyteorder('<' if header.get('endian', sys.byteorder) == "little" else '>')
+  dimensions = geometry[0]
+  try:
+    array = np.memmap(fileName, dtype=dtype, mode='r', offset=header['data offset'], shape=(dimensions[2], dimensions[1], dimensions[0]))
+  except (IOError, ValueError):
+    print "Can't map " + fileName
+    return None
+  return array, dimensions, geometry[1]
@@ -5,6 +5,12 @@ import math
 
 import threading
 import RegistrationHierarchy
+from BsplineTransform import BsplineTransform, volumeGeometry
+import FieldStore
+from FieldPyramid import downsampleField, levelGrid
+from MidVManifest import MidVManifest
+from AmplitudeMaps import AmplitudeMaps, amplitudeMapFiles
+from TransformCache import TransformCache
 
 
 class Patient():
@@ -26,6 +32,13 @@ class Patient():
     self.ptvMargins = [0, 0, 0]
     self.linearTransform = None #Matrix for transforming contour to new axis of motion
     self.planUid = ""
+    self.registrationCache = None
+    self.stagePlanner = None
+    self.volumeCache = None
+    self.transformCache = TransformCache() # Registrations read in this session, shared by all stages
+    self.fieldEncoding = None # int16, float16 or float32 keeps vector fields in FieldStore
+    self.structureMotion = None # StructureMotion of all structures from calculateStructureMotion
+    self.amplitudeMaps = None # AmplitudeMaps of reference phase, read from patient directory
     # self.maxminAmplitudes = [[0, 0, 0], [0, 0, 0]]
 
   class dicom():
@@ -36,6 +49,7 @@ class Patient():
       self.node = None
       self.transform = None
       self.contour = None
+      self.points = None # Propagated contour points (N x 3, RAS) without contour node
       self.vectorField = None
       self.origin = [0, 0, 0]
       self.relOrigin = [0, 0, 0]
@@ -43,6 +57,12 @@ class Patient():
       self.dicomParameters = {}
 
   def loadDicom(self, position):
+    #Volume loaded before is taken from cache without parsing DICOM
+    if self.fourDCT[position].node is None and self.volumeCache is not None:
+      self.fourDCT[position].node = self.volumeCache.get(self.fourDCT[position].uid)
+      if self.fourDCT[position].node is not None:
+        return True
+
     dicomWidget = slicer.modules.dicom.widgetRepresentation().self()
     print "  LoadDicom position", position, self.fourDCT[position].node, self.findNode(position)
     if not self.fourDCT[position].node == None or self.findNode(position):
@@ -62,8 +82,32 @@ class Patient():
     if not self.findNode(position):
         print "Can't find CT Node"
         return False
+    if self.volumeCache is not None:
+      self.volumeCache.put(self.fourDCT[position].uid, self.fourDCT[position].node)
     return True
 
+  def releaseDicom(self, position, modified = False):
+    """Hands CT back to volume cache, or removes it from scene without cache.
+    Use modified, when the volume was changed (e.g. transform hardened).
+    """
+    node = self.fourDCT[position].node
+    if node is None:
+      return
+    self.fourDCT[position].node = None
+    uid = self.fourDCT[position].uid
+    if self.volumeCache is not None and self.volumeCache.uidOf(node) == uid:
+      self.volumeCache.release(uid, modified)
+      return
+    slicer.mrmlScene.RemoveNode(node)
+
+  def pinDicom(self, position):
+    if self.volumeCache is not None:
+      self.volumeCache.pin(self.fourDCT[position].uid)
+
+  def unpinDicom(self, position):
+    if self.volumeCache is not None:
+      self.volumeCache.unpin(self.fourDCT[position].uid)
+
   def loadStructureSet(self):
     dicomWidget = slicer.modules.dicom.widgetRepresentation().self()
 
@@ -80,7 +124,18 @@ class Patient():
     if self.midVentilation.node is not None:
       return True
 
-    fileName = self.patientDir + "/" + self.ID + "_midV_ref" + str(position) + ".nrrd"
+    fileName = self.midVFileName(position)
+    if not os.path.exists(fileName):
+      print "Can't find mid Ventilation on disk (" + fileName + ")"
+      return False
+    #Stale midV isn't loaded, so it's created again
+    reason = self.checkMidV(position)
+    if reason == "no manifest":
+      print "Mid ventilation " + fileName + " has no manifest, it can't be validated."
+    elif reason:
+      print "Mid ventilation is out of date (" + reason + ")"
+      return False
+
     success, midV = slicer.util.loadVolume(fileName, properties = {'name' : self.ID + "_midV_ref" + str(position)}, returnNode=True)
     if not success:
       print "Can't load mid Ventilation from disk (" + fileName + ")"
@@ -89,7 +144,68 @@ class Patient():
     self.midVentilation.node = midV
     return True
 
-  def exportMidV(self):
+  def midVFileName(self, position, suffix = ""):
+    return self.patientDir + "/" + self.ID + "_midV_ref" + str(position) + suffix + ".nrrd"
+
+  def midVInputs(self, position):
+    """Series UIDs and B-spline files midV of reference position (10 is planning CT) is made from."""
+    if position == 10:
+      moving = "Plan"
+      references = range(0, 10)
+    else:
+      moving = str(position) + "0"
+      references = [i for i in range(0, 10) if not i == position]
+    seriesUIDs = {}
+    for i in range(0, 10):
+      seriesUIDs[str(i) + "0"] = self.fourDCT[i].uid
+    if position == 10:
+      seriesUIDs["Plan"] = self.fourDCT[10].uid
+    transformFiles = [self.vectorDir + self.ID + "_" + moving + "to" + str(i) + "0_bs.txt" for i in references]
+    return seriesUIDs, transformFiles
+
+  def checkMidV(self, position):
+    """Returns "" if midV on disk is up to date, otherwise the reason. Only headers and the manifest are read."""
+    seriesUIDs, transformFiles = self.midVInputs(position)
+    dimensions, ijkToRAS = None, None
+    if self.fourDCT[position].node is not None:
+      dimensions, ijkToRAS = volumeGeometry(self.fourDCT[position].node)
+    return MidVManifest(self.midVFileName(position)).check(position, seriesUIDs, transformFiles, dimensions, ijkToRAS)
+
+  def saveMidVManifest(self, position, method = "", suffix = "", region = None):
+    seriesUIDs, transformFiles = self.midVInputs(position)
+    return MidVManifest(self.midVFileName(position, suffix)).write(position, seriesUIDs, transformFiles, method, region)
+
+  def amplitudeMapPrefix(self, position):
+    return self.patientDir + "/" + self.ID + "_amplitude_ref" + str(position)
+
+  def getAmplitudeMaps(self, position):
+    """AmplitudeMaps of reference position, None if they don't exist or were made from other registrations."""
+    prefix = self.amplitudeMapPrefix(position)
+    maps = AmplitudeMaps(prefix)
+    if not maps.exists():
+      return None
+    #Maps come from the same registrations as midV, so the manifest of midV is used for them.
+    #They are always written with manifest, maps without one are stale
+    seriesUIDs, transformFiles = self.midVInputs(position)
+    reason = MidVManifest(amplitudeMapFiles(prefix)[0]).check(position, seriesUIDs, transformFiles)
+    if reason:
+      print "Amplitude maps are out of date (" + reason + ")"
+      self.amplitudeMaps = None
+      return None
+    if self.amplitudeMaps is not None and self.amplitudeMaps.prefix == prefix:
+      return self.amplitudeMaps
+    if not maps.read():
+      return None
+    self.amplitudeMaps = maps
+    return maps
+
+  def saveAmplitudeMapsManifest(self, position):
+    self.amplitudeMaps = None
+    seriesUIDs, transformFiles = self.midVInputs(position)
+    return MidVManifest(amplitudeMapFiles(self.amplitudeMapPrefix(position))[0]).write(position, seriesUIDs, transformFiles, "amplitude maps")
+
+  def exportMidV(self, wait_for_completion = True):
+    # Without wait_for_completion the DICOM export CLI node is returned right after launch
     if self.midVentilation.node is None:
       print "Load mid Ventilation first."
       return False
@@ -102,11 +218,12 @@ class Patient():
     self.midVentilation.directory = directory
 
     #Create Parameters and export dicom
-    if not self.createDicom(self.midVentilation, "midVentilation"):
+    result = self.createDicom(self.midVentilation, "midVentilation", wait_for_completion)
+    if not result:
       print "Can't create Dicom series"
       return False
 
-    return True
+    return result
 
   def createPlanParameters(self):
     self.regParameters = None
@@ -116,6 +233,7 @@ class Patient():
     self.regParameters.referenceNumber = str(self.refPhase) + "0"
     self.regParameters.bsplineOn = True
     self.regParameters.stageThreeOn = True
+    self.setRegistrationOptions()
 
   def create4DParameters(self):
     self.regParameters = None
@@ -123,18 +241,34 @@ class Patient():
     self.regParameters.movingNumber = str(self.refPhase) + "0"
     self.regParameters.vectorDirectory = self.vectorDir
     self.regParameters.bsplineOn = True
+    self.setRegistrationOptions()
+
+  def setRegistrationOptions(self):
+    #Series UIDs under the names used as moving/reference number
+    self.regParameters.seriesUIDs = {}
+    self.regParameters.seriesUIDs["Plan"] = self.fourDCT[10].uid
+    for i in range(0, 10):
+      self.regParameters.seriesUIDs[str(i) + "0"] = self.fourDCT[i].uid
+    self.regParameters.cache = self.registrationCache
+    self.regParameters.stagePlanner = self.stagePlanner
 
   def getTransform(self,position):
     if self.regParameters == None:
       print "No parameters have been set."
       return False
     bsplineName = self.regParameters.checkBspline()
-    bspline = slicer.util.getNode(bsplineName)
+    fileName = self.regParameters.bspline_F_name
+    key = self.transformKey()
+    #Node stays in scene for next use, transform cache removes it
+    bspline = self.transformCache.get(key, 'node', fileName)
     if bspline is None:
-      success, bspline = slicer.util.loadTransform(self.regParameters.bspline_F_name, returnNode=True)
-      if not success:
-        print "Can't load " + self.regParameters.bspline_F_name
-        return False
+      bspline = slicer.util.getNode(bsplineName)
+      if bspline is None:
+        success, bspline = slicer.util.loadTransform(fileName, returnNode=True)
+        if not success:
+          print "Can't load " + fileName
+          return False
+      self.transformCache.put(key, 'node', fileName, bspline)
 
     if position == 11:
       self.midVentilation.transform = bspline
@@ -142,8 +276,39 @@ class Patient():
       self.fourDCT[position].transform = bspline
     return True
 
-  def getVectorField(self, position, saveVectorField = False):
+  def getBspline(self):
+    """Registration result of current regParameters as numpy evaluator, without MRML transform node."""
+    if self.regParameters == None:
+      print "No parameters have been set."
+      return None
+    if not self.regParameters.checkBspline():
+      print "Can't find " + self.regParameters.bspline_F_name
+      return None
+    fileName = self.regParameters.bspline_F_name
+    key = self.transformKey()
+    bspline = self.transformCache.get(key, 'bspline', fileName)
+    if bspline is not None:
+      return bspline
+    bspline = BsplineTransform()
+    if not bspline.read(fileName):
+      return None
+    self.transformCache.put(key, 'bspline', fileName, bspline)
+    return bspline
+
+  def transformKey(self):
+    """(moving, reference, parameters) of current regParameters, after checkBspline."""
+    parameters = self.regParameters.cacheKey() or self.regParameters.bspline_F_name
+    return (self.regParameters.movingNumber, self.regParameters.referenceNumber, parameters)
+
+  def getVectorField(self, position, saveVectorField = False, roi = None, level = 1):
       #saveVectorField is turned off, because it takes up a lot of disk space (cca 1 GB per patient)
+      #With roi (RegionOfInterest) the field is computed only on the part of the CT grid inside it
+      #level 2 or 4 gives coarser pyramid level of the field (for quick looks)
+
+      if roi is not None:
+        return self.getVectorFieldInRegion(position, roi, level)
+      if level > 1:
+        return self.getVectorFieldAtLevel(position, level)
 
       transformLogic = slicer.modules.transforms.logic()
 
@@ -159,6 +324,15 @@ class Patient():
             vf = self.findVectorNode(vfName)
 
       else:
+          #Field computed before from the same B-spline is mapped from the store
+          fieldStore = self.getFieldStore()
+          fieldName = os.path.splitext(os.path.basename(self.regParameters.vf_F_name))[0]
+          if fieldStore is not None and self.regParameters.checkBspline():
+            storedField = fieldStore.open(fieldName, self.regParameters.bspline_F_name)
+            if storedField is not None:
+              self.fourDCT[position].vectorField = FieldStore.createVectorVolume(storedField, fieldName)
+              return True
+
           if self.fourDCT[position].node is None:
             if not self.loadDicom(position):
               print "Can't load phase" + str(position) + "0%"
@@ -173,11 +347,10 @@ class Patient():
           if vf is not None:
               if saveVectorField:
                 slicer.util.saveNode(vf,self.regParameters.vf_F_name)
-              slicer.mrmlScene.RemoveNode(node)
-              slicer.mrmlScene.RemoveNode(transform)
-
+              if fieldStore is not None:
+                fieldStore.save(fieldName, slicer.util.array(vf.GetID()), volumeGeometry(vf)[1], self.regParameters.bspline_F_name)
+              self.releaseDicom(position)
               self.fourDCT[position].transform = None
-              self.fourDCT[position].node = None
           else:
               print "Can't generate vf."
               return False
@@ -185,6 +358,63 @@ class Patient():
       self.fourDCT[position].vectorField = vf
       return True
 
+  def getVectorFieldAtLevel(self, position, level):
+    fieldStore = self.getFieldStore()
+    self.regParameters.checkVf()
+    fieldName = os.path.splitext(os.path.basename(self.regParameters.vf_F_name))[0]
+    if fieldStore is not None and self.regParameters.checkBspline():
+      storedField = fieldStore.open(fieldName, self.regParameters.bspline_F_name, level)
+      if storedField is not None:
+        self.fourDCT[position].vectorField = FieldStore.createVectorVolume(storedField, fieldStore.levelName(fieldName, level))
+        return True
+
+    #Level is made from full resolution field (which also stores all levels, if store is on)
+    if not self.getVectorField(position):
+      return False
+    vf = self.fourDCT[position].vectorField
+    field, ijkToRAS = downsampleField(slicer.util.array(vf.GetID()), volumeGeometry(vf)[1], level)
+    name = vf.GetName() + "_" + str(level) + "x"
+    slicer.mrmlScene.RemoveNode(vf)
+    self.fourDCT[position].vectorField = FieldStore.vectorVolumeFromArray(field, ijkToRAS, name)
+    return True
+
+  def getVectorFieldInRegion(self, position, roi, level = 1):
+    if self.fourDCT[position].node is None:
+      if not self.loadDicom(position):
+        print "Can't load phase" + str(position) + "0%"
+        return False
+    dimensions, ijkToRAS = volumeGeometry(self.fourDCT[position].node)
+    self.releaseDicom(position)
+    dimensions, ijkToRAS = levelGrid(dimensions, ijkToRAS, level)
+    subGrid = roi.subGrid(dimensions, ijkToRAS)
+    if subGrid is None:
+      print "Region of interest is outside of phase " + str(position) + "0%"
+      return False
+    bspline = self.getBspline()
+    if bspline is None:
+      return False
+
+    start, cropDimensions, cropIJKToRAS = subGrid
+    field = bspline.gridDisplacement(cropDimensions, cropIJKToRAS, True)
+    name = self.ID + "_" + self.regParameters.movingNumber + "to" + self.regParameters.referenceNumber + "_vf_roi"
+    if level > 1:
+      name += "_" + str(level) + "x"
+    self.fourDCT[position].vectorField = FieldStore.vectorVolumeFromArray(field, cropIJKToRAS, name)
+    return True
+
+  def getFieldStore(self):
+    if self.fieldEncoding is None:
+      return None
+    return FieldStore.FieldStore(os.path.join(self.vectorDir, "fields"), self.fieldEncoding)
+
+  def phaseFieldName(self, position):
+    """Name of ToParent field of phase to reference registration in field store."""
+    return self.ID + "_" + str(position) + "0to" + str(self.refPhase) + "0_toParent"
+
+  def midVFieldName(self, position):
+    """Name of composed phase to midV field in field store."""
+    return self.ID + "_" + str(position) + "0toMidV_ref" + str(self.refPhase)
+
   def findNode(self, position):
     if position == 0:
       string = " 0.0%"
@@ -196,6 +426,9 @@ class Patient():
     print "findNode", position, nodes
     for node in nodes:
       if node.find(string) > -1:
+        #Cached volumes of other series can have the same name
+        if self.volumeCache is not None and self.volumeCache.uidOf(nodes[node]) not in [None, self.fourDCT[position].uid]:
+          continue
         self.fourDCT[position].node = nodes[node]
         return True
 
@@ -220,7 +453,7 @@ class Patient():
       self.ptvMargins[i] = 2.1 * SSigma + 0.8 * math.sqrt(Rsigma*Rsigma + (self.amplitudes[i]/3)*(self.amplitudes[i]/3))
     return True
 
-  def createDicom(self, dicomClass, studyDescription):
+  def createDicom(self, dicomClass, studyDescription, wait_for_completion = True):
     if len(dicomClass.directory) == 0:
       print "No directory for DICOM export."
       return False
@@ -233,7 +466,9 @@ class Patient():
     dicomClass.dicomParameters["dicomPrefix"] = self.ID
 
     dicomSeries = slicer.modules.createdicomseries
-    slicer.cli.run(dicomSeries, None, dicomClass.dicomParameters, wait_for_completion=True)
+    cliNode = slicer.cli.run(dicomSeries, None, dicomClass.dicomParameters, wait_for_completion=wait_for_completion)
+    if not wait_for_completion:
+      return cliNode
     return True
 
   class myThread (threading.Thread):
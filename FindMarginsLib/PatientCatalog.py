@@ -0,0 +1,308 @@
+import os
+import json
+import sqlite3
+
+from Patient import Patient
+
+#
+# PatientCatalog
+#
+
+# Single query that reads every tag needed for classification straight from
+# the ctkDICOMDatabase tables, instead of one instanceValue call per tag and series.
+SERIES_QUERY = """
+SELECT Patients.UID, Patients.PatientID, Patients.PatientsName,
+       Studies.StudyDescription,
+       Series.SeriesInstanceUID, Series.SeriesDescription, Series.Modality,
+       MIN(Images.Filename), COUNT(Images.Filename)
+FROM Series
+JOIN Studies ON Series.StudyInstanceUID = Studies.StudyInstanceUID
+JOIN Patients ON Studies.PatientsUID = Patients.UID
+JOIN Images ON Images.SeriesInstanceUID = Series.SeriesInstanceUID
+GROUP BY Series.SeriesInstanceUID
+ORDER BY Patients.UID, Studies.StudyInstanceUID, Series.SeriesInstanceUID
+"""
+
+CATALOG_VERSION = 1
+
+
+def classifySeries(seriesDescription, studyDescription, modality):
+  """Returns the role of a series in a 4DCT patient: planning CT, structure set or 4D phase."""
+  role = {'plan': False, 'structureSet': False, 'phase': None, 'fourD': False}
+  if studyDescription.upper().find('PLAN') > -1 and studyDescription.upper().find('REPLAN') <= -1 and modality == "CT" and seriesDescription.find('%') <= -1:
+    role['plan'] = True
+
+  if seriesDescription.find('Structure Sets') > -1:
+    role['structureSet'] = True
+
+  if seriesDescription.find('%') > -1:        # phase of 4D scan
+    role['fourD'] = True
+    for i in range(0, 100, 10):
+      tmpName = str(i) + ".0%"
+      if seriesDescription.find(tmpName) > -1:
+        #Special case for 0.0%
+        if i == 0:
+          position = seriesDescription.find(tmpName)
+          try:
+            int(seriesDescription[position-1])
+            continue
+          except ValueError:
+            if seriesDescription.find(" " + tmpName) < 0 and not seriesDescription == tmpName:
+              continue
+        role['phase'] = i/10
+  return role
+
+
+class PatientCatalog():
+  """On-disk index of classified DICOM series, keyed by series UID.
+
+  The index is stored next to the DICOM database together with the database
+  modification time. When the database didn't change, patients are built from
+  the index alone; otherwise only new or changed series are classified again.
+  """
+  def __init__(self, dicomDatabase, tags = None, indexFile = None):
+    self.dicomDatabase = dicomDatabase
+    self.tags = tags
+    if self.tags is None:
+      self.tags = {}
+      self.tags['seriesDescription'] = "0008,103e"
+      self.tags['patientName'] = "0010,0010"
+      self.tags['patientID'] = "0010,0020"
+      self.tags['studyDescription'] = "0008,1030"
+      self.tags['modality'] = "0008,0060"
+
+    self.databaseFile = dicomDatabase.databaseFilename
+    if indexFile is None:
+      indexFile = os.path.join(os.path.dirname(self.databaseFile), "FindMarginsCatalog.json")
+    self.indexFile = indexFile
+    self.series = {}
+    self.order = []
+    self.byPatient = {} # patientKey -> series UIDs in order
+    self.patientOrder = []
+    self.databaseModified = None
+    self.reclassified = 0
+    self.previous = {} # series of old index, reused for unchanged series
+    self.pending = set() # patients whose series are read, but not classified yet
+    self.modified = None
+
+  def databaseModificationTime(self):
+    if not os.path.exists(self.databaseFile):
+      return None
+    return os.path.getmtime(self.databaseFile)
+
+  def loadIndex(self):
+    if not os.path.exists(self.indexFile):
+      return False
+    try:
+      with open(self.indexFile, 'r') as f:
+        index = json.load(f)
+    except (IOError, ValueError):
+      print "Can't read patient catalog " + self.indexFile
+      return False
+    if index.get('version') != CATALOG_VERSION or index.get('databaseFile') != self.databaseFile:
+      return False
+    self.series = index['series']
+    self.order = index['order']
+    self.databaseModified = index['databaseModified']
+    self.groupSeries()
+    return True
+
+  def saveIndex(self):
+    index = {}
+    index['version'] = CATALOG_VERSION
+    index['databaseFile'] = self.databaseFile
+    index['databaseModified'] = self.databaseModified
+    index['series'] = self.series
+    index['order'] = self.order
+    tmpFile = self.indexFile + ".tmp"
+    try:
+      with open(tmpFile, 'w') as f:
+        json.dump(index, f)
+      if os.path.exists(self.indexFile):
+        os.remove(self.indexFile)
+      os.rename(tmpFile, self.indexFile)
+    except (IOError, OSError):
+      print "Can't write patient catalog " + self.indexFile
+      return False
+    return True
+
+  def update(self, useDatabaseAPI = True, classify = True):
+    """Brings the index up to date with the database. Returns True if anything was re-read.
+
+    With useDatabaseAPI False the dicomDatabase object is never touched (it may only be
+    used from the GUI thread) and sqlite3.Error is raised if the tables can't be queried.
+    Without classify, series are only read; each patient is classified when it's created
+    (see PatientDiscovery) and the index is saved by finishUpdate().
+    """
+    modified = self.databaseModificationTime()
+    if self.loadIndex() and modified is not None and modified == self.databaseModified:
+      return False
+
+    try:
+      rows = self.querySeries()
+    except sqlite3.Error as e:
+      if not useDatabaseAPI:
+        raise
+      print "Can't query DICOM database directly (" + str(e) + "), reading tags per series."
+      rows = self.readSeries()
+
+    self.previous = self.series
+    self.series = dict([(row['seriesUID'], row) for row in rows])
+    self.order = [row['seriesUID'] for row in rows]
+    self.modified = modified
+    self.reclassified = 0
+    self.groupSeries()
+    self.pending = set(self.patientOrder)
+    if classify:
+      for patientKey in self.patientOrder:
+        self.classifyPatient(patientKey)
+      self.finishUpdate()
+    return True
+
+  def classifyPatient(self, patientKey):
+    """Classifies series of patient read by update(), unchanged series are taken from the old index."""
+    if patientKey not in self.pending:
+      return
+    for uid in self.byPatient.get(patientKey, []):
+      row = self.series[uid]
+      entry = self.previous.get(uid)
+      if entry is None or not self.sameSeries(entry, row):
+        row.update(classifySeries(row['seriesDescription'], row['studyDescription'], row['modality']))
+        entry = row
+        self.reclassified += 1
+      self.series[uid] = entry
+    self.pending.discard(patientKey)
+
+  def finishUpdate(self):
+    """Saves index, once all patients read by update() are classified."""
+    if self.pending or self.modified is None:
+      return False
+    print "Patient catalog: " + str(self.reclassified) + " of " + str(len(self.order)) + " series classified."
+    self.databaseModified = self.modified
+    self.modified = None
+    self.previous = {}
+    return self.saveIndex()
+
+  def sameSeries(self, entry, row):
+    for key in ['patientKey', 'patientID', 'seriesDescription', 'studyDescription', 'modality', 'file', 'nFiles']:
+      if entry.get(key) != row.get(key):
+        return False
+    return True
+
+  def querySeries(self):
+    connection = sqlite3.connect(self.databaseFile)
+    try:
+      rows = []
+      for result in connection.execute(SERIES_QUERY):
+        row = {}
+        row['patientKey'] = result[0]
+        row['patientID'] = result[1] or ""
+        row['patientName'] = result[2] or ""
+        row['studyDescription'] = result[3] or ""
+        row['seriesUID'] = result[4]
+        row['seriesDescription'] = result[5] or ""
+        row['modality'] = result[6] or ""
+        row['file'] = result[7]
+        row['nFiles'] = result[8]
+        rows.append(row)
+    finally:
+      connection.close()
+    return rows
+
+  def readSeries(self):
+    #Fallback through the database API; tags are only read for series that aren't in the index yet.
+    database = self.dicomDatabase
+    rows = []
+    for patient in database.patients():
+      for study in database.studiesForPatient(patient):
+        for series in database.seriesForStudy(study):
+          files = database.filesForSeries(series)
+          if len(files) == 0:
+            continue
+          entry = self.series.get(series)
+          if entry is not None and entry.get('file') == files[0] and entry.get('nFiles') == len(files):
+            rows.append(dict(entry))
+            continue
+          instance = database.instanceForFile(files[0])
+          try:
+            patientID = database.instanceValue(instance, self.tags['patientID'])
+          except RuntimeError:
+            # this indicates that the particular instance is no longer
+            # accessible to the dicom database, so we should ignore it here
+            continue
+          row = {}
+          row['patientKey'] = patient
+          row['patientID'] = patientID
+          row['patientName'] = database.instanceValue(instance, self.tags['patientName'])
+          row['studyDescription'] = database.instanceValue(instance, self.tags['studyDescription'])
+          row['seriesUID'] = series
+          row['seriesDescription'] = database.instanceValue(instance, self.tags['seriesDescription'])
+          row['modality'] = database.instanceValue(instance, self.tags['modality'])
+          row['file'] = files[0]
+          row['nFiles'] = len(files)
+          rows.append(row)
+    return rows
+
+  def groupSeries(self):
+    #Series of each patient in one pass, so patient lookups don't scan all series
+    self.byPatient = {}
+    self.patientOrder = []
+    for uid in self.order:
+      key = self.series[uid]['patientKey']
+      if key not in self.byPatient:
+        self.byPatient[key] = []
+        self.patientOrder.append(key)
+      self.byPatient[key].append(uid)
+
+  def patientKeys(self):
+    return list(self.patientOrder)
+
+  def patientID(self, patientKey):
+    uids = self.byPatient.get(patientKey, [])
+    if not uids:
+      return ""
+    return self.series[uids[-1]]['patientID']
+
+  def seriesForPatient(self, patientKey):
+    return [self.series[uid] for uid in self.byPatient.get(patientKey, [])]
+
+  def createPatient(self, patientKey, databaseNumber = 0):
+    newPatient = Patient()
+    self.classifyPatient(patientKey)
+    entries = self.seriesForPatient(patientKey)
+    for entry in entries:
+      series = entry['seriesUID']
+      if entry['plan']:
+        newPatient.fourDCT[10].uid = series
+        newPatient.fourDCT[10].file = entry['file']
+        newPatient.fourDCT[10].name = entry['seriesDescription']
+        print "CT plan for patient " + entry['patientID'] + ": " + entry['studyDescription'] + ", seriesID: ", series
+
+      if entry['structureSet']:
+        newPatient.structureSet.uid = series
+
+      if entry['phase'] is not None:
+        newPatient.fourDCT[entry['phase']].uid = series
+        newPatient.fourDCT[entry['phase']].file = entry['file']
+        if len(newPatient.patientDir) == 0:
+          newPatient.patientDir = os.path.dirname(entry['file'])
+
+      if entry['fourD'] and len(newPatient.vectorDir) == 0 and os.path.exists(entry['file']):
+        dicomDir = os.path.dirname(entry['file'])
+        newPatient.vectorDir = dicomDir + "/VectorFields/"
+        if not os.path.exists(newPatient.vectorDir):
+          os.makedirs(newPatient.vectorDir)
+          print "Created " + newPatient.vectorDir
+
+    newPatient.databaseNumber = databaseNumber
+    if entries:
+      newPatient.ID = entries[-1]['patientID']
+      newPatient.name = entries[-1]['patientName']
+    return newPatient
+
+  def getPatients(self):
+    self.update()
+    patientList = []
+    for patientKey in self.patientKeys():
+      patientList.append(self.createPatient(patientKey, len(patientList)))
+    return patientList
@@ -0,0 +1,71 @@
+import threading
+import Queue
+import sqlite3
+
+
+#
+# PatientDiscovery
+#
+
+class PatientDiscovery(threading.Thread):
+  """Builds patients from a PatientCatalog off the GUI thread.
+
+  Results are put on self.results and must be collected from the GUI thread
+  (see FindMarginsWidget.onDiscoveryTimer):
+    ('patients', [(patientKey, patientID), ...]) - all patients, before any is classified
+    ('patient', index, patient)                 - one patient is ready
+    ('fallback', message)                       - database can't be queried from this thread
+    ('done', None)                              - finished or cancelled
+  """
+  def __init__(self, catalog):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.catalog = catalog
+    self.results = Queue.Queue()
+    self.lock = threading.Lock()
+    self.cancelEvent = threading.Event()
+    self.queue = []
+    self.keys = []
+
+  def run(self):
+    try:
+      # Series are only read here, each patient is classified when it's created below
+      self.catalog.update(useDatabaseAPI = False, classify = False)
+    except sqlite3.Error as e:
+      self.results.put(('fallback', str(e)))
+      self.results.put(('done', None))
+      return
+
+    self.keys = self.catalog.patientKeys()
+    with self.lock:
+      self.queue = range(len(self.keys))
+    self.results.put(('patients', [(key, self.catalog.patientID(key)) for key in self.keys]))
+
+    while not self.cancelEvent.is_set():
+      with self.lock:
+        if not self.queue:
+          break
+        index = self.queue.pop(0)
+      patient = self.catalog.createPatient(self.keys[index], index)
+      self.results.put(('patient', index, patient))
+
+    # Index is saved only when every patient was classified
+    if not self.cancelEvent.is_set():
+      self.catalog.finishUpdate()
+    self.results.put(('done', None))
+
+  def prioritize(self, index):
+    """Moves patient with index to the front of the queue, if it's still pending."""
+    with self.lock:
+      if index in self.queue:
+        self.queue.remove(index)
+        self.queue.insert(0, index)
+        return True
+    return False
+
+  def pending(self):
+    with self.lock:
+      return len(self.queue)
+
+  def cancel(self):
+    self.cancelEvent.set()
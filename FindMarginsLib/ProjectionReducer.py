@@ -0,0 +1,110 @@
+import numpy as np
+
+from WarpEngine import runSlabs
+
+# Projection and name suffix of its volume
+PROJECTIONS = ['mean', 'mip', 'minip', 'median', 'std']
+PROJECTION_NAMES = {'mean': 'average4DCT', 'mip': 'MIP4DCT', 'minip': 'MinIP4DCT', 'median': 'median4DCT', 'std': 'std4DCT'}
+
+
+#
+# ProjectionReducer
+#
+
+class ProjectionReducer():
+  """Reduces phases of a 4DCT voxel by voxel in one pass over the phases.
+
+  Each phase is added once (e.g. right after it's loaded from DICOM) and all
+  selected projections are updated from it: mean and standard deviation with
+  float32 running mean and sum of squared deviations (Welford), MIP and MinIP
+  as running maximum and minimum. Median needs every value of a voxel, so
+  phases are kept in a stack only when it is selected. Updates and median
+  are split into slabs of slices over threads.
+  """
+  def __init__(self, projections = None, nPhases = 10, nThreads = None):
+    if projections is None:
+      projections = ['mean']
+    self.projections = [p for p in projections if p in PROJECTIONS]
+    for p in projections:
+      if p not in PROJECTIONS:
+        print "Unknown projection " + str(p)
+    self.nPhases = nPhases
+    self.nThreads = nThreads
+    self.count = 0
+    self.shape = None
+    self.accumulators = {}
+
+  def allocate(self, array):
+    self.shape = array.shape
+    if 'mean' in self.projections or 'std' in self.projections:
+      self.accumulators['mean'] = np.zeros(self.shape, dtype=np.float32)
+      self.accumulators['delta'] = np.empty(self.shape, dtype=np.float32)
+    if 'std' in self.projections:
+      self.accumulators['m2'] = np.zeros(self.shape, dtype=np.float32)
+    if 'mip' in self.projections:
+      self.accumulators['mip'] = np.array(array, dtype=np.float32)
+    if 'minip' in self.projections:
+      self.accumulators['minip'] = np.array(array, dtype=np.float32)
+    if 'median' in self.projections:
+      self.accumulators['stack'] = np.empty((self.nPhases,) + self.shape, dtype=array.dtype)
+
+  def add(self, array):
+    """Adds phase (k, j, i array, e.g. slicer.util.array of the CT)."""
+    if self.shape is None:
+      self.allocate(array)
+    elif not array.shape == self.shape:
+      print "Phase " + str(array.shape) + " doesn't match " + str(self.shape)
+      return False
+    if 'stack' in self.accumulators and self.count >= self.nPhases:
+      print "Only " + str(self.nPhases) + " phases can be added."
+      return False
+    self.count += 1
+    a = self.accumulators
+
+    def slab(zStart, zEnd):
+      values = array[zStart:zEnd]
+      if 'mean' in a:
+        delta = a['delta'][zStart:zEnd]
+        mean = a['mean'][zStart:zEnd]
+        np.subtract(values, mean, out=delta, casting='unsafe')
+        mean += delta / self.count
+        if 'm2' in a:
+          # Sum of squared deviations: delta (to old mean) times deviation from new mean
+          a['m2'][zStart:zEnd] += delta * (values - mean)
+      if 'mip' in a:
+        np.maximum(a['mip'][zStart:zEnd], values, out=a['mip'][zStart:zEnd], casting='unsafe')
+      if 'minip' in a:
+        np.minimum(a['minip'][zStart:zEnd], values, out=a['minip'][zStart:zEnd], casting='unsafe')
+      if 'stack' in a:
+        a['stack'][self.count - 1, zStart:zEnd] = values
+
+    runSlabs(self.shape[0], slab, self.nThreads)
+    return True
+
+  def finish(self):
+    """Returns dictionary of projection name and float32 (k, j, i) array."""
+    if self.count == 0:
+      return {}
+    results = {}
+    a = self.accumulators
+    if 'mean' in self.projections:
+      results['mean'] = a['mean']
+    if 'std' in self.projections:
+      a['m2'] /= self.count
+      results['std'] = np.sqrt(a['m2'], out=a['m2'])
+    if 'mip' in self.projections:
+      results['mip'] = a['mip']
+    if 'minip' in self.projections:
+      results['minip'] = a['minip']
+    if 'median' in self.projections:
+      median = np.empty(self.shape, dtype=np.float32)
+      stack = a['stack'][0:self.count]
+
+      def slab(zStart, zEnd):
+        median[zStart:zEnd] = np.median(stack[:, zStart:zEnd], axis=0)
+
+      runSlabs(self.shape[0], slab, self.nThreads)
+      results['median'] = median
+    a.pop('delta', None)
+    a.pop('stack', None)
+    return results
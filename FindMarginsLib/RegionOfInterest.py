@@ -0,0 +1,61 @@
+import numpy as np
+
+
+#
+# RegionOfInterest
+#
+
+class RegionOfInterest():
+  """Box in RAS around a structure (bounds grown by padding in mm).
+
+  Cuts a voxel grid down to the part covering the box, so fields and warps
+  are computed only where the target moves. Padding has to cover motion of
+  the target and support of the interpolation.
+  """
+  def __init__(self, bounds, padding = 30.):
+    self.bounds = np.asarray(bounds, dtype=np.float64).reshape(3, 2)
+    self.padding = padding
+
+  def record(self):
+    """Box as JSON compatible dict (e.g. for midV manifest)."""
+    return {'bounds': self.bounds.tolist(), 'padding': float(self.padding)}
+
+  def corners(self):
+    low = self.bounds[:, 0] - self.padding
+    high = self.bounds[:, 1] + self.padding
+    return np.array([[x, y, z] for x in [low[0], high[0]] for y in [low[1], high[1]] for z in [low[2], high[2]]])
+
+  def indexRange(self, dimensions, ijkToRAS):
+    """First and behind last voxel index (i, j, k) of the grid inside the box, None if they don't overlap."""
+    rasToIJK = np.linalg.inv(np.asarray(ijkToRAS, dtype=np.float64))
+    ijk = np.dot(self.corners(), rasToIJK[0:3, 0:3].T) + rasToIJK[0:3, 3]
+    start = np.maximum(np.floor(ijk.min(axis=0)).astype(int), 0)
+    end = np.minimum(np.ceil(ijk.max(axis=0)).astype(int) + 1, [int(d) for d in dimensions])
+    if np.any(end <= start):
+      return None
+    return start, end
+
+  def subGrid(self, dimensions, ijkToRAS):
+    """(start index, dimensions, ijkToRAS) of the cropped grid, None if box is outside the grid."""
+    indexRange = self.indexRange(dimensions, ijkToRAS)
+    if indexRange is None:
+      return None
+    start, end = indexRange
+    matrix = np.array(ijkToRAS, dtype=np.float64)
+    matrix[0:3, 3] += np.dot(matrix[0:3, 0:3], start)
+    return start, list(end - start), matrix
+
+  def fraction(self, dimensions, ijkToRAS):
+    """Part of the grid's voxels inside the box."""
+    indexRange = self.indexRange(dimensions, ijkToRAS)
+    if indexRange is None:
+      return 0.
+    return float(np.prod(indexRange[1] - indexRange[0])) / np.prod([int(d) for d in dimensions])
+
+
+def regionFromPoints(points, padding = 30.):
+  """RegionOfInterest around RAS points (N x 3), None if there are none."""
+  if points is None or len(points) == 0:
+    return None
+  points = np.asarray(points, dtype=np.float64)
+  return RegionOfInterest(np.column_stack([points.min(axis=0), points.max(axis=0)]), padding)
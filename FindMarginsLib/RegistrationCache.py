@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+from MidVManifest import transformRecord
+
+#
+# RegistrationCache
+#
+
+class RegistrationCache():
+  """Content addressed store for registration results.
+
+  Results are keyed by a hash of the fixed and moving series UIDs and all
+  plastimatch settings, so a changed stage setting or series always gives a
+  new key, while the same registration is found again even if its file in the
+  vector directory was moved or deleted. A warm started registration also
+  depends on its seed transform and stage changes, they're part of its key;
+  find() gives it for the key of the settings while its seed file is unchanged. The manifest keeps size and usage
+  time of every entry for eviction by size (maxBytes) or age (maxAge, seconds),
+  together with hit/miss statistics. It's written by store() and evict() only,
+  lookups change it in memory. Files are hashed again only when their size or
+  modification time changed.
+  """
+  # Parameters that only name input and output nodes/files, they don't change the result
+  IGNORED_PARAMETERS = ["plmslc_fixed_volume", "plmslc_moving_volume", "plmslc_output_bsp", "plmslc_output_bsp_f",
+                        "plmslc_output_vf", "plmslc_output_vf_f", "plmslc_output_warped", "plmslc_output_warped_1",
+                        "plmslc_output_warped_2", "plmslc_output_warped_3"]
+
+  def __init__(self, directory, maxBytes = 20 * 1024**3, maxAge = 180 * 24 * 3600):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self.maxAge = maxAge
+    self.manifestFile = os.path.join(directory, "manifest.json")
+    self.entries = {}
+    self.records = {} # path -> size, modification time and SHA-1 of files compared with entries
+    self.statistics = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    self.loadManifest()
+
+  def loadManifest(self):
+    if not os.path.exists(self.manifestFile):
+      return False
+    try:
+      with open(self.manifestFile, 'r') as f:
+        manifest = json.load(f)
+    except (IOError, ValueError):
+      print "Can't read registration cache manifest " + self.manifestFile
+      return False
+    self.entries = manifest.get('entries', {})
+    self.records = manifest.get('records', {})
+    self.statistics.update(manifest.get('statistics', {}))
+    return True
+
+  def saveManifest(self):
+    for path in list(self.records.keys()):
+      if not os.path.exists(path):
+        del self.records[path]
+    tmpFile = self.manifestFile + ".tmp"
+    with open(tmpFile, 'w') as f:
+      json.dump({'entries': self.entries, 'records': self.records, 'statistics': self.statistics}, f, indent=1, sort_keys=True)
+    if os.path.exists(self.manifestFile):
+      os.remove(self.manifestFile)
+    os.rename(tmpFile, self.manifestFile)
+
+  def key(self, fixedUID, movingUID, parameters, warmStart = None):
+    settings = {}
+    for name in parameters:
+      if name not in self.IGNORED_PARAMETERS:
+        settings[name] = str(parameters[name])
+    content = {'fixed': fixedUID, 'moving': movingUID, 'parameters': settings}
+    if warmStart is not None:
+      content['warmStart'] = warmStart
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+  def find(self, baseKey):
+    """Key of cached result for settings key baseKey: registered from identity, or the latest
+    warm started one, whose seed file still has the content it was started from."""
+    if baseKey in self.entries:
+      return baseKey
+    warm = [key for key in self.entries if self.entries[key].get('baseKey') == baseKey and self.entries[key].get('warmStart')]
+    warm.sort(key = lambda key: self.entries[key]['created'], reverse = True)
+    for key in warm:
+      entry = self.entries[key]
+      seedFile = entry.get('seedFile', "")
+      if os.path.exists(seedFile) and self.stampedHash(seedFile) == entry['warmStart']['seed']:
+        return key
+    return baseKey
+
+  def lookup(self, key):
+    """Returns file name of cached result or None."""
+    entry = self.entries.get(key)
+    if entry is not None and not os.path.exists(os.path.join(self.directory, entry['file'])):
+      del self.entries[key]
+      entry = None
+    if entry is None:
+      self.statistics['misses'] += 1
+      return None
+
+    self.statistics['hits'] += 1
+    entry['lastUsed'] = time.time()
+    return os.path.join(self.directory, entry['file'])
+
+  def store(self, key, fileName, fixedUID = "", movingUID = "", baseKey = None, warmStart = None, seedFile = ""):
+    if not os.path.exists(fileName):
+      print "Can't cache " + fileName + ", file doesn't exist."
+      return False
+    cacheFile = key + os.path.splitext(fileName)[1]
+    shutil.copyfile(fileName, os.path.join(self.directory, cacheFile))
+    entry = {}
+    entry['file'] = cacheFile
+    entry['size'] = os.path.getsize(fileName)
+    entry['sha1'] = self.stampedHash(fileName)
+    entry['created'] = time.time()
+    entry['lastUsed'] = entry['created']
+    entry['fixedUID'] = fixedUID
+    entry['movingUID'] = movingUID
+    entry['source'] = os.path.basename(fileName)
+    entry['baseKey'] = baseKey or key
+    if warmStart is not None:
+      entry['warmStart'] = warmStart
+      entry['seedFile'] = seedFile
+    self.entries[key] = entry
+    self.statistics['stores'] += 1
+    self.evict()
+    return True
+
+  def restore(self, key, fileName):
+    """Copies cached result to fileName, unless an identical file is already there."""
+    cacheFile = self.lookup(key)
+    if cacheFile is None:
+      return False
+    entry = self.entries[key]
+    if not entry.get('sha1'):
+      entry['sha1'] = self.stampedHash(cacheFile)
+    if os.path.exists(fileName) and os.path.getsize(fileName) == entry['size'] and self.stampedHash(fileName) == entry['sha1']:
+      return True
+    directory = os.path.dirname(fileName)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    shutil.copyfile(cacheFile, fileName)
+    self.records[os.path.abspath(fileName)] = {'file': os.path.basename(fileName), 'size': os.path.getsize(fileName),
+                                               'mtime': os.path.getmtime(fileName), 'sha1': entry['sha1']}
+    return True
+
+  def stampedHash(self, fileName):
+    """SHA-1 of fileName, the recorded one while its size and modification time didn't change."""
+    path = os.path.abspath(fileName)
+    record = transformRecord(path, self.records.get(path))
+    if record is None:
+      return None
+    self.records[path] = record
+    return record['sha1']
+
+  def remove(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      return
+    fileName = os.path.join(self.directory, entry['file'])
+    if os.path.exists(fileName):
+      os.remove(fileName)
+    self.statistics['evictions'] += 1
+
+  def size(self):
+    return sum([entry['size'] for entry in self.entries.values()])
+
+  def evict(self):
+    now = time.time()
+    if self.maxAge is not None:
+      for key in list(self.entries.keys()):
+        if now - self.entries[key]['lastUsed'] > self.maxAge:
+          self.remove(key)
+    if self.maxBytes is not None:
+      byAge = sorted(self.entries.keys(), key = lambda key: self.entries[key]['lastUsed'])
+      while byAge and self.size() > self.maxBytes:
+        self.remove(byAge.pop(0))
+    self.saveManifest()
+
+  def clear(self):
+    for key in list(self.entries.keys()):
+      self.remove(key)
+    self.saveManifest()
+
+  def summary(self):
+    lookups = self.statistics['hits'] + self.statistics['misses']
+    hitRate = 0.
+    if lookups > 0:
+      hitRate = 100. * self.statistics['hits'] / lookups
+    return ("Registration cache: " + str(len(self.entries)) + " entries, " + str(round(self.size() / 1024.**2, 1)) + " MB, " +
+            str(self.statistics['hits']) + " hits, " + str(self.statistics['misses']) + " misses (" + str(round(hitRate, 1)) + " %), " +
+            str(self.statistics['evictions']) + " evicted.")
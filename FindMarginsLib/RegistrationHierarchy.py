@@ -1,5 +1,10 @@
 import os
+import re
 import unittest
+import shutil
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
 from __main__ import vtk, qt, ctk, slicer
 import numpy as np
 
@@ -310,6 +315,100 @@ class RegistrationHierarchyLogic:
             return True
 
 
+def findPlastimatch():
+    return find_executable("plastimatch")
+
+
+def registrationLog(node):
+    # Output of plastimatch from CLI node or PlastimatchProcess
+    if hasattr(node, 'logText'):
+        return node.logText()
+    if hasattr(node, 'GetOutputText'):
+        return node.GetOutputText()
+    return ""
+
+
+# Plastimatch registration running as separate process. Status values are the same
+# as in vtkMRMLCommandLineModuleNode, so it can be polled like a CLI node.
+class PlastimatchProcess():
+    Running = 2
+    Cancelled = 8
+    Completed = 32
+    CompletedWithErrors = 32 | 128
+
+    def __init__(self, executable, commandFile, nativeFile, outputFile, workDirectory, totalIterations = 0):
+        self.executable = executable
+        self.totalIterations = totalIterations
+        self.nativeFile = nativeFile
+        self.outputFile = outputFile
+        self.workDirectory = workDirectory
+        self.logFile = os.path.join(workDirectory, "register.log")
+        self.log = open(self.logFile, "w")
+        self.process = subprocess.Popen([executable, "register", commandFile], stdout=self.log, stderr=subprocess.STDOUT)
+        self.status = self.Running
+
+    def GetStatus(self):
+        if self.status == self.Running and self.process.poll() is not None:
+            self.log.close()
+            if self.process.returncode == 0 and self.convert():
+                self.status = self.Completed
+            else:
+                self.status = self.CompletedWithErrors
+            self.removeInputs()
+        return self.status
+
+    def GetStatusString(self):
+        strings = {self.Running: "Running", self.Cancelled: "Cancelled", self.Completed: "Completed",
+                   self.CompletedWithErrors: "Completed with errors"}
+        return strings[self.status]
+
+    def Cancel(self):
+        if self.status == self.Running:
+            self.process.terminate()
+            self.process.wait()
+            self.log.close()
+            self.status = self.Cancelled
+            self.removeInputs()
+
+    def GetProgress(self):
+        # Iterations reported in log against all planned iterations (0-100)
+        if self.status == self.Completed:
+            return 100.
+        if self.totalIterations <= 0:
+            return 0.
+        iterations = len(re.findall(r'\]\s+(?:MSE|MI|NMI)\s', self.logText()))
+        return min(99., 100. * iterations / self.totalIterations)
+
+    def wait(self):
+        self.process.wait()
+        return self.GetStatus()
+
+    def convert(self):
+        # Slicer reads B-splines as ITK transforms, same as written by the CLI module
+        command = [self.executable, "xf-convert", "--input", self.nativeFile, "--output", self.outputFile, "--output-type", "itk_bsp"]
+        with open(self.logFile, "a") as log:
+            result = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+        if result != 0:
+            print "Can't convert " + self.nativeFile + " to " + self.outputFile
+            return False
+        return os.path.exists(self.outputFile)
+
+    def logText(self):
+        if not os.path.exists(self.logFile):
+            return ""
+        with open(self.logFile, "r") as f:
+            return f.read()
+
+    def removeInputs(self):
+        for name in ["fixed.nrrd", "moving.nrrd"]:
+            fileName = os.path.join(self.workDirectory, name)
+            if os.path.exists(fileName):
+                os.remove(fileName)
+
+    def cleanup(self):
+        shutil.rmtree(self.workDirectory, True)
+
+
 # Class that holds all info for registration
 class registrationParameters():
     def __init__(self, patientName, resample = []):
@@ -332,6 +431,14 @@ class registrationParameters():
         self.stageTwoOn = True
         self.stageThreeOn = False
         self.resample = resample
+        self.seriesUIDs = {}  # movingNumber/referenceNumber -> series UID, used for cache keys
+        self.cache = None
+        # Registration through plastimatch command file, needed for warm start
+        self.useCommandFile = False
+        self.initialBspline = ''
+        self.iterationFactor = 1.0
+        self.skipFirstStage = False
+        self.stagePlanner = None
 
     def setWarpVolume(self):
         warpVolume = slicer.vtkMRMLScalarVolumeNode()
@@ -349,10 +456,12 @@ class registrationParameters():
         vectorVolume.SetAndObserveStorageNodeID(storageNode.GetID())
         self.vectorVolume = vectorVolume
 
-    def register(self):
+    def register(self, wait_for_completion=True):
+        # Without wait_for_completion the CLI node is returned right after launch,
+        # caller has to call saveNodes() when it's completed.
         if not self.referenceNode or not self.movingNode:
             print "Not enough parameters"
-            return
+            return None
 
         registrationName = self.patientName + "_" + self.movingNumber + "to" + self.referenceNumber
         if self.warpVolume:
@@ -367,15 +476,145 @@ class registrationParameters():
             self.bspline_F_name = self.vectorDirectory + registrationName + "_bs.txt"
 
         self.setParameters()
+        useCommandFile = self.useCommandFile or self.initialBspline
+        if self.stagePlanner is not None and not useCommandFile:
+            # CLI module has no convergence tolerance, planned stages stop at it only through the command file
+            useCommandFile = bool(findPlastimatch())
+            if not useCommandFile:
+                print "Can't find plastimatch executable, planned stages run without convergence tolerance."
+        if useCommandFile:
+            process = self.registerWithCommandFile(wait_for_completion)
+            if process is not None and wait_for_completion:
+                self.finishRegistration(registrationLog(process))
+            return process
         #run plastimatch registration
         plmslcRegistration = slicer.modules.plastimatch_slicer_bspline
-        slicer.cli.run(plmslcRegistration, None, self.parameters, wait_for_completion=True)
+        cliNode = slicer.cli.run(plmslcRegistration, None, self.parameters, wait_for_completion=wait_for_completion)
+        if not wait_for_completion:
+            return cliNode
         #Resample if neccesary
         #TODO: Descripton in process.
         #self.resampleVectorVolume()
         #save nodes
-        self.saveNodes()
+        self.finishRegistration(registrationLog(cliNode))
         #Switch
+        return cliNode
+
+    def registerWithCommandFile(self, wait_for_completion=True):
+        # Same registration as the CLI module, but through the plastimatch executable,
+        # which can start from an initial transform (xform_in).
+        executable = findPlastimatch()
+        if not executable:
+            print "Can't find plastimatch executable."
+            return None
+        if not self.bspline_F_name:
+            print "No output file for registration."
+            return None
+
+        workDirectory = tempfile.mkdtemp(prefix="FindMargins_")
+        fixedFile = os.path.join(workDirectory, "fixed.nrrd")
+        movingFile = os.path.join(workDirectory, "moving.nrrd")
+        nativeFile = os.path.join(workDirectory, "bspline_native.txt")
+        for nodeID, fileName in [(self.referenceNode, fixedFile), (self.movingNode, movingFile)]:
+            node = slicer.mrmlScene.GetNodeByID(nodeID)
+            storageNode = slicer.vtkMRMLVolumeArchetypeStorageNode()
+            storageNode.SetFileName(fileName)
+            if node is None or not storageNode.WriteData(node):
+                print "Can't write " + fileName
+                shutil.rmtree(workDirectory, True)
+                return None
+
+        commandFile = os.path.join(workDirectory, "register.txt")
+        f = open(commandFile, "w")
+        f.write("[GLOBAL]\n")
+        f.write("fixed=" + fixedFile + "\n")
+        f.write("moving=" + movingFile + "\n")
+        if self.initialBspline:
+            f.write("xform_in=" + self.initialBspline + "\n")
+        f.write("xform_out=" + nativeFile + "\n")
+        totalIterations = 0
+        for stage in self.commandFileStages():
+            f.write("\n[STAGE]\n")
+            for name, value in stage:
+                f.write(name + "=" + value + "\n")
+                if name == "max_its":
+                    totalIterations += int(value)
+        f.close()
+
+        process = PlastimatchProcess(executable, commandFile, nativeFile, self.bspline_F_name, workDirectory, totalIterations)
+        if wait_for_completion:
+            process.wait()
+        return process
+
+    def plannedStageNumbers(self):
+        numbers = [1]
+        for n in [2, 3]:
+            if self.parameters["enable_stage_" + str(n)]:
+                numbers.append(n)
+        return numbers
+
+    def commandFileStages(self):
+        parameters = self.parameters
+        numbers = self.plannedStageNumbers()
+        if self.skipFirstStage and len(numbers) > 1:
+            numbers.pop(0)
+
+        stages = []
+        for n in numbers:
+            prefix = "stage_" + str(n) + "_"
+            iterations = int(round(int(parameters[prefix + "its"]) * self.iterationFactor))
+            gridSize = parameters[prefix + "grid_size"]
+            stage = []
+            stage.append(("xform", "bspline"))
+            stage.append(("impl", "plastimatch"))
+            stage.append(("metric", parameters["metric"].lower()))
+            stage.append(("res", parameters[prefix + "resolution"].replace(",", " ")))
+            stage.append(("grid_spac", gridSize + " " + gridSize + " " + gridSize))
+            stage.append(("regularization_lambda", parameters.get(prefix + "regularization", parameters["stage_1_regularization"])))
+            stage.append(("max_its", str(max(iterations, 1))))
+            if self.stagePlanner is not None:
+                stage.append(("convergence_tol", str(self.stagePlanner.convergenceTolerance)))
+            stages.append(stage)
+        return stages
+
+    def finishRegistration(self, log=""):
+        self.saveNodes()
+        if self.stagePlanner is not None and log:
+            firstStage = 0
+            if self.skipFirstStage and len(self.commandFileStages()) < len(self.plannedStageNumbers()):
+                firstStage = 1
+            self.stagePlanner.observe(log, firstStage)
+        key = self.cacheKey()
+        if key and os.path.exists(self.bspline_F_name):
+            self.cache.store(key, self.bspline_F_name, self.seriesUIDs[self.referenceNumber], self.seriesUIDs[self.movingNumber],
+                             self.cacheKey(False), self.warmStartInputs(), self.initialBspline)
+
+    def warmStartInputs(self):
+        # Seed transform (by content) and stage changes of a warm start change the result
+        if not self.initialBspline:
+            return None
+        seed = self.cache.stampedHash(self.initialBspline) or ""
+        return {'seed': seed, 'iterationFactor': str(self.iterationFactor), 'skipFirstStage': self.skipFirstStage}
+
+    def cacheKey(self, warmStart=True):
+        # Only registrations between known DICOM series are cached (not e.g. midV).
+        if self.cache is None:
+            return ""
+        fixedUID = self.seriesUIDs.get(self.referenceNumber, "")
+        movingUID = self.seriesUIDs.get(self.movingNumber, "")
+        if not fixedUID or not movingUID:
+            return ""
+        # Key is a query, parameters of a registration in progress stay as they are
+        values = self.parameterValues()
+        parameters = values
+        if self.stagePlanner is not None:
+            # Planned stages follow from planner settings and the series geometry
+            parameters = {}
+            for name in values:
+                if not name.startswith("stage_") and not name.startswith("enable_stage_"):
+                    parameters[name] = values[name]
+            parameters["stage_plan"] = self.stagePlanner.signature()
+        return self.cache.key(fixedUID, movingUID, parameters, self.warmStartInputs() if warmStart else None)
 
     def checkVf(self):
       fileName = self.vectorDirectory + self.patientName + "_" + self.movingNumber + "to" + self.referenceNumber +  "_vf.nrrd"
@@ -388,11 +627,32 @@ class registrationParameters():
     def checkBspline(self):
       fileName = self.vectorDirectory + self.patientName + "_" + self.movingNumber + "to" + self.referenceNumber +  "_bs.txt"
       self.bspline_F_name = fileName
+      key = self.cacheKey()
+      if key:
+        if not self.initialBspline:
+          # Warm start isn't set up yet, a warm started result with unchanged seed is as good
+          key = self.cache.find(key)
+        # Existing file is only trusted, if cache knows it was made from the same inputs and settings
+        if self.cache.restore(key, fileName):
+          return self.patientName + "_" + self.movingNumber + "to" + self.referenceNumber +  "_bs"
+        # Settings of files made before the cache (or with other settings) can't be checked, they're registered again
+        if os.path.exists(fileName):
+          print os.path.basename(fileName) + " isn't in registration cache for current settings, it will be registered again (unless imported with importBspline)."
+        return ""
       if os.path.exists(fileName):
         return self.patientName + "_" + self.movingNumber + "to" + self.referenceNumber +  "_bs"
       else:
         return ""
 
+    def importBspline(self):
+      # Explicitly adopts existing B-spline file (e.g. registered before the cache) as result of current settings
+      fileName = self.vectorDirectory + self.patientName + "_" + self.movingNumber + "to" + self.referenceNumber +  "_bs.txt"
+      key = self.cacheKey()
+      if not key or not os.path.exists(fileName):
+        print "Can't import " + fileName + " into registration cache."
+        return False
+      return self.cache.store(key, fileName, self.seriesUIDs[self.referenceNumber], self.seriesUIDs[self.movingNumber])
+
     def saveNodes(self, switch=False):
         logic = RegistrationHierarchyLogic()
         if self.warpVolume:
@@ -428,6 +688,10 @@ class registrationParameters():
         self.parameters["plmslc_moving_volume"] = self.referenceNode.GetID()
 
     def setParameters(self):
+        self.parameters = self.parameterValues()
+
+    def parameterValues(self):
+        # Parameters of plastimatch CLI for current settings, self.parameters isn't changed
         parameters = {}
 
         parameters["plmslc_fixed_volume"] = self.referenceNode
@@ -478,7 +742,32 @@ class registrationParameters():
         parameters["stage_1_regularization"] = '0.1'
         parameters["stage_3_its"] = '50'
         parameters["plmslc_output_warped_3"] = ''
-        self.parameters = parameters
+        if self.stagePlanner is not None:
+            self.setPlannedStages(parameters)
+        return parameters
+
+    def setPlannedStages(self, parameters):
+        # Stages from planner replace the fixed ones above. Geometry is only known
+        # after the reference volume is loaded, before that fixed stages are kept.
+        node = self.referenceNode
+        if isinstance(node, basestring):
+            node = slicer.mrmlScene.GetNodeByID(node) if node else None
+        if node is None or node.GetImageData() is None:
+            return
+        stages = self.stagePlanner.plan(node.GetImageData().GetDimensions(), node.GetSpacing())
+        for n in range(1, 4):
+            prefix = "stage_" + str(n) + "_"
+            if n > 1:
+                parameters["enable_stage_" + str(n)] = n <= len(stages)
+            if n > len(stages):
+                continue
+            for name in ["resolution", "grid_size", "regularization", "its"]:
+                parameters[prefix + name] = stages[n - 1][name]
+        plannedStages = ", ".join([stage["resolution"] + " (" + stage["its"] + " its)" for stage in stages])
+        # Parameters are built for every cache key, the planner is shared by all phases of a patient
+        if not plannedStages == self.stagePlanner.lastPrinted:
+            self.stagePlanner.lastPrinted = plannedStages
+            print "Planned stages: " + plannedStages
 
     def resampleVectorVolume(self):
         if not self.vectorVolume or not self.vectorVolume.IsA('vtkMRMLVectorVolumeNode'):
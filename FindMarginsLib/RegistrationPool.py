@@ -0,0 +1,259 @@
+import os
+import time
+import multiprocessing
+from __main__ import vtk, qt, ctk, slicer
+
+import RegistrationHierarchy
+
+
+def physicalMemory():
+  """Returns installed RAM in bytes, or None if it can't be found out."""
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+  except (ValueError, OSError, AttributeError):
+    return None
+
+
+class RegistrationJob():
+  def __init__(self, position, regParameters, memory = 0):
+    self.position = position
+    self.regParameters = regParameters
+    self.memory = memory
+    self.cliNode = None
+    self.status = "Queued"
+    self.startTime = 0
+    self.duration = 0
+    self.dependsOn = None  # job that has to finish first, e.g. the one giving initial transform
+    self.moving = None  # position of moving CT
+    self.name = str(position) + "0%"
+    self.observer = None
+
+
+#
+# RegistrationPool
+#
+
+class RegistrationPool():
+  """Runs independent plastimatch registrations concurrently.
+
+  Jobs are admitted while there are less than maxWorkers running and the
+  estimated memory of all running jobs stays inside memoryBudget (bytes).
+  A job is always admitted when nothing else runs, so an underestimated
+  budget can't stall the pool.
+
+  startJob(job) is called right before the job is launched and must set
+  movingNode/referenceNode of job.regParameters (it returns False on failure),
+  finishJob(job) is called when the registration ended either way.
+
+  start() returns right away: a timer and the status events of CLI nodes call
+  step(), so the GUI stays responsive, progress(pool) is called on every change
+  and finished(pool) at the end. run() does the same, but blocks in a local
+  event loop until all jobs are done.
+  cancel() drops queued jobs and cancels running ones, which also happens
+  when deadline (time.time() value) passed; timedOut tells it apart.
+  """
+  # Memory for one registration per CT voxel: the phase CT in the scene (short),
+  # fixed and moving image inside plastimatch (float), moving image gradient
+  # and the deformation field (3 x float each).
+  BYTES_PER_VOXEL = 2 + 4 + 4 + 12 + 12
+
+  def __init__(self, maxWorkers = 0, memoryBudget = None, startJob = None, finishJob = None):
+    if maxWorkers < 1:
+      maxWorkers = multiprocessing.cpu_count()
+    self.maxWorkers = maxWorkers
+    if memoryBudget is None:
+      memory = physicalMemory()
+      if memory:
+        memoryBudget = int(0.75 * memory)
+    self.memoryBudget = memoryBudget
+    self.reservedMemory = 0
+    self.startJob = startJob
+    self.finishJob = finishJob
+    self.jobs = []
+    self.queued = []
+    self.running = []
+    self.pollInterval = 0.2
+    self.timer = None
+    self.stepping = False
+    self.cancelled = False
+    self.deadline = None
+    self.timedOut = False
+    self.progress = None
+    self.finished = None
+
+  def addJob(self, job):
+    self.jobs.append(job)
+    self.queued.append(job)
+
+  def estimateMemory(self, numberOfVoxels):
+    return numberOfVoxels * self.BYTES_PER_VOXEL
+
+  def usedMemory(self):
+    return self.reservedMemory + sum([job.memory for job in self.running])
+
+  def canAdmit(self, job):
+    if len(self.running) >= self.maxWorkers:
+      return False
+    if not self.running or self.memoryBudget is None:
+      return True
+    return self.usedMemory() + job.memory <= self.memoryBudget
+
+  def nextJob(self):
+    """First queued job, whose dependency already finished."""
+    for job in self.queued:
+      if job.dependsOn is None or job.dependsOn.status in ["Completed", "Failed", "Cancelled"]:
+        return job
+    return None
+
+  def isDone(self):
+    return not self.queued and not self.running
+
+  def step(self):
+    """Collects finished registrations and launches queued ones. Returns True when all jobs are done."""
+    if self.deadline is not None and not self.cancelled and time.time() > self.deadline:
+      print "Registrations exceeded deadline, cancelling."
+      self.timedOut = True
+      self.cancel()
+    for job in list(self.running):
+      status = job.cliNode.GetStatus()
+      if status == job.cliNode.Completed:
+        if os.path.exists(job.regParameters.bspline_F_name):
+          job.status = "Completed"
+          job.regParameters.finishRegistration(RegistrationHierarchy.registrationLog(job.cliNode))
+        else:
+          job.status = "Failed"
+          print "Registration finished without output: " + job.regParameters.bspline_F_name
+      elif status == job.cliNode.Cancelled:
+        job.status = "Cancelled"
+        print "Registration of " + job.name + " cancelled."
+      elif status == job.cliNode.CompletedWithErrors:
+        job.status = "Failed"
+        print "Registration of " + job.name + " failed: " + job.cliNode.GetStatusString()
+      else:
+        continue
+      self.running.remove(job)
+      job.duration = time.time() - job.startTime
+      if job.observer is not None:
+        job.cliNode.RemoveObserver(job.observer)
+        job.observer = None
+      if hasattr(job.cliNode, 'cleanup'):
+        job.cliNode.cleanup()
+      else:
+        slicer.mrmlScene.RemoveNode(job.cliNode)
+      job.cliNode = None
+      if self.finishJob:
+        self.finishJob(job)
+
+    while self.nextJob() is not None and self.canAdmit(self.nextJob()):
+      job = self.nextJob()
+      self.queued.remove(job)
+      if job.dependsOn is not None and not job.dependsOn.status == "Completed":
+        job.regParameters.initialBspline = ''
+      if self.startJob and not self.startJob(job):
+        job.status = "Failed"
+        if self.finishJob:
+          self.finishJob(job)
+        continue
+      job.startTime = time.time()
+      job.cliNode = job.regParameters.register(wait_for_completion = False)
+      if job.cliNode is None:
+        job.status = "Failed"
+        if self.finishJob:
+          self.finishJob(job)
+        continue
+      job.status = "Running"
+      if hasattr(job.cliNode, 'AddObserver'):
+        job.observer = job.cliNode.AddObserver(slicer.vtkMRMLCommandLineModuleNode().StatusModifiedEvent, self.onStatusModified)
+      self.running.append(job)
+
+    return self.isDone()
+
+  def run(self, progress = None):
+    """Blocks until all jobs are done, keeping the GUI event loop running.
+
+    Waits in a local event loop, which is quit when the pool finished, so
+    nothing polls between the timer and status events.
+    """
+    loop = qt.QEventLoop()
+    def finished(pool):
+      loop.quit()
+    self.start(progress, finished)
+    if self.isRunning():
+      loop.exec_()
+    return self.completed()
+
+  def start(self, progress = None, finished = None):
+    """Runs jobs without blocking."""
+    self.progress = progress
+    self.finished = finished
+    self.timer = qt.QTimer()
+    self.timer.setInterval(int(1000 * self.pollInterval))
+    self.timer.connect('timeout()', self.onTimer)
+    self.timer.start()
+    self.onTimer()
+
+  def onStatusModified(self, caller, event):
+    self.onTimer()
+
+  def onTimer(self):
+    #Loading volumes in startJob processes events, which could call back here
+    if self.stepping or self.timer is None:
+      return
+    self.stepping = True
+    try:
+      done = self.step()
+    finally:
+      self.stepping = False
+    if self.progress:
+      self.progress(self)
+    if done:
+      self.timer.stop()
+      self.timer = None
+      if self.finished:
+        self.finished(self)
+
+  def isRunning(self):
+    return self.timer is not None
+
+  def cancel(self):
+    self.cancelled = True
+    for job in list(self.queued):
+      self.queued.remove(job)
+      job.status = "Cancelled"
+      if self.finishJob:
+        self.finishJob(job)
+    for job in self.running:
+      job.cliNode.Cancel()
+
+  def jobProgress(self, job):
+    """Progress of job in percent."""
+    if job.status == "Completed":
+      return 100.
+    if job.status == "Running" and hasattr(job.cliNode, 'GetProgress'):
+      return float(job.cliNode.GetProgress())
+    return 0.
+
+  def totalProgress(self):
+    jobs = [job for job in self.jobs if not job.status in ["Failed", "Cancelled"]]
+    if not jobs:
+      return 100.
+    return sum([self.jobProgress(job) for job in jobs]) / len(jobs)
+
+  def progressText(self):
+    lines = []
+    for job in self.jobs:
+      if job.status == "Running":
+        lines.append(job.name + ": " + str(int(self.jobProgress(job))) + " %")
+      else:
+        lines.append(job.name + ": " + job.status.lower())
+    return "\n".join(lines)
+
+  def completed(self):
+    return [job for job in self.jobs if job.status == "Completed"]
+
+  def summary(self):
+    done = len(self.completed())
+    failed = len([job for job in self.jobs if job.status == "Failed"])
+    cancelled = len([job for job in self.jobs if job.status == "Cancelled"])
+    return (str(done) + " registrations completed, " + str(failed) + " failed, " + str(cancelled) + " cancelled, " +
+            str(len(self.running)) + " running, " + str(len(self.queued)) + " queued.")
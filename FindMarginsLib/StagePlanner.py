@@ -0,0 +1,132 @@
+import re
+import math
+
+
+def metricTraces(log):
+  """Metric values per stage from plastimatch output. A new stage starts where the iteration number drops."""
+  traces = []
+  lastIteration = None
+  for match in re.finditer(r'\[\s*(\d+)(?:\s*,\s*\d+)?\s*\]\s+(?:MSE|MI|NMI)\s+([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)', log):
+    iteration = int(match.group(1))
+    if lastIteration is None or iteration < lastIteration:
+      traces.append([])
+    traces[-1].append(float(match.group(2)))
+    lastIteration = iteration
+  return traces
+
+
+def plateauIteration(values, tolerance = 1e-3, window = 10):
+  """First iteration after which the metric improved less than tolerance (relative) over window iterations."""
+  for i in range(window, len(values)):
+    reference = abs(values[i - window])
+    if reference == 0:
+      return i
+    if (values[i - window] - values[i]) / reference < tolerance:
+      return i
+  return None
+
+
+#
+# StagePlanner
+#
+
+class StagePlanner():
+  """Derives the multi-resolution B-spline schedule from volume geometry.
+
+  Every stage has a target voxel size (mm); the subsampling factor along each
+  axis is chosen so the stage works close to that size, which keeps thin-slice
+  CTs from running their last stage on every slice. Only the finest stage
+  gets finer with higher accuracy. Grid spacing is capped so
+  there are at least four control points along each axis. Iterations are
+  scaled with accuracy and, if timeBudget (seconds) is given, cut so the
+  estimated cost fits the budget.
+
+  Within a registration, every stage stops at convergenceTolerance (passed
+  as convergence_tol, so planned registrations run through the plastimatch
+  command file). observe() reads plastimatch output of a finished
+  registration. If a stage stopped improving well before its last
+  iteration, the following registrations get fewer iterations for that stage.
+  """
+  SITES = {}
+  SITES["default"] = {'voxel': [5.0, 2.5, 1.5], 'grid': [50, 25, 15], 'regularization': [0.005, 0.005, 0.1], 'its': [200, 100, 50]}
+  SITES["lung"] = {'voxel': [4.0, 2.0, 1.2], 'grid': [40, 20, 12], 'regularization': [0.005, 0.005, 0.05], 'its': [200, 100, 50]}
+  SITES["liver"] = {'voxel': [6.0, 3.0, 2.0], 'grid': [60, 30, 20], 'regularization': [0.01, 0.01, 0.1], 'its': [200, 100, 50]}
+
+  ACCURACY = {'fast': 0.5, 'normal': 1.0, 'accurate': 2.0}
+
+  # Rough plastimatch throughput (voxels x iterations per second) for time budget
+  VOXEL_ITERATIONS_PER_SECOND = 5.0e7
+
+  def __init__(self, site = "default", accuracy = "normal", timeBudget = None):
+    if site not in self.SITES:
+      print "Unknown site " + site + ", using default stages."
+      site = "default"
+    self.site = site
+    self.accuracy = accuracy
+    self.timeBudget = timeBudget
+    self.convergenceTolerance = 1e-4
+    self.plateauTolerance = 1e-3
+    self.iterationCaps = {}
+    self.lastPrinted = ""
+
+  def signature(self):
+    """Planner settings that define the schedule for given series (used in registration cache key)."""
+    return "site=" + self.site + ";accuracy=" + self.accuracy + ";time=" + str(self.timeBudget) + ";tol=" + str(self.convergenceTolerance)
+
+  def plan(self, dimensions, spacing):
+    """Returns list of stages (dictionaries with resolution, grid_size, regularization, its)."""
+    site = self.SITES[self.site]
+    factor = self.ACCURACY.get(self.accuracy, 1.0)
+    extent = [dimensions[i] * spacing[i] for i in range(3)]
+
+    stages = []
+    for n in range(0, 3):
+      voxel = site['voxel'][n]
+      if n == 2:
+        voxel = voxel / math.sqrt(factor)
+      subsampling = [max(1, int(round(voxel / spacing[i]))) for i in range(3)]
+      #Skip stages that would repeat the previous resolution
+      if stages and subsampling == stages[-1]['subsampling']:
+        continue
+      grid = min(site['grid'][n], min(extent) / 4.)
+      stage = {}
+      stage['subsampling'] = subsampling
+      stage['voxels'] = 1
+      for i in range(3):
+        stage['voxels'] *= int(math.ceil(dimensions[i] / float(subsampling[i])))
+      stage['resolution'] = ",".join([str(s) for s in subsampling])
+      stage['grid_size'] = str(int(round(grid)))
+      stage['regularization'] = str(site['regularization'][n])
+      stage['its'] = max(10, int(round(site['its'][n] * factor)))
+      stages.append(stage)
+
+    for n in range(len(stages)):
+      if n in self.iterationCaps:
+        stages[n]['its'] = min(stages[n]['its'], self.iterationCaps[n])
+
+    if self.timeBudget is not None:
+      cost = sum([stage['voxels'] * stage['its'] for stage in stages]) / self.VOXEL_ITERATIONS_PER_SECOND
+      if cost > self.timeBudget:
+        scale = self.timeBudget / cost
+        for stage in stages:
+          stage['its'] = max(10, int(stage['its'] * scale))
+
+    for stage in stages:
+      stage['its'] = str(stage['its'])
+    return stages
+
+  def observe(self, log, firstStage = 0):
+    """Caps iterations of stages, which reached a plateau in the given plastimatch output.
+    firstStage is the index of the first planned stage that was run (1 if coarse stage was skipped).
+    """
+    traces = metricTraces(log)
+    for n in range(len(traces)):
+      plateau = plateauIteration(traces[n], self.plateauTolerance)
+      if plateau is None:
+        continue
+      cap = max(10, int(math.ceil(1.25 * plateau)))
+      stage = n + firstStage
+      if stage not in self.iterationCaps or cap > self.iterationCaps[stage]:
+        #Keep the largest plateau seen, so harder phases aren't cut short
+        self.iterationCaps[stage] = cap
+    return traces
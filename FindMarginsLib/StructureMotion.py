@@ -0,0 +1,102 @@
+import numpy as np
+
+from Centroids import pointsCentroids
+
+AXES = ["L-R", "A-P", "I-S"]
+# Name parts of contours made by this module (propagated copies, ITV, PTV), they aren't structures of the structure set
+DERIVED_CONTOURS = ["_phase", "_refPosition", "_midV", "_ITV", "_PTV", "Expanded"]
+
+
+def isStructureContour(name):
+  """True for contours loaded from the structure set (<ROI>_Contour), False for derived ones."""
+  if name.find("_Contour") < 0:
+    return False
+  for tag in DERIVED_CONTOURS:
+    if name.find(tag) > -1:
+      return False
+  return True
+
+
+#
+# StructureMotion
+#
+
+class StructureMotion():
+  """Centroids and peak-to-peak amplitudes of several structures in all phases of 4DCT.
+
+  Points of all structures are stacked into one array, so every registration
+  is loaded and evaluated once for all of them. Propagated points of each
+  phase are kept until finish(), which computes the centroids of a structure
+  in all phases in one batch (volumetric, from mesh or labelmap voxels).
+  """
+  def __init__(self, nPhases = 10):
+    self.nPhases = nPhases
+    self.names = []
+    self.triangles = []
+    self.offsets = [0]
+    self.planPoints = []
+    self.phasePoints = {}
+    self.planOrigins = None
+    self.origins = None # structures x 3 x phases, NaN where propagation failed
+    self.amplitudes = None # structures x 3
+
+  def add(self, name, points, triangles = None):
+    self.names.append(name)
+    self.planPoints.append(np.asarray(points, dtype=np.float64))
+    self.triangles.append(triangles)
+    self.offsets.append(self.offsets[-1] + len(points))
+
+  def stackedPoints(self):
+    """Points of all structures as one N x 3 array."""
+    return np.vstack(self.planPoints)
+
+  def split(self, points):
+    return [points[self.offsets[s]:self.offsets[s + 1]] for s in range(len(self.names))]
+
+  def setPhase(self, phase, points):
+    """Stacked points propagated to phase."""
+    self.phasePoints[phase] = points
+
+  def finish(self):
+    nStructures = len(self.names)
+    self.planOrigins = np.empty((nStructures, 3))
+    self.origins = np.empty((nStructures, 3, self.nPhases))
+    self.origins.fill(np.nan)
+    phases = sorted(self.phasePoints.keys())
+    split = dict([(phase, self.split(self.phasePoints[phase])) for phase in phases])
+    for s in range(nStructures):
+      self.planOrigins[s] = pointsCentroids([self.planPoints[s]], self.triangles[s])[0]
+      if len(phases) == 0:
+        continue
+      centroids = pointsCentroids([split[phase][s] for phase in phases], self.triangles[s])
+      for n in range(len(phases)):
+        self.origins[s, :, phases[n]] = centroids[n]
+    if len(phases) > 0:
+      self.amplitudes = self.origins[:, :, phases].max(axis=2) - self.origins[:, :, phases].min(axis=2)
+    else:
+      self.amplitudes = np.zeros((nStructures, 3))
+
+  def relativeOrigins(self):
+    """Centroids relative to planning CT, like relOrigins in calculateMotion."""
+    return self.origins - self.planOrigins[:, :, np.newaxis]
+
+  def amplitude(self, name):
+    if self.amplitudes is None or name not in self.names:
+      return None
+    return self.amplitudes[self.names.index(name)]
+
+  def writeCsv(self, fileName):
+    """One row per structure and phase, amplitudes repeated on every row of the structure."""
+    relOrigins = self.relativeOrigins()
+    try:
+      with open(fileName, 'w') as f:
+        f.write("Structure,Phase,R,A,S,dR,dA,dS," + ",".join(["Amplitude " + axis for axis in AXES]) + "\n")
+        for s in range(len(self.names)):
+          amplitudes = ",".join(["%.2f" % a for a in self.amplitudes[s]])
+          for phase in range(self.nPhases):
+            values = list(self.origins[s, :, phase]) + list(relOrigins[s, :, phase])
+            f.write(self.names[s] + "," + str(phase) + "0," + ",".join(["%.2f" % v for v in values]) + "," + amplitudes + "\n")
+    except IOError:
+      print "Can't write " + fileName
+      return False
+    return True
@@ -0,0 +1,96 @@
+import os
+import time
+from __main__ import vtk, qt, ctk, slicer
+
+
+def fileStamp(fileName):
+  if not os.path.exists(fileName):
+    return None
+  return (os.path.getsize(fileName), os.path.getmtime(fileName))
+
+
+#
+# TransformCache
+#
+
+class TransformCache():
+  """Registration results read during a session, keyed by (moving, reference, parameters).
+
+  Holds both kinds a transform file is used as: BsplineTransform (numpy
+  evaluator, for points and fields) and MRML transform node (for hardening
+  contours). Callers get the same object again instead of reading the file,
+  so motion, ITV and midV stages read each registration once. Nodes stay in
+  the scene while cached; callers mustn't remove them. Entries are dropped,
+  least recently used first, when they take more than maxBytes, and when the
+  file changed on disk (e.g. registration was run again). invalidate() drops
+  them explicitly.
+  """
+  def __init__(self, maxBytes = 256 * 1024**2):
+    self.maxBytes = maxBytes
+    self.entries = {}
+    self.statistics = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+  def get(self, key, kind, fileName):
+    """Cached transform of kind ('bspline' or 'node') or None."""
+    entry = self.entries.get((key, kind))
+    if entry is not None and not entry['stamp'] == fileStamp(fileName):
+      self.remove((key, kind))
+      entry = None
+    if entry is not None and kind == 'node' and not slicer.mrmlScene.GetNodeByID(entry['nodeID']) is entry['transform']:
+      #Node was removed from scene by someone else (e.g. scene was cleared)
+      del self.entries[(key, kind)]
+      entry = None
+    if entry is None:
+      self.statistics['misses'] += 1
+      return None
+    self.statistics['hits'] += 1
+    entry['lastUsed'] = time.time()
+    return entry['transform']
+
+  def put(self, key, kind, fileName, transform):
+    entry = {}
+    entry['transform'] = transform
+    entry['fileName'] = fileName
+    entry['stamp'] = fileStamp(fileName)
+    entry['lastUsed'] = time.time()
+    if kind == 'node':
+      entry['nodeID'] = transform.GetID()
+      # Node keeps the same control points as the evaluator, file size is close enough
+      entry['bytes'] = entry['stamp'][0] if entry['stamp'] is not None else 0
+    else:
+      entry['bytes'] = transform.coefficients.nbytes
+    self.entries[(key, kind)] = entry
+    self.evict((key, kind))
+
+  def remove(self, entryKey):
+    entry = self.entries.pop(entryKey, None)
+    if entry is None or not entryKey[1] == 'node':
+      return
+    if slicer.mrmlScene.GetNodeByID(entry['nodeID']) is entry['transform']:
+      slicer.mrmlScene.RemoveNode(entry['transform'])
+
+  def invalidate(self, fileName = None):
+    """Drops transforms of fileName (all without fileName), e.g. after a new registration."""
+    for entryKey in list(self.entries.keys()):
+      if fileName is None or self.entries[entryKey]['fileName'] == fileName:
+        self.remove(entryKey)
+
+  def size(self):
+    return sum([entry['bytes'] for entry in self.entries.values()])
+
+  def evict(self, keep = None):
+    if self.maxBytes is None:
+      return
+    candidates = [entryKey for entryKey in self.entries if not entryKey == keep]
+    candidates.sort(key = lambda entryKey: self.entries[entryKey]['lastUsed'])
+    while candidates and self.size() > self.maxBytes:
+      self.remove(candidates.pop(0))
+      self.statistics['evictions'] += 1
+
+  def clear(self):
+    self.invalidate()
+
+  def summary(self):
+    return ("Transform cache: " + str(len(self.entries)) + " transforms, " + str(round(self.size() / 1024.**2, 1)) + " MB, " +
+            str(self.statistics['hits']) + " hits, " + str(self.statistics['misses']) + " misses, " +
+            str(self.statistics['evictions']) + " evicted.")
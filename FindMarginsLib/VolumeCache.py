@@ -0,0 +1,111 @@
+import time
+from __main__ import vtk, qt, ctk, slicer
+
+
+def volumeBytes(node):
+  imageData = node.GetImageData()
+  if imageData is None:
+    return 0
+  return imageData.GetNumberOfPoints() * imageData.GetNumberOfScalarComponents() * imageData.GetScalarSize()
+
+
+#
+# VolumeCache
+#
+
+class VolumeCache():
+  """Keeps CT volumes loaded from DICOM in the scene for reuse, keyed by series UID.
+
+  Patient.releaseDicom() hands a volume back instead of removing it, so the
+  next loadDicom() of the same series takes the node from the scene instead
+  of parsing DICOM again. Released volumes are removed, least recently used
+  first, when all cached volumes take more than maxBytes. Pinned volumes (e.g.
+  reference phase during registration of all phases) are never removed, nor
+  are volumes still in use. Volumes changed in place (hardened transform) must
+  be released with modified=True, they are dropped right away.
+  """
+  def __init__(self, maxBytes = 4 * 1024**3):
+    self.maxBytes = maxBytes
+    self.entries = {}
+    self.pinned = set()
+    self.statistics = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+  def get(self, uid):
+    """Cached node of series uid or None."""
+    entry = self.entries.get(uid)
+    if entry is not None and not slicer.mrmlScene.GetNodeByID(entry['nodeID']) is entry['node']:
+      #Node was removed from scene by someone else (e.g. scene was cleared)
+      del self.entries[uid]
+      entry = None
+    if entry is None:
+      self.statistics['misses'] += 1
+      return None
+    self.statistics['hits'] += 1
+    entry['released'] = False
+    entry['lastUsed'] = time.time()
+    return entry['node']
+
+  def put(self, uid, node):
+    entry = {}
+    entry['node'] = node
+    entry['nodeID'] = node.GetID()
+    entry['bytes'] = volumeBytes(node)
+    entry['lastUsed'] = time.time()
+    entry['released'] = False
+    self.entries[uid] = entry
+    self.evict()
+
+  def uidOf(self, node):
+    for uid, entry in self.entries.items():
+      if entry['node'] is node:
+        return uid
+    return None
+
+  def pin(self, uid):
+    """Keeps series in cache after release, also when it is loaded later."""
+    self.pinned.add(uid)
+
+  def unpin(self, uid):
+    self.pinned.discard(uid)
+    self.evict()
+
+  def release(self, uid, modified = False):
+    """Marks volume as unused. Returns False, if it isn't cached and caller has to remove it."""
+    entry = self.entries.get(uid)
+    if entry is None:
+      return False
+    if modified:
+      self.remove(uid)
+      return True
+    entry['released'] = True
+    entry['lastUsed'] = time.time()
+    self.evict()
+    return True
+
+  def remove(self, uid):
+    entry = self.entries.pop(uid, None)
+    if entry is None:
+      return
+    if slicer.mrmlScene.GetNodeByID(entry['nodeID']) is entry['node']:
+      slicer.mrmlScene.RemoveNode(entry['node'])
+
+  def size(self):
+    return sum([entry['bytes'] for entry in self.entries.values()])
+
+  def evict(self):
+    if self.maxBytes is None:
+      return
+    candidates = [uid for uid in self.entries if self.entries[uid]['released'] and uid not in self.pinned]
+    candidates.sort(key = lambda uid: self.entries[uid]['lastUsed'])
+    while candidates and self.size() > self.maxBytes:
+      self.remove(candidates.pop(0))
+      self.statistics['evictions'] += 1
+
+  def clear(self):
+    for uid in list(self.entries.keys()):
+      self.remove(uid)
+
+  def summary(self):
+    return ("Volume cache: " + str(len(self.entries)) + " volumes, " + str(round(self.size() / 1024.**2, 1)) + " MB, " +
+            str(self.statistics['hits']) + " hits, " + str(self.statistics['misses']) + " misses, " +
+            str(self.statistics['evictions']) + " evicted.")
@@ -0,0 +1,163 @@
+import os
+import re
+import time
+import shutil
+import tempfile
+from __main__ import vtk, qt, ctk, slicer
+import numpy as np
+
+import RegistrationHierarchy
+
+# Relative image difference between a phase and the phase its initial transform
+# comes from, under which the warm start is taken as close enough to skip the
+# coarsest stage and cut the iterations.
+CLOSE_DISTANCE = 0.05
+CLOSE_ITERATION_FACTOR = 0.5
+THUMBNAIL_STEP = 4
+
+
+def phaseOrder(refPhase, nPhases = 10):
+  """Returns [(phase, seedPhase), ...] going outward from refPhase around the breathing cycle.
+  seedPhase is the neighbour one step closer to refPhase, None for neighbours of refPhase.
+  """
+  order = []
+  for distance in range(1, nPhases/2 + 1):
+    for direction in [1, -1]:
+      phase = (refPhase + direction * distance) % nPhases
+      if phase == refPhase or phase in [p for p, seed in order]:
+        continue
+      seed = (phase - direction) % nPhases
+      if seed == refPhase:
+        seed = None
+      order.append((phase, seed))
+  return order
+
+
+def thumbnail(node):
+  return slicer.util.array(node.GetID())[::THUMBNAIL_STEP, ::THUMBNAIL_STEP, ::THUMBNAIL_STEP].astype(np.float32)
+
+
+def imageDistance(image, seedImage):
+  """Mean squared difference relative to image variance."""
+  if image is None or seedImage is None or not image.shape == seedImage.shape:
+    return None
+  variance = image.var()
+  if variance <= 0:
+    return None
+  return float(np.mean((image - seedImage)**2) / variance)
+
+
+def setWarmStart(regParameters, seedFile, distance):
+  """Seeds registration with seedFile; skips coarse stage and cuts iterations, if the phases are close."""
+  regParameters.initialBspline = seedFile
+  regParameters.iterationFactor = 1.0
+  regParameters.skipFirstStage = False
+  if distance is not None and distance < CLOSE_DISTANCE:
+    regParameters.iterationFactor = CLOSE_ITERATION_FACTOR
+    regParameters.skipFirstStage = True
+
+
+def parseMetric(log):
+  """Last metric value reported in plastimatch register output."""
+  values = re.findall(r'(?:MSE|MI|NMI|MSE_ROI)\s+([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)', log)
+  if not values:
+    return None
+  return float(values[-1])
+
+
+#
+# WarmStartBenchmark
+#
+
+class WarmStartBenchmark():
+  """Registers phases of a patient cold and warm started and compares wall time and final metric.
+
+  Both modes run through the plastimatch executable into a temporary directory,
+  so existing registrations and the registration cache aren't touched.
+  """
+  def __init__(self, patient, phases = None):
+    self.patient = patient
+    self.phases = phases
+    self.results = {}
+    self.report = ""
+
+  def run(self):
+    patient = self.patient
+    refPhase = patient.refPhase
+    directory = tempfile.mkdtemp(prefix="FindMarginsWarmStart_")
+    thumbnails = {}
+    files = {}
+
+    if not patient.loadDicom(refPhase):
+      return "Can't load reference phase"
+
+    for phase, seed in phaseOrder(refPhase):
+      if self.phases is not None and phase not in self.phases:
+        continue
+      if not patient.loadDicom(phase):
+        print "Can't load phase " + str(phase) + "0%."
+        continue
+      thumbnails[phase] = thumbnail(patient.fourDCT[phase].node)
+
+      self.results[phase] = {}
+      for mode in ["cold", "warm"]:
+        patient.create4DParameters()
+        regParameters = patient.regParameters
+        regParameters.cache = None
+        regParameters.useCommandFile = True
+        regParameters.vectorDirectory = os.path.join(directory, mode) + "/"
+        if not os.path.exists(regParameters.vectorDirectory):
+          os.makedirs(regParameters.vectorDirectory)
+        regParameters.referenceNumber = str(phase) + "0"
+        regParameters.movingNode = patient.fourDCT[refPhase].node.GetID()
+        regParameters.referenceNode = patient.fourDCT[phase].node.GetID()
+
+        distance = None
+        if mode == "warm" and seed is not None and seed in files:
+          distance = imageDistance(thumbnails[phase], thumbnails.get(seed))
+          setWarmStart(regParameters, files[seed], distance)
+
+        startTime = time.time()
+        process = regParameters.register()
+        duration = time.time() - startTime
+        if process is None:
+          return "Can't run plastimatch, check python console."
+
+        result = {}
+        result['time'] = duration
+        result['metric'] = parseMetric(process.logText())
+        result['distance'] = distance
+        result['warm'] = bool(regParameters.initialBspline)
+        result['success'] = process.GetStatus() == process.Completed
+        self.results[phase][mode] = result
+        if mode == "warm" and result['success']:
+          files[phase] = regParameters.bspline_F_name
+        process.cleanup()
+
+      patient.releaseDicom(phase)
+
+    patient.releaseDicom(refPhase)
+    shutil.rmtree(directory, True)
+    self.report = self.createReport()
+    print self.report
+    return self.report
+
+  def createReport(self):
+    lines = ["Warm start benchmark for " + self.patient.ID + " (reference phase " + str(self.patient.refPhase) + "0%)",
+             "phase   cold [s]   warm [s]   cold metric   warm metric   metric diff"]
+    totalCold = 0.
+    totalWarm = 0.
+    for phase in sorted(self.results.keys()):
+      cold = self.results[phase]["cold"]
+      warm = self.results[phase]["warm"]
+      totalCold += cold['time']
+      totalWarm += warm['time']
+      difference = ""
+      if cold['metric'] is not None and warm['metric'] is not None:
+        difference = "%.4g" % (warm['metric'] - cold['metric'])
+      lines.append("%3d0%%   %8.1f   %8.1f   %11s   %11s   %11s" % (phase, cold['time'], warm['time'], cold['metric'], warm['metric'], difference))
+    saving = 0.
+    if totalCold > 0:
+      saving = 100. * (totalCold - totalWarm) / totalCold
+    lines.append("total   %8.1f   %8.1f   wall time saved: %.1f %%" % (totalCold, totalWarm, saving))
+    return "\n".join(lines)
@@ -0,0 +1,214 @@
+import threading
+import multiprocessing
+import numpy as np
+
+# Output slices per work item, small enough to keep coordinates of a slab in cache
+SLAB_SIZE = 4
+
+
+def linearWeights(f):
+  return [1 - f, f]
+
+
+def cubicConvolutionWeights(f):
+  """Cubic convolution (Keys, a = -0.5), interpolates the samples like VTK's cubic mode."""
+  f2 = f * f
+  f3 = f2 * f
+  return [-0.5 * f3 + f2 - 0.5 * f,
+          1.5 * f3 - 2.5 * f2 + 1,
+          -1.5 * f3 + 2 * f2 + 0.5 * f,
+          0.5 * f3 - 0.5 * f2]
+
+
+def interpolate(image, cidx, order = 1, background = 0.):
+  """Samples image (k, j, i) or (k, j, i, components) at continuous indices cidx (N x 3, i j k order).
+  order 1 is trilinear, 3 cubic convolution. Points outside the image get background.
+  Returns float32 array (N) or (N, components).
+  """
+  shape = image.shape[0:3]
+  n = cidx.shape[0]
+  if image.ndim == 4:
+    flat = image.reshape(-1, image.shape[3])
+    resultShape = (n, image.shape[3])
+  else:
+    flat = image.reshape(-1)
+    resultShape = (n,)
+  inside = np.ones(n, dtype=bool)
+  for axis in range(3):
+    inside &= (cidx[:, axis] >= 0) & (cidx[:, axis] <= shape[2 - axis] - 1)
+
+  if order == 3:
+    weightFunction, offsets = cubicConvolutionWeights, [-1, 0, 1, 2]
+  else:
+    weightFunction, offsets = linearWeights, [0, 1]
+
+  indexType = np.int32 if flat.shape[0] < 2**31 else np.int64
+  base = np.floor(cidx)
+  fraction = (cidx - base).astype(np.float32)
+  base = base.astype(indexType)
+  weights = [weightFunction(fraction[:, axis]) for axis in range(3)]
+  # Neighbours outside the image repeat the edge voxel
+  strides = [1, shape[2], shape[2] * shape[1]]
+  indices = []
+  for axis in range(3):
+    indices.append([np.clip(base[:, axis] + offset, 0, shape[2 - axis] - 1) * strides[axis] for offset in offsets])
+
+  # Buffers are reused for all neighbours, only result is returned
+  result = np.zeros(resultShape, dtype=np.float32)
+  index = np.empty(n, dtype=indexType)
+  weight = np.empty(n, dtype=np.float32)
+  weightKJ = np.empty(n, dtype=np.float32)
+  values = np.empty(resultShape, dtype=flat.dtype)
+  weighted = np.empty(resultShape, dtype=np.float32)
+  if image.ndim == 4:
+    weightView = weight[:, np.newaxis]
+  else:
+    weightView = weight
+  for c in range(len(offsets)):
+    for b in range(len(offsets)):
+      offsetKJ = indices[2][c] + indices[1][b]
+      np.multiply(weights[2][c], weights[1][b], out=weightKJ)
+      for a in range(len(offsets)):
+        np.add(offsetKJ, indices[0][a], out=index)
+        np.multiply(weightKJ, weights[0][a], out=weight)
+        # take releases the GIL, so slabs in other threads run meanwhile
+        np.take(flat, index, axis=0, out=values)
+        np.multiply(values, weightView, out=weighted)
+        result += weighted
+  result[~inside] = background
+  return result
+
+
+def gridIndices(dimensions, zStart, zEnd):
+  """Voxel indices (i, j, k) of slices zStart:zEnd as N x 3 float array."""
+  k, j, i = np.mgrid[zStart:zEnd, 0:dimensions[1], 0:dimensions[0]]
+  return np.vstack([i.ravel(), j.ravel(), k.ravel()]).T.astype(np.float64)
+
+
+def runSlabs(n, function, nThreads = None, slabSize = SLAB_SIZE):
+  """Calls function(start, end) for slabs of range(n), spread over nThreads threads."""
+  if nThreads is None:
+    nThreads = multiprocessing.cpu_count()
+  slabs = [(start, min(start + slabSize, n)) for start in range(0, n, slabSize)]
+  lock = threading.Lock()
+  errors = []
+
+  def worker():
+    while True:
+      with lock:
+        if not slabs or errors:
+          return
+        start, end = slabs.pop(0)
+      try:
+        function(start, end)
+      except Exception as e:
+        with lock:
+          errors.append(e)
+
+  threads = [threading.Thread(target=worker) for t in range(max(1, min(nThreads, len(slabs))))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
+
+
+def warpVolume(image, imageIJKToRAS, field, fieldIJKToRAS, out = None, order = 1, background = 0., nThreads = None):
+  """Resamples image through dense displacement field: out(y) = image(y + field(y)).
+
+  field (k, j, i, 3, RAS displacements) defines output grid with fieldIJKToRAS,
+  image (k, j, i) is placed by imageIJKToRAS (4x4 arrays). This is what
+  hardening a transform does, when field is the FromParent displacement.
+  Output is written slab by slab into out (float32 array of field grid shape,
+  allocated if not given), slabs are spread over nThreads threads.
+  """
+  dimensions = [field.shape[2], field.shape[1], field.shape[0]]
+  if out is None:
+    out = np.empty(field.shape[0:3], dtype=np.float32)
+  fieldIJKToRAS = np.asarray(fieldIJKToRAS, dtype=np.float64)
+  rasToImageIJK = np.linalg.inv(np.asarray(imageIJKToRAS, dtype=np.float64))
+
+  def slab(zStart, zEnd):
+    points = np.dot(gridIndices(dimensions, zStart, zEnd), fieldIJKToRAS[0:3, 0:3].T) + fieldIJKToRAS[0:3, 3]
+    points += field[zStart:zEnd].reshape(-1, 3)
+    cidx = np.dot(points, rasToImageIJK[0:3, 0:3].T) + rasToImageIJK[0:3, 3]
+    out[zStart:zEnd] = interpolate(image, cidx, order, background).reshape(zEnd - zStart, dimensions[1], dimensions[0])
+
+  runSlabs(dimensions[2], slab, nThreads)
+  return out
+
+
+def imageSlices(nSlices, imageIJKToRAS, field, fieldIJKToRAS, order = 1):
+  """Slices (start, end) of image that warping through field reads: range of the displaced
+  points along k plus halo of the interpolation kernel (linear reads k..k+1, cubic k-1..k+2).
+  """
+  rasToImageIJK = np.linalg.inv(np.asarray(imageIJKToRAS, dtype=np.float64))
+  fieldIJKToRAS = np.asarray(fieldIJKToRAS, dtype=np.float64)
+  # Image k is linear in the point, so it's found slice by slice of the field
+  row = rasToImageIJK[2, 0:3]
+  gridRow = np.dot(row, fieldIJKToRAS[0:3, 0:3])
+  offset = np.dot(row, fieldIJKToRAS[0:3, 3]) + rasToImageIJK[2, 3]
+  j, i = np.mgrid[0:field.shape[1], 0:field.shape[2]]
+  base = gridRow[0] * i + gridRow[1] * j + offset
+  low, high = np.inf, -np.inf
+  for z in range(field.shape[0]):
+    k = base + gridRow[2] * z + np.dot(field[z], row)
+    low, high = min(low, float(k.min())), max(high, float(k.max()))
+  halo = 1 if order == 3 else 0
+  start = min(max(0, int(np.floor(low)) - halo), nSlices - 1)
+  end = max(min(nSlices, int(np.floor(high)) + 2 + halo), start + 1)
+  return start, end
+
+
+def warpSlab(image, imageIJKToRAS, field, fieldIJKToRAS, out = None, order = 1, background = 0., nThreads = None):
+  """Same as warpVolume, but only the slices of image the field reaches are read, so image
+  can be a memory mapped file (e.g. readNrrdArray) and stays on disk apart from them.
+  """
+  start, end = imageSlices(image.shape[0], imageIJKToRAS, field, fieldIJKToRAS, order)
+  return warpVolume(np.asarray(image[start:end]), slabIJKToRAS(imageIJKToRAS, start), field, fieldIJKToRAS, out, order, background, nThreads)
+
+
+def imageDataArray(imageData):
+  """numpy view (k, j, i) or (k, j, i, components) of vtkImageData scalars, for writing results in place."""
+  from vtk.util import numpy_support
+  dimensions = imageData.GetDimensions()
+  components = imageData.GetNumberOfScalarComponents()
+  array = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+  if components > 1:
+    return array.reshape(dimensions[2], dimensions[1], dimensions[0], components)
+  return array.reshape(dimensions[2], dimensions[1], dimensions[0])
+
+
+def composeFields(inner, innerIJKToRAS, outer, outerIJKToRAS, out = None, nThreads = None):
+  """Fuses two displacement fields into one: out(y) = inner(y) + outer(y + inner(y)).
+
+  Warping with the result equals warping with outer first and inner second,
+  but the image is interpolated only once. Output is on grid of inner
+  (k, j, i, 3, float32); outer is interpolated trilinearly, points outside
+  its grid get no outer displacement.
+  """
+  dimensions = [inner.shape[2], inner.shape[1], inner.shape[0]]
+  if out is None:
+    out = np.empty(inner.shape, dtype=np.float32)
+  innerIJKToRAS = np.asarray(innerIJKToRAS, dtype=np.float64)
+  rasToOuterIJK = np.linalg.inv(np.asarray(outerIJKToRAS, dtype=np.float64))
+
+  def slab(zStart, zEnd):
+    displacement = inner[zStart:zEnd].reshape(-1, 3)
+    points = np.dot(gridIndices(dimensions, zStart, zEnd), innerIJKToRAS[0:3, 0:3].T) + innerIJKToRAS[0:3, 3]
+    points += displacement
+    cidx = np.dot(points, rasToOuterIJK[0:3, 0:3].T) + rasToOuterIJK[0:3, 3]
+    values = interpolate(outer, cidx, 1, 0.)
+    values += displacement
+    out[zStart:zEnd] = values.reshape(zEnd - zStart, dimensions[1], dimensions[0], 3)
+
+  runSlabs(dimensions[2], slab, nThreads)
+  return out
+
+
+def slabIJKToRAS(ijkToRAS, zStart):
+  """ijkToRAS of a slab of slices starting at zStart."""
+  matrix = np.array(ijkToRAS, dtype=np.float64)
+  matrix[0:3, 3] += zStart * matrix[0:3, 2]
+  return matrix
@@ -1,2 +1,25 @@
 from RegistrationHierarchy import *
 from Patient import *
+from PatientCatalog import *
+from PatientDiscovery import *
+from RegistrationPool import *
+from BatchProcessing import *
+from RegistrationCache import *
+from WarmStart import *
+from StagePlanner import *
+from BsplineTransform import *
+from VolumeCache import *
+from FieldAccumulator import *
+from FieldStore import *
+from WarpEngine import *
+from FieldInverter import *
+from NrrdFile import *
+from ProjectionReducer import *
+from MidVManifest import *
+from RegionOfInterest import *
+from FieldPyramid import *
+from ContourPoints import *
+from Centroids import *
+from StructureMotion import *
+from TransformCache import *
+from AmplitudeMaps import *
@@ -0,0 +1,162 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+# Modules tested here only need numpy, they're imported without Slicer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "FindMarginsLib"))
+
+from NrrdFile import NrrdWriter, readNrrdArray
+from FieldStore import FieldStore
+from FieldInverter import FieldInverter
+from ProjectionReducer import ProjectionReducer
+from WarpEngine import interpolate, gridIndices, warpVolume, warpSlab
+from Centroids import pointsCentroids
+from AmplitudeMaps import maskPoints
+
+
+def obliqueIJKToRAS(spacing = (1.2, 0.9, 2.5), origin = (-30., 12., -80.)):
+  angle = 0.1
+  rotation = np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+  ijkToRAS = np.eye(4)
+  ijkToRAS[0:3, 0:3] = rotation * np.array(spacing)
+  ijkToRAS[0:3, 3] = origin
+  return ijkToRAS
+
+
+def smoothField(shape, amplitude = 3.):
+  """Breathing like displacement field (k, j, i, 3), smooth enough to be inverted."""
+  k, j, i = np.mgrid[0:shape[0], 0:shape[1], 0:shape[2]].astype(np.float32)
+  field = np.empty(tuple(shape) + (3,), dtype=np.float32)
+  field[..., 0] = amplitude * 0.3 * np.sin(i / 7.)
+  field[..., 1] = amplitude * 0.5 * np.cos(j / 9.) * np.sin(k / 11.)
+  field[..., 2] = amplitude * np.sin(k / 8. + j / 13.)
+  return field
+
+
+class FindMarginsLibTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="FindMarginsLibTest_")
+    self.random = np.random.RandomState(7)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, True)
+
+  def test_NrrdRoundTrip(self):
+    volume = self.random.randint(-1024, 3000, size=(13, 10, 12)).astype(np.int16)
+    ijkToRAS = obliqueIJKToRAS()
+    fileName = os.path.join(self.directory, "volume.nrrd")
+    writer = NrrdWriter(fileName, [12, 10, 13], ijkToRAS, np.int16)
+    self.assertTrue(writer.open())
+    for zStart in range(0, 13, 5):
+      writer.writeSlab(volume[zStart:zStart + 5])
+    self.assertTrue(writer.close())
+
+    array, dimensions, readIJKToRAS = readNrrdArray(fileName)
+    self.assertEqual(dimensions, [12, 10, 13])
+    self.assertTrue(np.allclose(readIJKToRAS, ijkToRAS))
+    self.assertTrue(np.array_equal(array, volume))
+
+  def test_NrrdWriterRejectsMissingSlices(self):
+    fileName = os.path.join(self.directory, "short.nrrd")
+    writer = NrrdWriter(fileName, [4, 4, 6], np.eye(4), np.float32)
+    self.assertTrue(writer.open())
+    writer.writeSlab(np.zeros((3, 4, 4), dtype=np.float32))
+    self.assertFalse(writer.close())
+
+  def test_FieldStoreInt16(self):
+    field = smoothField((12, 16, 14), 8.)
+    field += self.random.randn(*field.shape).astype(np.float32)
+    source = os.path.join(self.directory, "bspline.txt")
+    with open(source, 'w') as f:
+      f.write("transform")
+    store = FieldStore(os.path.join(self.directory, "fields"), 'int16')
+    self.assertTrue(store.save("field", field, obliqueIJKToRAS(), source))
+
+    stored = store.open("field", source)
+    self.assertIsNotNone(stored)
+    self.assertTrue(stored.matches([14, 16, 12], obliqueIJKToRAS()))
+    error = np.abs(stored.array() - field).max()
+    self.assertLessEqual(error, stored.header['maxError'] * (1 + 1e-5))
+    # int16 takes half of float32, pyramid levels aren't stored with the field
+    self.assertLessEqual(os.path.getsize(stored.fileName), field.nbytes / 2 + 1024)
+    self.assertIsNone(store.readHeader(store.levelName("field", 2)))
+
+    level = store.open("field", source, 2)
+    self.assertEqual(level.shape, (6, 8, 7, 3))
+
+    # Changed source file makes the field stale
+    with open(source, 'a') as f:
+      f.write(" changed")
+    self.assertIsNone(store.open("field", source))
+
+  def test_FieldInverterResidual(self):
+    shape = (10, 18, 16)
+    ijkToRAS = obliqueIJKToRAS((2., 2., 2.5))
+    field = smoothField(shape, 4.)
+    inverter = FieldInverter(tolerance = 0.01, maxIterations = 30, nThreads = 2)
+    inverse = inverter.invert(field, ijkToRAS)
+    self.assertEqual(inverter.statistics['unconverged'], 0)
+    self.assertLessEqual(inverter.statistics['maxResidual'], 0.01)
+
+    # v(y) + u(y + v(y)) vanishes inside the grid (edge values extend the field outside)
+    dimensions = [shape[2], shape[1], shape[0]]
+    points = np.dot(gridIndices(dimensions, 0, shape[0]), ijkToRAS[0:3, 0:3].T) + ijkToRAS[0:3, 3]
+    points += inverse.reshape(-1, 3)
+    cidx = np.dot(points, np.linalg.inv(ijkToRAS)[0:3, 0:3].T) + np.linalg.inv(ijkToRAS)[0:3, 3]
+    np.clip(cidx, 0, np.array(dimensions) - 1, out=cidx)
+    residual = interpolate(field, cidx, 1, 0.) + inverse.reshape(-1, 3)
+    self.assertLess(np.sqrt(np.sum(residual**2, axis=1)).max(), 0.011)
+
+  def test_ProjectionReducerMeanStd(self):
+    phases = [self.random.randint(-1000, 2000, size=(9, 8, 7)).astype(np.int16) for n in range(10)]
+    reducer = ProjectionReducer(['mean', 'std', 'mip', 'minip', 'median'], nThreads = 2)
+    for phase in phases:
+      self.assertTrue(reducer.add(phase))
+    results = reducer.finish()
+    stack = np.array(phases, dtype=np.float64)
+    self.assertTrue(np.allclose(results['mean'], stack.mean(axis=0), atol=1e-2))
+    self.assertTrue(np.allclose(results['std'], stack.std(axis=0), atol=1e-2))
+    self.assertTrue(np.array_equal(results['mip'], stack.max(axis=0)))
+    self.assertTrue(np.array_equal(results['minip'], stack.min(axis=0)))
+    self.assertTrue(np.allclose(results['median'], np.median(stack, axis=0)))
+
+  def test_ProjectionReducerRejectsOtherShape(self):
+    reducer = ProjectionReducer(['mean'])
+    self.assertTrue(reducer.add(np.zeros((4, 4, 4), dtype=np.int16)))
+    self.assertFalse(reducer.add(np.zeros((4, 4, 5), dtype=np.int16)))
+
+  def test_VolumetricCentroids(self):
+    # Box with much more vertices on one side, its centre of mass is still the centre of the box
+    corners = np.array([[x, y, z] for x in [0, 4] for y in [0, 2] for z in [0, 6]], dtype=np.float64)
+    faces = [[0, 1, 3, 2], [4, 6, 7, 5], [0, 4, 5, 1], [2, 3, 7, 6], [0, 2, 6, 4], [1, 5, 7, 3]]
+    triangles = np.array([[f[0], f[1], f[2]] for f in faces] + [[f[0], f[2], f[3]] for f in faces])
+    extra = np.vstack([corners, np.tile(corners[0], (50, 1))])
+    shifted = extra + [10., -5., 3.]
+    centroids = pointsCentroids([extra, shifted], triangles)
+    self.assertTrue(np.allclose(centroids, [[2., 1., 3.], [12., -4., 6.]]))
+
+    # Labelmap voxel centres give the centre of mass of the labelled volume
+    mask = np.zeros((6, 5, 4), dtype=np.uint8)
+    mask[1:5, 1:3, 0:4] = 1
+    ijkToRAS = obliqueIJKToRAS()
+    centroid = pointsCentroids([maskPoints(mask, ijkToRAS)])[0]
+    self.assertTrue(np.allclose(centroid, np.dot(ijkToRAS, [1.5, 1.5, 2.5, 1.])[0:3]))
+
+  def test_WarpSlabMatchesWholeVolume(self):
+    image = self.random.rand(30, 12, 14).astype(np.float32)
+    imageIJKToRAS = obliqueIJKToRAS()
+    for order in [1, 3]:
+      for zStart in [0, 12, 24]:
+        fieldIJKToRAS = np.array(imageIJKToRAS)
+        fieldIJKToRAS[0:3, 3] += zStart * fieldIJKToRAS[0:3, 2]
+        field = 3 * self.random.randn(6, 12, 14, 3).astype(np.float32)
+        whole = warpVolume(image, imageIJKToRAS, field, fieldIJKToRAS, None, order)
+        slab = warpSlab(image, imageIJKToRAS, field, fieldIJKToRAS, None, order)
+        self.assertTrue(np.array_equal(whole, slab))
+
+
+if __name__ == '__main__':
+  unittest.main()